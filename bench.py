@@ -0,0 +1,404 @@
+import asyncio
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import click
+
+import codec
+from config import MCAST_GRP, MCAST_PORT, BUF
+from ring import HashRing, PARTITIONED_TYPES, READ_TYPES, parse_leader_reply
+
+
+HOST = "127.0.0.1"
+WORKLOADS = ["small-groups", "huge-group", "vote-storm", "reads"]
+
+# Members per group in the small-groups workload
+SMALL_GROUP_SIZE = 4
+
+# Servers discover each other before the first one starts the election
+ELECT_AFTER = 2.5
+LEADER_TIMEOUT = 20.0
+
+# A new leader first syncs with its backups, keep that out of the numbers
+SETTLE = 1.0
+
+REQUEST_TIMEOUT = 2.0
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    rank = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(seconds):
+    values = sorted(s * 1000 for s in seconds)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "p999": percentile(values, 99.9),
+        "max": values[-1] if values else None
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+class BenchClient(asyncio.DatagramProtocol):
+    """
+    A simulated client speaking the real wire protocol. It runs one
+    request at a time and votes on every poll it receives.
+    """
+    def __init__(self, bench):
+        self.bench = bench
+        self.id = str(uuid.uuid4())
+        self.token = None
+        self.codec = codec.JSON
+        self.transport = None
+        self.waiting = None
+        self.voted = {}
+        self.version = 0
+        self.catalogue = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = codec.decode(data)
+        except Exception:
+            self.bench.errors += 1
+            return
+
+        msg_type = msg.get("type")
+        self.version = max(self.version, msg.get("version", 0))
+        if self.waiting is not None and msg_type == self.waiting[0]:
+            future = self.waiting[1]
+            if not future.done():
+                future.set_result(msg)
+        elif msg_type == "VOTE":
+            self.__vote(msg)
+        elif msg_type == "VOTE_RESULT":
+            self.bench.poll_done(msg)
+        elif msg_type == "NEW_LEADER":
+            self.bench.new_leader(msg)
+        elif msg_type == "ERROR":
+            self.bench.errors += 1
+
+    def send(self, msg):
+        msg["id"] = self.id
+        if self.token is not None:
+            msg["token"] = self.token
+        if msg["type"] in READ_TYPES:
+            msg["min_version"] = self.version
+        self.transport.sendto(codec.encode(msg, self.codec), self.bench.route(msg))
+
+    async def request(self, msg, reply_type):
+        """
+        Sends msg and waits for its reply. Returns None on timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiting = (reply_type, future)
+        start = time.perf_counter()
+        self.send(msg)
+        try:
+            reply = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.bench.timeouts += 1
+            return None
+        finally:
+            self.waiting = None
+
+        self.bench.record(msg["type"], time.perf_counter() - start)
+        return reply
+
+    async def register(self, offer):
+        reply = await self.request({"type": "REGISTER", "codecs": [offer]}, "REGISTER_OK")
+        if reply is not None:
+            self.token = reply["token"]
+            self.codec = reply.get("codec", codec.JSON)
+        return reply
+
+    def __vote(self, msg):
+        key = (msg["group"], msg["S"])
+        vote = self.voted.get(key)
+        if vote is None:
+            # First delivery, retransmissions get the same ballot again
+            vote = random.choice(msg["options"])
+            self.voted[key] = vote
+            self.bench.votes += 1
+        self.send({"type": "VOTE_ACK", "vote_id": msg["vote_id"], "group": msg["group"], "S": msg["S"], "vote": vote})
+
+
+class Bench:
+    """
+    One benchmark run against an already running cluster.
+    """
+    def __init__(self, leader, ring, clients, workload, polls, poll_timeout, offer):
+        self.leader = leader
+        self.ring = ring
+        self.workload = workload
+        self.polls = polls
+        self.poll_timeout = poll_timeout
+        self.offer = offer
+        self.n_clients = clients
+        self.run_id = uuid.uuid4().hex[:8]
+
+        self.latencies = {}
+        self.poll_started = {}
+        self.poll_waiters = {}
+        self.completions = []
+        self.votes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.lost_polls = 0
+
+    def route(self, msg):
+        """
+        Address of the server a request goes to: polls to the owner of
+        their group, reads to any server, everything else to the leader.
+        """
+        server = None
+        if msg["type"] in PARTITIONED_TYPES and len(self.ring):
+            server = self.ring.owner(msg["group"])
+        elif msg["type"] in READ_TYPES and len(self.ring):
+            server = random.choice(self.ring.nodes)
+        if server is None:
+            return self.leader
+        ip, port = server.split(":")
+        return ip, int(port)
+
+    def new_leader(self, msg):
+        ip, port = msg["id"].split(":")
+        self.leader = (ip, int(port))
+        self.ring = HashRing(msg.get("ring", []))
+
+    def record(self, msg_type, seconds):
+        self.latencies.setdefault(msg_type, []).append(seconds)
+
+    def poll_done(self, msg):
+        topic = msg.get("topic")
+        start = self.poll_started.pop(topic, None)
+        if start is None:
+            return
+        self.completions.append(time.perf_counter() - start)
+        waiter = self.poll_waiters.pop(topic, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(msg)
+
+    async def __poll(self, client, group):
+        topic = f"{self.run_id}-{uuid.uuid4().hex[:8]}"
+        waiter = asyncio.get_running_loop().create_future()
+        self.poll_waiters[topic] = waiter
+        self.poll_started[topic] = time.perf_counter()
+
+        reply = await client.request({
+            "type": "START_VOTE",
+            "group": group,
+            "topic": topic,
+            "options": ["yes", "no"],
+            "timeout": self.poll_timeout
+        }, "START_VOTE_OK")
+
+        try:
+            if reply is not None:
+                await asyncio.wait_for(waiter, self.poll_timeout + REQUEST_TIMEOUT)
+                return
+        except asyncio.TimeoutError:
+            pass
+        self.lost_polls += 1
+        self.poll_started.pop(topic, None)
+        self.poll_waiters.pop(topic, None)
+
+    async def __poller(self, client, group):
+        for _ in range(self.polls):
+            await self.__poll(client, group)
+
+    async def __reader(self, client):
+        for i in range(self.polls):
+            if i % 2:
+                await client.request({"type": "JOINED_GROUPS"}, "JOINED_GROUPS_OK")
+            else:
+                # Asks for changes since the last listing like the client
+                msg = {"type": "GET_GROUPS"}
+                if client.catalogue is not None:
+                    msg["since"] = client.catalogue
+                reply = await client.request(msg, "GET_GROUPS_OK")
+                if reply is not None and reply.get("cursor") is None:
+                    client.catalogue = reply["catalogue"]
+
+    async def __form_group(self, owner, members, group):
+        await owner.request({"type": "CREATE_GROUP", "group": group}, "CREATE_GROUP_OK")
+        await asyncio.gather(*(m.request({"type": "JOIN_GROUP", "group": group}, "JOIN_GROUP_OK") for m in members))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        clients = []
+        for _ in range(self.n_clients):
+            _, client = await loop.create_datagram_endpoint(lambda: BenchClient(self), local_addr=(HOST, 0))
+            clients.append(client)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(c.register(self.offer) for c in clients))
+
+        if self.workload == "small-groups":
+            teams = [clients[i:i + SMALL_GROUP_SIZE] for i in range(0, len(clients), SMALL_GROUP_SIZE)]
+            names = [f"bench-{self.run_id}-{i}" for i in range(len(teams))]
+            await asyncio.gather(*(self.__form_group(t[0], t[1:], n) for t, n in zip(teams, names)))
+            await asyncio.gather(*(self.__poller(t[0], n) for t, n in zip(teams, names)))
+        elif self.workload == "reads":
+            # Catalogue queries only, --polls of them per client
+            await asyncio.gather(*(c.request({"type": "CREATE_GROUP", "group": f"bench-{self.run_id}-{i}"}, "CREATE_GROUP_OK")
+                                   for i, c in enumerate(clients)))
+            await asyncio.gather(*(self.__reader(c) for c in clients))
+        else:
+            name = f"bench-{self.run_id}-all"
+            await self.__form_group(clients[0], clients[1:], name)
+            pollers = clients[:1] if self.workload == "huge-group" else clients
+            await asyncio.gather(*(self.__poller(c, name) for c in pollers))
+
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            client.transport.close()
+
+        ops = sum(len(v) for v in self.latencies.values()) + self.votes
+        return {
+            "duration_s": elapsed,
+            "ops": ops,
+            "ops_per_s": ops / elapsed if elapsed else 0.0,
+            "votes": self.votes,
+            "latency_ms": {t: summarize(v) for t, v in sorted(self.latencies.items())},
+            "poll_completion_ms": summarize(self.completions),
+            "lost_polls": self.lost_polls,
+            "timeouts": self.timeouts,
+            "errors": self.errors
+        }
+
+
+def start_servers(n, base_port, server_args, log_dir):
+    here = os.path.dirname(os.path.abspath(__file__))
+    # A fresh token key for the cluster, passed in the environment
+    env = dict(os.environ, VOTECAST_SECRET=secrets.token_hex(32))
+    procs = []
+    for i in range(n):
+        port = base_port + i
+        args = [sys.executable, "-u", os.path.join(here, "server.py"), str(port), "--host", HOST, "--headless"] + server_args
+        if i == 0:
+            args += ["--elect-after", str(ELECT_AFTER)]
+        out = open(os.path.join(log_dir, f"server-{port}.log"), "w") if log_dir else subprocess.DEVNULL
+        procs.append(subprocess.Popen(args, cwd=here, stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, env=env))
+    return procs
+
+
+def stop_servers(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(5)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def find_leader(timeout=LEADER_TIMEOUT):
+    """
+    Returns the leader's address and the ring, None if nobody answers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1.0)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.sendto("WHO_IS_LEADER".encode(), (MCAST_GRP, MCAST_PORT))
+            try:
+                data, _ = sock.recvfrom(BUF)
+            except socket.timeout:
+                continue
+            reply = parse_leader_reply(data.decode())
+            if reply is not None:
+                ip, port = reply[0].split(":")
+                return (ip, int(port)), reply[1]
+    finally:
+        sock.close()
+    return None
+
+
+@click.command()
+@click.option("--servers", default=1, help="Servers to start on 127.0.0.1.")
+@click.option("--clients", default=16, help="Simulated clients.")
+@click.option("--workload", type=click.Choice(WORKLOADS), default="small-groups")
+@click.option("--polls", default=10, help="Polls started by every polling client, queries with --workload reads.")
+@click.option("--poll-timeout", default=5.0, help="Timeout of every poll in seconds.")
+@click.option("--codec", "offer", type=click.Choice(codec.SUPPORTED), default=codec.JSON, help="Codec the clients offer.")
+@click.option("--base-port", default=7100, help="Port of the first server.")
+@click.option("--asyncio", "use_asyncio", is_flag=True, help="Run the servers in asyncio mode.")
+@click.option("--durability", default=None, help="Durability mode passed to the servers.")
+@click.option("--workers", default=1, help="Worker processes per server.")
+@click.option("--log-dir", type=click.Path(file_okay=False), default=None, help="Keep server output in this directory.")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Append the result as a JSON line to this file.")
+def main(servers, clients, workload, polls, poll_timeout, offer, base_port, use_asyncio, durability, workers, log_dir, output):
+    server_args = ["--workers", str(workers)]
+    if use_asyncio:
+        server_args.append("--asyncio")
+    if durability:
+        server_args += ["--durability", durability]
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    procs = start_servers(servers, base_port, server_args, log_dir)
+    try:
+        if find_leader() is None:
+            raise click.ClickException("No leader was elected")
+        time.sleep(SETTLE)
+
+        # Asked again for the ring the leader settled on
+        found = find_leader()
+        if found is None:
+            raise click.ClickException("Lost the leader while the cluster settled")
+        leader, ring = found
+        bench = Bench(leader, ring, clients, workload, polls, poll_timeout, offer)
+        result = asyncio.run(bench.run())
+    finally:
+        stop_servers(procs)
+
+    result = {
+        "commit": git_commit(),
+        "time": time.time(),
+        "workload": workload,
+        "servers": servers,
+        "clients": clients,
+        "polls": polls,
+        "codec": offer,
+        "mode": "asyncio" if use_asyncio else "threaded",
+        "durability": durability,
+        "workers": workers,
+        **result
+    }
+
+    line = json.dumps(result)
+    print(line)
+    if output:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
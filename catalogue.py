@@ -0,0 +1,59 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+
+# Catalogue changes kept for deltas, older versions get the full listing
+CATALOGUE_HISTORY = 1000
+
+
+class Catalogue:
+    """
+    Names of all groups in sorted order, with a version.
+
+    The version counts catalogue changes in log order, so it is the same
+    on every server. The newest changes are kept to answer a client that
+    knows an older version with the groups added since. Groups are never
+    deleted. Sorted names make a cursor, the last name of the previous
+    page, stable while groups are added.
+    """
+    def __init__(self, names=(), version=0, history=CATALOGUE_HISTORY):
+        self.names = sorted(names)
+        self.version = version
+        self.changes = deque(maxlen=history)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        insort(self.names, name)
+        self.version += 1
+        self.changes.append((self.version, name))
+
+    def select(self, cursor=None, prefix="", contains=""):
+        """
+        Yields the names after cursor in order that start with prefix and
+        contain contains.
+        """
+        # Names with a prefix are next to each other
+        start = bisect_left(self.names, prefix)
+        if cursor is not None:
+            start = max(start, bisect_right(self.names, cursor))
+        for i in range(start, len(self.names)):
+            name = self.names[i]
+            if not name.startswith(prefix):
+                return
+            if contains in name:
+                yield name
+
+    def delta(self, since):
+        """
+        Returns the names added since version since in order, None if
+        that is older than the history or not a version of this
+        catalogue.
+        """
+        if since > self.version:
+            return None
+        if since < self.version and (not self.changes or self.changes[0][0] > since + 1):
+            return None
+
+        return sorted(name for version, name in self.changes if version > since)
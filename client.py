@@ -1,27 +1,79 @@
-import socket
 import json
+import os
+import random
+import socket
 import uuid
 import threading
 import signal
+import time
 
+import codec
 from config import MCAST_GRP, MCAST_PORT, BUF
+from logger import Logger, DEBUG, INFO, ERROR
+from ring import HashRing, PARTITIONED_TYPES, READ_TYPES, parse_leader_reply
+
+
+# Seconds before a lost FEED_FETCH is sent again
+FEED_FETCH_INTERVAL = 1.0
+
+# Seconds a reply is waited for
+SOCKET_TIMEOUT = 2
+
+# Seconds between leader requests while nobody answers, doubled up to the
+# maximum, so that clients waiting out an election do not flood the group
+DISCOVERY_INTERVAL = 0.5
+DISCOVERY_MAX_INTERVAL = 8.0
+
+# Last known leader and ring, tried first after a restart. Not the epoch:
+# servers count epochs anew when the whole cluster restarts
+LEADER_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "poll-client", "leader.json")
 
 
 class Client:
     def __init__(self):
+        self.logger = Logger("CLIENT")
+
         # Own communication
         self.id = str(uuid.uuid4())
         self.__log(f"ID: {self.id}")
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.settimeout(2)
+        self.sock.settimeout(SOCKET_TIMEOUT)
 
-        # Leader server
+        # Leader server, the election that made it leader, and the ring
+        # telling which server leads the polls of a group
         self.leader = None
+        self.epoch = 0
+        self.ring = HashRing()
+
+        # Last request of every type, sent again when redirected
+        self.last_sent = {}
+
+        # Newest state of the leader's log seen in a reply, reads from
+        # backups must not go back before it
+        self.version = 0
+
+        # Group catalogue as of version catalogue, and the pages of the
+        # listing being fetched with its (prefix, contains) filter
+        self.catalogue = None
+        self.known_groups = set()
+        self.listing = ("", "")
+        self.pages = []
+        self.pages_catalogue = None
+
+        # Catalogue feed: the leader's log index it was received up to and
+        # the last known member count per group
+        self.subscribed = False
+        self.feed_seq = 0
+        self.feed_fetched_at = 0
+        self.member_counts = {}
         
         # Authentication
         self.token = None
 
+        # Wire codec, negotiated at registration
+        self.codec = codec.JSON
+
         # FO reliable multicast R^q_g and FIFO
         self.R = {}
         self.hold_back = {}
@@ -32,8 +84,8 @@ class Client:
         signal.signal(signal.SIGINT, self.__shutdown)
         signal.signal(signal.SIGTERM, self.__shutdown)
 
-    def __log(self, msg):
-        print(f"[CLIENT] {msg}")
+    def __log(self, msg, level=INFO, category=None, **fields):
+        self.logger.log(level, msg, category, **fields)
 
     def __shutdown(self, *_):
         self.__log("Shutting down...")
@@ -43,42 +95,135 @@ class Client:
         # Send request to server multicast group
         self.sock.sendto("WHO_IS_LEADER".encode(), (MCAST_GRP, MCAST_PORT))
 
-    def __send(self, msg):
+    def __send(self, msg, server=None):
         if self.leader is None:
-            self.__log("Error: No leader")
-
-        # Send request to leader server
-        ip, port = self.leader.split(":")
-        self.sock.sendto(json.dumps(msg).encode(), (ip, int(port)))
+            self.__log("No leader", ERROR)
+
+        # Polls go to the server owning the group, reads to any server
+        # and the rest to the leader, unless a redirect named the server
+        if server is None:
+            server = self.leader
+            if msg["type"] in PARTITIONED_TYPES and len(self.ring):
+                server = self.ring.owner(msg["group"])
+            elif msg["type"] in READ_TYPES and len(self.ring):
+                server = random.choice(self.ring.nodes)
+                msg["min_version"] = self.version
+
+        self.last_sent[msg["type"]] = msg
+        ip, port = server.split(":")
+        self.sock.sendto(codec.encode(msg, self.codec), (ip, int(port)))
 
     def __recv(self):
-        data, _ = self.sock.recvfrom(BUF)
-        return json.loads(data.decode())
+        while True:
+            data, _ = self.sock.recvfrom(BUF)
+            if not self.__leader_reply(data):
+                return codec.decode(data)
+
+    def __leader_reply(self, data):
+        """
+        Takes in a datagram if it is an answer to WHO_IS_LEADER. Every
+        server that knows the leader answers, so they keep coming after
+        the first.
+        """
+        if not data.startswith(b"LEADER:"):
+            return False
+        leader, ring, epoch = parse_leader_reply(data.decode(errors="replace"))
+        self.__learn_leader(leader, ring, epoch)
+        return True
+
+    def __learn_leader(self, leader, ring, epoch, trusted=False):
+        """
+        Follows leader unless one of a later election is known already,
+        or always when trusted. Returns False for an outdated leader.
+        """
+        if epoch < self.epoch and not trusted:
+            self.__log(f"Ignoring outdated leader {leader} (epoch {epoch} < {self.epoch})", DEBUG)
+            return False
+
+        changed = (leader, ring.nodes) != (self.leader, self.ring.nodes)
+        self.leader = leader
+        self.epoch = epoch
+        self.ring = ring
+        if changed:
+            self.__save_leader()
+        return True
+
+    def __load_leader(self):
+        try:
+            with open(LEADER_CACHE) as f:
+                cached = json.load(f)
+            self.leader = cached["leader"]
+            self.ring = HashRing(cached["ring"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def __save_leader(self):
+        cached = {"leader": self.leader, "ring": self.ring.nodes}
+        tmp = f"{LEADER_CACHE}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(LEADER_CACHE), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(cached, f)
+            # Other clients on this host may read it at the same time
+            os.replace(tmp, LEADER_CACHE)
+        except OSError as e:
+            self.__log(f"Could not cache the leader: {e}", ERROR)
 
     def discover_leader(self):
+        """
+        Starts with the leader cached by the last run if there is one. The
+        first request checks it: a server that does not lead anymore
+        redirects to the one that does, if none answers the leader is
+        asked for by multicast.
+        """
+        if self.__load_leader():
+            self.__log(f"Last known leader is {self.leader}")
+            return
+        self.__find_leader()
+
+    def __find_leader(self):
         self.__log("Requesting leader via multicast...")
+        # The cluster may have been restarted and counts epochs anew
+        self.leader = None
+        self.epoch = 0
 
-        # Request leader
+        interval = DISCOVERY_INTERVAL
         self.__send_leader_request()
-
-        # Wait for reply
+        deadline = time.time() + interval
         while self.leader is None:
             try:
+                self.sock.settimeout(max(deadline - time.time(), 0.01))
                 data, _ = self.sock.recvfrom(BUF)
-                msg = data.decode()
-                if msg.startswith("LEADER:"):
-                    _, sid = msg.split(":", 1)
-                    self.leader = sid
+                self.__leader_reply(data)
             except socket.timeout:
+                # Nobody knows a leader yet, likely an election
+                interval = min(interval * 2, DISCOVERY_MAX_INTERVAL)
+                deadline = time.time() + interval * random.uniform(0.5, 1.0)
                 self.__send_leader_request()
-                continue
+        self.sock.settimeout(SOCKET_TIMEOUT)
 
-        self.__log(f"Leader is {self.leader}")
+        self.__log(f"Leader is {self.leader} (epoch {self.epoch})")
+
+    def __redirected(self, msg):
+        # The server taken for the leader knows best that it is not, also
+        # when the cluster restarted and counts epochs anew
+        trusted = msg.get("id") == self.leader
+        if not self.__learn_leader(msg["leader"], self.ring, msg["epoch"], trusted):
+            return
+        self.__log(f"Redirected to leader {self.leader}" + (f", owner {msg['owner']}" if "owner" in msg else ""))
+
+        # Sent again only once, two servers that disagree on the ring
+        # must not bounce it between them
+        resent = self.last_sent.pop(msg.get("for"), None)
+        if resent is not None:
+            self.__send(resent, msg.get("owner"))
 
     def __send_register_request(self):
         self.__send({
             "type": "REGISTER",
-            "id": self.id
+            "id": self.id,
+            "codecs": codec.SUPPORTED
         })
 
     def __create_group(self, name):
@@ -99,24 +244,77 @@ class Client:
         while self.token is None:
             try:
                 reply = self.__recv()
+                if reply.get("type") == "REDIRECT":
+                    self.__redirected(reply)
+                    continue
                 token = reply.get("token")
                 if token is None:
-                    self.__log(f"Error: Expected 'token': {reply}")
+                    self.__log("Expected 'token'", ERROR, reply=reply)
                     continue
 
                 self.token = token
-                self.__log("Registered successfully")
+                self.codec = reply.get("codec", codec.JSON)
+                self.__log(f"Registered successfully (codec: {self.codec})")
                         
             except socket.timeout:
+                # The leader may be gone, or the cached one outdated
+                self.__find_leader()
                 self.__send_register_request()
                 continue
 
-    def __get_groups(self):
-        self.__send({
+    def __get_groups(self, prefix="", contains="", cursor=None):
+        msg = {
             "type": "GET_GROUPS",
             "id": self.id,
             "token": self.token
-        })
+        }
+        if prefix:
+            msg["prefix"] = prefix
+        if contains:
+            msg["contains"] = contains
+
+        if cursor is not None:
+            msg["cursor"] = cursor
+        else:
+            self.listing = (prefix, contains)
+            self.pages = []
+            self.pages_catalogue = None
+            if not prefix and not contains and self.catalogue is not None:
+                # Only what changed since the last full listing
+                msg["since"] = self.catalogue
+        self.__send(msg)
+
+    def __groups(self, msg):
+        self.__learn_leader(self.leader, HashRing(msg.get("ring", self.ring.nodes)), self.epoch)
+        prefix, contains = self.listing
+        full = not prefix and not contains
+
+        if msg.get("not_modified"):
+            self.__log(f"Groups (unchanged): {sorted(self.known_groups)}")
+            return
+        if "added" in msg:
+            self.known_groups.update(msg["added"])
+            self.catalogue = msg["catalogue"]
+            self.__log(f"Groups (+{len(msg['added'])}): {sorted(self.known_groups)}")
+            return
+
+        # Pages may come from different servers, the oldest catalogue
+        # version is the one every page is at least as new as
+        self.pages.extend(msg["groups"])
+        version = msg["catalogue"]
+        self.pages_catalogue = version if self.pages_catalogue is None else min(self.pages_catalogue, version)
+        if msg.get("cursor") is not None:
+            self.__get_groups(prefix, contains, msg["cursor"])
+            return
+
+        if full:
+            if self.subscribed:
+                # Pushed while the pages were fetched, maybe after them
+                self.known_groups.update(self.pages)
+            else:
+                self.known_groups = set(self.pages)
+            self.catalogue = self.pages_catalogue
+        self.__log(f"Groups: {self.pages}")
 
     def __join_group(self, name):
         self.__send({
@@ -141,13 +339,61 @@ class Client:
             "token": self.token
         })
 
-    def __start_vote(self, name, topic, options, timeout):
+    def __subscribe(self, subscribe):
+        self.__send({
+            "type": "SUBSCRIBE" if subscribe else "UNSUBSCRIBE",
+            "id": self.id,
+            "token": self.token
+        })
+
+    def __subscribed(self, msg):
+        self.subscribed = True
+        self.feed_seq = msg["seq"]
+        self.__log("Subscribed to group changes")
+        # Everything up to seq comes from a listing, the rest is pushed
+        self.__get_groups()
+
+    def __feed(self, msg):
+        if not self.subscribed:
+            return
+
+        if msg.get("resync"):
+            self.__log("Group changes were lost, listing all groups again")
+            self.feed_seq = msg["seq"]
+            self.catalogue = None
+            self.__get_groups()
+            return
+
+        if msg["prev"] > self.feed_seq:
+            # Missed a push, ask again unless that is under way
+            if time.time() - self.feed_fetched_at > FEED_FETCH_INTERVAL:
+                self.feed_fetched_at = time.time()
+                self.__send({"type": "FEED_FETCH", "id": self.id, "token": self.token, "since": self.feed_seq})
+            return
+        if msg["seq"] <= self.feed_seq:
+            return
+
+        self.feed_seq = msg["seq"]
+        self.feed_fetched_at = 0
+        self.known_groups.update(msg["added"])
+        self.member_counts.update(msg["members"])
+        if "catalogue" in msg and self.catalogue is not None:
+            self.catalogue = msg["catalogue"]
+
+        for group in msg["added"]:
+            self.__log(f"New group: {group}")
+        for group, count in msg["members"].items():
+            if group not in msg["added"]:
+                self.__log(f"Group {group} has {count} members", DEBUG)
+
+    def __start_vote(self, name, topic, options, timeout, close):
         self.__send({
             "type": "START_VOTE",
             "group": name,
             "topic": topic,
             "options": options,
             "timeout": timeout,
+            "close": close,
             "id": self.id,
             "token": self.token
         })
@@ -170,9 +416,7 @@ class Client:
             self.__log(f"New vote available for {g}: {msg.get('topic')} (Vote ID: {vote_id}, S={S})")
 
     def __send_vote_ack(self, g, vote_id, vote, S):
-        # TODO: Send to leader?
-        ip, port = self.leader.split(":")
-        msg = {
+        self.__send({
             "type": "VOTE_ACK",
             "group": g,
             "vote_id": vote_id,
@@ -180,9 +424,8 @@ class Client:
             "id": self.id,
             "vote": vote,
             "token": self.token
-        }
-        self.sock.sendto(json.dumps(msg).encode(), (ip, int(port)))
-        self.__log(f"Sent VOTE_ACK for vote {vote_id} to leader")
+        })
+        self.__log(f"Sent VOTE_ACK for vote {vote_id}")
 
     def __vote(self, msg):
         g = msg["group"]
@@ -215,40 +458,59 @@ class Client:
     def __vote_result(self, msg):
         vote_id = msg.get("vote_id")
         if vote_id in self.pending_votes:
-            self.__log(f"Vote finished: {vote_id}, result: {msg.get('winner')}")
+            self.__log(f"Vote finished: {vote_id}, result: {msg.get('winner')} (closed: {msg.get('reason')})")
             del self.pending_votes[vote_id]
         else:
-            self.__log(f"Error: Received result for unknown vote_id: {vote_id}")
+            self.__log(f"Received result for unknown vote_id: {vote_id}", ERROR)
 
     def __handle_message(self, msg, addr):
         t = msg.get("type")
+        self.version = max(self.version, msg.get("version", 0))
         
         if t == "VOTE":
             self.__vote(msg)
         elif t == "VOTE_RESULT":
             self.__vote_result(msg)
         elif t == "NEW_LEADER":
-            self.leader = msg["id"]
-            self.__log(f"Got a new leader: {self.leader}")
+            if self.__learn_leader(msg["id"], HashRing(msg.get("ring", [])), msg.get("epoch", 0)):
+                self.__log(f"Got a new leader: {self.leader} (epoch {self.epoch})")
+        elif t == "REDIRECT":
+            self.__redirected(msg)
+        elif t == "GET_GROUPS_OK":
+            self.__groups(msg)
+        elif t == "SUBSCRIBE_OK":
+            self.__subscribed(msg)
+        elif t == "UNSUBSCRIBE_OK":
+            self.subscribed = False
+            self.__log("Unsubscribed from group changes")
+        elif t == "FEED":
+            self.__feed(msg)
+        elif t == "ERROR" and msg.get("error") == "TOKEN_EXPIRED":
+            self.__log("Session expired, registering again")
+            self.__send_register_request()
+        elif t == "REGISTER_OK":
+            self.token = msg["token"]
+            self.codec = msg.get("codec", codec.JSON)
+            self.__log("Registered again")
         else:
-            self.__log(f"Got message: {msg}")
+            self.__log("Got message", message=msg)
 
     def __message_handling(self):
         while not self.stop_event.is_set():
             try:
                 data, addr = self.sock.recvfrom(BUF)
-                if data:
+                if data and not self.__leader_reply(data):
                     try:
-                        msg = json.loads(data.decode())
+                        msg = codec.decode(data)
                         self.__handle_message(msg, addr)
                     except Exception as e:
-                        self.__log(f"Invalid message: {e}")
+                        self.__log(f"Invalid message: {e}", ERROR)
             except socket.timeout:
                 continue
 
     def run(self):
         if self.leader is None:
-            self.__log("Error: No leader")
+            self.__log("No leader", ERROR)
 
         message_thread = threading.Thread(target=self.__message_handling)
         message_thread.start()
@@ -264,12 +526,18 @@ class Client:
             print("6) Leave group")
             print("7) Start vote")
             print("8) Vote")
-            print("9) Exit")
+            print(f"9) {'Unsubscribe from' if self.subscribed else 'Subscribe to'} group changes")
+            print("10) Exit")
             choice = int(input("Choose: "))
             if choice == 1:
-                print(f"Leader: {self.leader}")
+                print(f"Leader: {self.leader} (epoch {self.epoch})")
+                print(f"Ring: {self.ring.nodes}")
             elif choice == 2:
-                self.__get_groups()
+                pattern = input("Filter (text, text* for a prefix, empty for all): ")
+                if pattern.endswith("*"):
+                    self.__get_groups(prefix=pattern[:-1])
+                else:
+                    self.__get_groups(contains=pattern)
             elif choice == 3:
                 self.__joined_groups()
             elif choice == 4:
@@ -289,6 +557,7 @@ class Client:
                     timeout = int(input("Timeout: "))
                 except:
                     print(f"Invalid timeout, default={timeout}")
+                close = input("Close when (all/majority/decided, default=all): ") or "all"
                 options = []
                 stop = False
                 i = 0
@@ -299,7 +568,7 @@ class Client:
                         stop = True
                     else:
                         options.append(option)
-                self.__start_vote(name, topic, options, timeout)
+                self.__start_vote(name, topic, options, timeout, close)
             elif choice == 8:
                 if not self.pending_votes:
                     print("No pending votes")
@@ -333,12 +602,15 @@ class Client:
                     )
 
             elif choice == 9:
+                self.__subscribe(not self.subscribed)
+            elif choice == 10:
                 self.stop_event.set()
             else:
                 print("Invalid choice")
 
         # Clean exit
         message_thread.join()
+        self.logger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,329 @@
+import json
+import socket
+import struct
+import sys
+import uuid
+import zlib
+
+
+JSON = "json"
+BINARY = "bin1"
+
+# Preference order when negotiating at REGISTER
+SUPPORTED = [BINARY, JSON]
+
+# Bodies larger than this are zlib compressed if that makes them smaller
+COMPRESS_THRESHOLD = 512
+
+# Wire tables. Only ever append to them, the index is the wire value.
+MESSAGE_TYPES = [
+    None,
+    "HS_ELECTION", "HS_REPLY", "HS_LEADER",
+    "REGISTER", "REGISTER_OK",
+    "CREATE_GROUP", "CREATE_GROUP_OK",
+    "GET_GROUPS", "GET_GROUPS_OK",
+    "JOIN_GROUP", "JOIN_GROUP_OK",
+    "JOINED_GROUPS", "JOINED_GROUPS_OK",
+    "LEAVE_GROUP", "LEAVE_GROUP_OK",
+    "START_VOTE", "START_VOTE_OK",
+    "VOTE", "VOTE_ACK", "VOTE_RESULT",
+    "NEW_LEADER", "ERROR",
+    "REPL_REGISTER", "REPL_VOTE", "REPL_STATE",
+    "HEARTBEAT", "HEARTBEAT_ACK",
+]
+KEYS = [
+    "type", "id", "token", "group", "groups", "vote_id", "S", "sender",
+    "topic", "options", "timeout", "vote", "winner", "error", "phase",
+    "direction", "hop", "addr", "votes", "owner", "members", "codec", "codecs",
+    "close", "reason",
+]
+TYPE_CODES = {t: i for i, t in enumerate(MESSAGE_TYPES) if t is not None}
+KEY_CODES = {k: i for i, k in enumerate(KEYS)}
+
+MAGIC = 0xB1
+LITERAL_KEY = 0xFF
+
+# Header flags
+COMPRESSED = 0x01
+ID_UUID = 0x02
+ID_ADDR = 0x04
+
+# Value tags
+T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_UUID, T_HEX, T_LIST, T_DICT = range(10)
+
+HEADER = struct.Struct("!BBB")
+ADDR = struct.Struct("!4sH")
+FLOAT = struct.Struct("!d")
+
+
+class CodecError(Exception):
+    pass
+
+
+def negotiate(offered):
+    """
+    Picks the first codec from the client's offer that is supported here.
+    """
+    for name in offered or []:
+        if name in SUPPORTED:
+            return name
+    return JSON
+
+
+def encode(msg, codec=JSON):
+    if codec == BINARY:
+        return encode_binary(msg)
+    return json.dumps(msg).encode()
+
+
+def decode(data):
+    """
+    Decodes a datagram of either codec, detected by its first byte.
+    """
+    if data[:1] == b"{":
+        return json.loads(data.decode())
+    if data[0] == MAGIC:
+        return decode_binary(data)
+    raise CodecError(f"Unknown codec byte: {data[0]:#x}")
+
+
+def _pack_id(sid):
+    """
+    Sender IDs travel as integers: client UUIDs as 128 bit,
+    server 'ip:port' IDs as 32 bit address and 16 bit port.
+    """
+    if not isinstance(sid, str):
+        return 0, None
+
+    if len(sid) == 36:
+        try:
+            u = uuid.UUID(sid)
+            if str(u) == sid:
+                return ID_UUID, u.bytes
+        except ValueError:
+            pass
+
+    ip, _, port = sid.rpartition(":")
+    if ip and port.isdigit() and int(port) < 65536 and str(int(port)) == port:
+        try:
+            packed = socket.inet_aton(ip)
+            if socket.inet_ntoa(packed) == ip:
+                return ID_ADDR, ADDR.pack(packed, int(port))
+        except OSError:
+            pass
+
+    return 0, None
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write_str(out, s):
+    b = s.encode()
+    _write_varint(out, len(b))
+    out += b
+
+
+def _write_value(out, v):
+    if v is None:
+        out.append(T_NONE)
+    elif v is True:
+        out.append(T_TRUE)
+    elif v is False:
+        out.append(T_FALSE)
+    elif isinstance(v, int):
+        out.append(T_INT)
+        # Zigzag so that small negative numbers stay small
+        _write_varint(out, (v << 1) if v >= 0 else ((-v << 1) - 1))
+    elif isinstance(v, float):
+        out.append(T_FLOAT)
+        out += FLOAT.pack(v)
+    elif isinstance(v, str):
+        _write_string_value(out, v)
+    elif isinstance(v, (list, tuple)):
+        out.append(T_LIST)
+        _write_varint(out, len(v))
+        for item in v:
+            _write_value(out, item)
+    elif isinstance(v, dict):
+        out.append(T_DICT)
+        _write_varint(out, len(v))
+        _write_fields(out, v.items())
+    else:
+        raise CodecError(f"Can not encode {type(v).__name__}")
+
+
+def _write_string_value(out, s):
+    n = len(s)
+
+    # UUIDs (client and vote IDs) as 16 raw bytes
+    if n == 36 and s[8] == "-":
+        try:
+            u = uuid.UUID(s)
+            if str(u) == s:
+                out.append(T_UUID)
+                out += u.bytes
+                return
+        except ValueError:
+            pass
+
+    # Hex strings (tokens) as raw bytes, only if that round trips exactly
+    if n >= 16 and n % 2 == 0:
+        try:
+            b = bytes.fromhex(s)
+            if b.hex() == s:
+                out.append(T_HEX)
+                _write_varint(out, len(b))
+                out += b
+                return
+        except ValueError:
+            pass
+
+    out.append(T_STR)
+    _write_str(out, s)
+
+
+def _write_fields(out, items):
+    for k, v in items:
+        code = KEY_CODES.get(k)
+        if code is None:
+            out.append(LITERAL_KEY)
+            _write_str(out, str(k))
+        else:
+            out.append(code)
+        _write_value(out, v)
+
+
+def encode_binary(msg):
+    flags = 0
+    type_code = TYPE_CODES.get(msg.get("type"), 0)
+
+    id_flag, id_bytes = _pack_id(msg.get("id"))
+    flags |= id_flag
+
+    fields = [
+        (k, v) for k, v in msg.items()
+        if not (k == "type" and type_code) and not (k == "id" and id_flag)
+    ]
+    body = bytearray()
+    _write_varint(body, len(fields))
+    _write_fields(body, fields)
+
+    if len(body) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(bytes(body), 1)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= COMPRESSED
+
+    out = bytearray(HEADER.pack(MAGIC, flags, type_code))
+    if id_bytes:
+        out += id_bytes
+    out += body
+    return bytes(out)
+
+
+class _Reader:
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def take(self, n):
+        end = self.pos + n
+        if end > len(self.data):
+            raise CodecError("Truncated datagram")
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def byte(self):
+        return self.take(1)[0]
+
+    def varint(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return n
+            shift += 7
+
+    def str(self):
+        return bytes(self.take(self.varint())).decode()
+
+    def value(self):
+        tag = self.byte()
+        if tag == T_NONE:
+            return None
+        if tag == T_TRUE:
+            return True
+        if tag == T_FALSE:
+            return False
+        if tag == T_INT:
+            z = self.varint()
+            return (z >> 1) if not z & 1 else -((z + 1) >> 1)
+        if tag == T_FLOAT:
+            return FLOAT.unpack(self.take(8))[0]
+        if tag == T_STR:
+            return self.str()
+        if tag == T_UUID:
+            return str(uuid.UUID(bytes=bytes(self.take(16))))
+        if tag == T_HEX:
+            return bytes(self.take(self.varint())).hex()
+        if tag == T_LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == T_DICT:
+            return self.fields({}, self.varint())
+        raise CodecError(f"Unknown value tag: {tag}")
+
+    def fields(self, msg, count):
+        for _ in range(count):
+            code = self.byte()
+            if code == LITERAL_KEY:
+                key = sys.intern(self.str())
+            elif code < len(KEYS):
+                key = KEYS[code]
+            else:
+                raise CodecError(f"Unknown key code: {code}")
+
+            value = self.value()
+            # Group names repeat in nearly every message
+            if key == "group" and type(value) is str:
+                value = sys.intern(value)
+            msg[key] = value
+        return msg
+
+
+def decode_binary(data):
+    if len(data) < HEADER.size:
+        raise CodecError("Truncated header")
+
+    magic, flags, type_code = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise CodecError("Bad magic")
+
+    msg = {}
+    if type_code:
+        if type_code >= len(MESSAGE_TYPES):
+            raise CodecError(f"Unknown type code: {type_code}")
+        msg["type"] = MESSAGE_TYPES[type_code]
+
+    pos = HEADER.size
+    if flags & ID_UUID:
+        msg["id"] = str(uuid.UUID(bytes=bytes(data[pos:pos + 16])))
+        pos += 16
+    elif flags & ID_ADDR:
+        packed, port = ADDR.unpack_from(data, pos)
+        msg["id"] = f"{socket.inet_ntoa(packed)}:{port}"
+        pos += ADDR.size
+
+    body = data[pos:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+
+    reader = _Reader(memoryview(body), 0)
+    return reader.fields(msg, reader.varint())
@@ -0,0 +1,145 @@
+import time
+from operator import itemgetter
+
+from logger import DEBUG, ERROR
+
+
+def compile_schema(required):
+    """
+    Builds a validator for a fixed tuple of required keys.
+    The validator returns the first missing (or None) key, or None if
+    the message is complete.
+    """
+    if not required:
+        return lambda msg: None
+
+    getter = itemgetter(*required)
+    single = len(required) == 1
+
+    def validate(msg):
+        try:
+            values = getter(msg)
+        except KeyError as e:
+            return e.args[0]
+
+        if single:
+            return required[0] if values is None else None
+
+        if None in values:
+            return required[values.index(None)]
+        return None
+
+    return validate
+
+
+class Handler:
+    """
+    A message type handler together with its declared requirements
+    and call statistics.
+    """
+    def __init__(self, fn, required=(), requires_auth=False, log=True, mutates=False, peer_only=False):
+        self.fn = fn
+        self.required = tuple(required)
+        self.validate = compile_schema(self.required)
+        self.requires_auth = requires_auth
+        self.log = log
+        self.mutates = mutates
+        self.peer_only = peer_only
+
+        # Statistics
+        self.calls = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "total_ms": self.total_time * 1000,
+            "avg_us": (self.total_time / self.calls * 1e6) if self.calls else 0.0,
+            "max_ms": self.max_time * 1000
+        }
+
+
+class Dispatcher:
+    """
+    Maps message types to handlers.
+
+    authenticate(msg) decides whether a message carries valid credentials,
+    auth_failed(addr, msg) is called for rejected messages and
+    log(text, level, category, **fields) is used for diagnostics. With metrics, every message is counted per type and
+    handler times go into a histogram per type. is_peer(msg, addr) decides
+    whether a message comes from a server of the cluster.
+    """
+    def __init__(self, authenticate, auth_failed, log, metrics=None, is_peer=None):
+        self.handlers = {}
+        self.authenticate = authenticate
+        self.auth_failed = auth_failed
+        self.log = log
+        self.metrics = metrics
+        self.is_peer = is_peer
+        self.unknown = 0
+
+    def register(self, msg_type, fn, required=(), requires_auth=False, log=True, mutates=False, peer_only=False):
+        self.handlers[msg_type] = Handler(fn, required, requires_auth, log, mutates, peer_only)
+
+    def dispatch(self, msg, addr):
+        """
+        Validates and runs the handler for msg.
+        Returns the handler, or None if the type is unknown.
+        """
+        msg_type = msg.get("type")
+        handler = self.handlers.get(msg_type)
+        if handler is None:
+            self.unknown += 1
+            if self.metrics is not None:
+                self.metrics.count("error.UNKNOWN_TYPE")
+            self.log("Got invalid message", ERROR, "msg", message=msg)
+            return None
+
+        if self.metrics is not None:
+            self.metrics.count(f"msg.{msg_type}")
+
+        if handler.log:
+            self.log(f"Got: {msg_type}", DEBUG, "msg")
+
+        if handler.requires_auth and not self.authenticate(msg):
+            handler.rejected += 1
+            self.auth_failed(addr, msg)
+            return handler
+
+        missing = handler.validate(msg)
+        if missing is not None:
+            handler.rejected += 1
+            if self.metrics is not None:
+                self.metrics.count("error.MISSING_KEY")
+            self.log(f"Expected key '{missing}'", ERROR, "msg", message=msg)
+            return handler
+
+        if handler.peer_only and not self.is_peer(msg, addr):
+            # Not answered, strangers learn nothing about the cluster
+            handler.rejected += 1
+            if self.metrics is not None:
+                self.metrics.count("error.NOT_A_PEER")
+            self.log(f"{msg_type} from a stranger", ERROR, "msg", addr=addr)
+            return handler
+
+        start = time.perf_counter()
+        try:
+            handler.fn(msg, addr)
+        finally:
+            elapsed = time.perf_counter() - start
+            handler.calls += 1
+            handler.total_time += elapsed
+            if elapsed > handler.max_time:
+                handler.max_time = elapsed
+            if self.metrics is not None:
+                self.metrics.record(f"handler.{msg_type}", elapsed)
+
+        return handler
+
+    def stats(self):
+        stats = {t: h.stats() for t, h in self.handlers.items() if h.calls or h.rejected}
+        stats["unknown"] = self.unknown
+        return stats
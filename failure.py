@@ -0,0 +1,80 @@
+import math
+import threading
+from collections import deque
+
+
+# Seconds between heartbeats to the left neighbour
+HEARTBEAT_INTERVAL = 0.5
+
+# Phi at which the neighbour is suspected and at which it is declared
+# crashed. Phi 8 means the heartbeat is that late once in 10^8 times
+# given the intervals seen so far.
+PHI_SUSPECT = 3.0
+PHI_CRASH = 8.0
+
+# Heartbeat intervals the estimate is based on
+WINDOW = 100
+
+# Floor of the standard deviation, so that a very regular link does not
+# turn the first slightly late heartbeat into a crash
+MIN_STD = 0.1
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector for one peer.
+
+    Instead of a fixed timeout it keeps the recent intervals between
+    heartbeat acks and computes phi, the -log10 of the probability that
+    an ack is still to come after the time waited so far, assuming the
+    intervals are normally distributed. On a steady link phi climbs fast
+    after the expected interval, on a jittery one it climbs slowly, so the
+    same threshold adapts to both.
+    """
+    def __init__(self, interval=HEARTBEAT_INTERVAL, window=WINDOW, min_std=MIN_STD):
+        self.interval = interval
+        self.min_std = min_std
+        self.intervals = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.peer = None
+        self.last = None
+
+    def reset(self, peer, now):
+        """
+        Starts watching peer, as if an ack had arrived at now.
+        """
+        with self.lock:
+            self.peer = peer
+            self.last = now
+            self.intervals.clear()
+            # Until acks arrive, expect them every interval
+            self.intervals.append(self.interval)
+
+    def heartbeat(self, now):
+        with self.lock:
+            if self.last is not None:
+                self.intervals.append(now - self.last)
+            self.last = now
+
+    def phi(self, now):
+        with self.lock:
+            if self.last is None:
+                return 0.0
+            n = len(self.intervals)
+            mean = sum(self.intervals) / n
+            variance = sum((x - mean) ** 2 for x in self.intervals) / n
+            elapsed = now - self.last
+
+        std = max(math.sqrt(variance), self.min_std)
+        # Tail of the normal distribution, erfc does not overflow however
+        # far the wait is from the mean
+        y = (elapsed - mean) / std
+        p = 0.5 * math.erfc(y / math.sqrt(2))
+        return max(0.0, -math.log10(max(p, 1e-300)))
+
+    def silence(self, now):
+        """
+        Seconds since the last ack.
+        """
+        with self.lock:
+            return None if self.last is None else now - self.last
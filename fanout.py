@@ -0,0 +1,165 @@
+import ctypes
+import socket
+import sys
+import threading
+
+
+# Datagrams handed to the kernel per sendmmsg call
+BATCH_SIZE = 64
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_ubyte * 2),
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+
+def _load_sendmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class FanOut:
+    """
+    Sends one already encoded payload to many addresses.
+
+    The payload is copied once into a buffer that every message header of
+    a batch points to, and batches go out with a single sendmmsg call.
+    Without sendmmsg or a socket (or for addresses it can not take) every
+    address falls back to sendto(data, addr).
+    """
+    def __init__(self, sock, sendto):
+        self.sock = sock
+        self.sendto = sendto
+        self.lock = threading.Lock()
+
+        # Packed sockaddr_in per address
+        self.names_cache = {}
+
+        # Message headers are built once and reused for every batch
+        self.iov = iovec()
+        self.names = (sockaddr_in * BATCH_SIZE)()
+        self.msgs = (mmsghdr * BATCH_SIZE)()
+        for i in range(BATCH_SIZE):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self.iov)
+            hdr.msg_iovlen = 1
+
+        # Statistics
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0
+
+    def __sockaddr(self, addr):
+        name = self.names_cache.get(addr)
+        if name is None:
+            ip, port = addr
+            packed = socket.inet_aton(ip)
+            name = sockaddr_in(socket.AF_INET, (ctypes.c_ubyte * 2)(*port.to_bytes(2, "big")), (ctypes.c_ubyte * 4)(*packed))
+            self.names_cache[addr] = name
+        return name
+
+    def __send_each(self, data, addrs):
+        sent = 0
+        failed = 0
+        for addr in addrs:
+            try:
+                self.sendto(data, addr)
+                sent += 1
+            except OSError:
+                failed += 1
+        return sent, failed
+
+    def __send_batch(self, addrs):
+        """
+        Returns how many of addrs the kernel accepted.
+        """
+        for i, addr in enumerate(addrs):
+            self.names[i] = self.__sockaddr(addr)
+
+        n = _sendmmsg(self.sock.fileno(), self.msgs, len(addrs), 0)
+        self.batches += 1
+        return max(n, 0)
+
+    def send(self, data, addrs):
+        """
+        Sends data to every address, returns (sent, failed).
+        """
+        addrs = list(addrs)
+        if _sendmmsg is None or self.sock is None or self.sock.fileno() < 0:
+            sent, failed = self.__send_each(data, addrs)
+        else:
+            sent = 0
+            failed = 0
+            with self.lock:
+                buf = ctypes.create_string_buffer(data, len(data))
+                self.iov.iov_base = ctypes.addressof(buf)
+                self.iov.iov_len = len(data)
+
+                batch = []
+                rest = []
+                for addr in addrs:
+                    try:
+                        self.__sockaddr(addr)
+                        batch.append(addr)
+                    except (OSError, TypeError, ValueError):
+                        rest.append(addr)
+
+                for i in range(0, len(batch), BATCH_SIZE):
+                    chunk = batch[i:i + BATCH_SIZE]
+                    n = self.__send_batch(chunk)
+                    sent += n
+                    # Whatever the kernel did not take goes one by one
+                    rest.extend(chunk[n:])
+
+            s, f = self.__send_each(data, rest)
+            sent += s
+            failed += f
+
+        self.sent += sent
+        self.failed += failed
+        return sent, failed
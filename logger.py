@@ -0,0 +1,160 @@
+import json
+import queue
+import sys
+import threading
+import time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+# Records waiting for the writer thread, newer ones are dropped beyond that
+QUEUE_SIZE = 10000
+
+# Field values that never reach the output
+REDACTED_KEYS = {"token"}
+REDACTED = "***"
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if k in REDACTED_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+class Logger:
+    """
+    Leveled, structured logging that never blocks the caller.
+
+    log() only filters and enqueues the record; formatting and writing
+    happen on a background thread. When the queue is full the record is
+    dropped and counted. Per category, records can be sampled (keep one in
+    every n) and rate limited (token bucket), both decided before anything
+    is enqueued.
+    """
+    def __init__(self, name, level=INFO, json_output=False, stream=None, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.level = level
+        self.json_output = json_output
+        self.stream = stream or sys.stdout
+
+        self.sampling = {}
+        self.sampled = {}
+        self.limits = {}
+        self.buckets = {}
+
+        # Statistics
+        self.dropped = 0
+        self.suppressed = 0
+
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.__writer, daemon=True)
+        self.thread.start()
+
+    def sample(self, category, every):
+        """
+        Keeps only every n-th record of a category.
+        """
+        self.sampling[category] = every
+        self.sampled[category] = 0
+
+    def limit(self, category, per_second, burst=None):
+        """
+        Keeps at most per_second records of a category, with bursts of burst.
+        """
+        burst = burst or per_second
+        self.limits[category] = (per_second, burst)
+        self.buckets[category] = [burst, time.monotonic()]
+
+    def __admit(self, category):
+        every = self.sampling.get(category)
+        if every is not None:
+            n = self.sampled[category]
+            self.sampled[category] = n + 1
+            if n % every:
+                return False
+
+        limit = self.limits.get(category)
+        if limit is not None:
+            per_second, burst = limit
+            bucket = self.buckets[category]
+            now = time.monotonic()
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * per_second)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+        return True
+
+    def log(self, level, text, category=None, **fields):
+        if level < self.level:
+            return
+        if category is not None and not self.__admit(category):
+            self.suppressed += 1
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), level, category, text, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, text, category=None, **fields):
+        self.log(DEBUG, text, category, **fields)
+
+    def info(self, text, category=None, **fields):
+        self.log(INFO, text, category, **fields)
+
+    def warning(self, text, category=None, **fields):
+        self.log(WARNING, text, category, **fields)
+
+    def error(self, text, category=None, **fields):
+        self.log(ERROR, text, category, **fields)
+
+    def __format(self, record):
+        ts, level, category, text, fields = record
+        fields = redact(fields)
+
+        if self.json_output:
+            out = dict(fields)
+            out.update(ts=ts, level=LEVEL_NAMES.get(level, level), logger=self.name, msg=text)
+            if category is not None:
+                out["category"] = category
+            return json.dumps(out, default=str)
+
+        line = f"[{self.name}] "
+        if level >= WARNING:
+            line += f"{LEVEL_NAMES[level].capitalize()}: "
+        line += text
+        for key, value in fields.items():
+            line += f" {key}={value}"
+        return line
+
+    def __writer(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.stream.write(self.__format(record) + "\n")
+                # Flush once the burst is written
+                if self.queue.empty():
+                    self.stream.flush()
+            except Exception:
+                self.dropped += 1
+        self.stream.flush()
+
+    def close(self, timeout=1.0):
+        """
+        Writes what is queued and stops the writer thread.
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
@@ -0,0 +1,60 @@
+class Membership:
+    """
+    Group membership indexed in both directions.
+
+    Both sides are sets, so membership tests are O(1) and the groups of a
+    client are found without scanning every group.
+    """
+    def __init__(self):
+        self.members = {}
+        self.joined = {}
+
+    def create(self, group):
+        self.members.setdefault(group, set())
+
+    def join(self, group, cid):
+        """
+        Returns False if cid already was a member.
+        """
+        members = self.members[group]
+        if cid in members:
+            return False
+        members.add(cid)
+        self.joined.setdefault(cid, set()).add(group)
+        return True
+
+    def leave(self, group, cid):
+        """
+        Returns False if cid was not a member.
+        """
+        members = self.members.get(group)
+        if members is None or cid not in members:
+            return False
+        members.remove(cid)
+        groups = self.joined[cid]
+        groups.discard(group)
+        if not groups:
+            del self.joined[cid]
+        return True
+
+    def is_member(self, group, cid):
+        members = self.members.get(group)
+        return members is not None and cid in members
+
+    def members_of(self, group):
+        return self.members.get(group, set())
+
+    def groups_of(self, cid):
+        return self.joined.get(cid, set())
+
+    def to_dict(self):
+        return {group: list(members) for group, members in self.members.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        membership = cls()
+        for group, members in data.items():
+            membership.create(group)
+            for cid in members:
+                membership.join(group, cid)
+        return membership
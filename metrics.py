@@ -0,0 +1,172 @@
+import json
+import math
+import socket
+import threading
+from collections import defaultdict
+
+import click
+
+
+# Linear sub-buckets per power of two, values are kept within 1/64
+SUB_BUCKET_BITS = 7
+
+PROC_NET_UDP = "/proc/net/udp"
+
+
+class Histogram:
+    """
+    Log-linear histogram in the style of HdrHistogram.
+
+    Values below 2^SUB_BUCKET_BITS are counted exactly. Larger values are
+    bucketed by power of two, each split into linear sub-buckets, so the
+    relative error stays bounded while buckets are only allocated for
+    ranges that actually occur.
+    """
+    def __init__(self, sub_bits=SUB_BUCKET_BITS):
+        self.sub_count = 1 << sub_bits
+        self.half = self.sub_count // 2
+        self.sub_bits = sub_bits
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return shift * self.half + (value >> shift)
+
+    def __value(self, index):
+        """
+        Middle of the range of values counted in a bucket.
+        """
+        if index < self.sub_count:
+            return index
+        shift = (index - self.sub_count) // self.half + 1
+        sub = index - shift * self.half
+        return (sub << shift) + (1 << (shift - 1))
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.counts[self.__index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = max(math.ceil(p / 100 * self.count), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.__value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max
+        }
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of one server.
+
+    Durations are recorded in seconds and kept in microseconds. Gauges are
+    callables evaluated when a snapshot is taken, so they cost nothing
+    until somebody looks.
+    """
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds * 1e6)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: h.summary() for name, h in self.histograms.items()}
+
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+
+        return {"counters": counters, "histograms_us": histograms, "gauges": gauges}
+
+
+def udp_drops(port):
+    """
+    Datagrams the kernel dropped for UDP sockets bound to port, None where
+    the kernel does not report it.
+    """
+    try:
+        with open(PROC_NET_UDP) as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+
+    drops = 0
+    for line in lines:
+        fields = line.split()
+        if int(fields[1].split(":")[1], 16) == port:
+            drops += int(fields[-1])
+    return drops
+
+
+@click.command()
+@click.argument("port", type=int)
+@click.option("--host", default=None, help="Server address, defaults to this host's outgoing interface.")
+def main(port, host):
+    """
+    Prints the metrics of a server running on this host.
+    """
+    if host is None:
+        from server import get_local_ip
+        host = get_local_ip()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2)
+    sock.sendto(json.dumps({"type": "STATS"}).encode(), (host, port))
+    try:
+        data, _ = sock.recvfrom(65536)
+    except socket.timeout:
+        raise click.ClickException(f"No reply from {host}:{port}")
+    finally:
+        sock.close()
+
+    print(json.dumps(json.loads(data)["metrics"], indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import heapq
+import itertools
+import random
+import sys
+import traceback
+
+from config import MCAST_GRP, MCAST_PORT
+
+
+# One-way delay of a datagram and the random spread added to it (seconds)
+LATENCY = 0.001
+JITTER = 0.0005
+
+# A reordered datagram is held back by up to this many latencies
+REORDER_DELAY = 10
+
+
+class TimerHandle:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimTransport:
+    """
+    One simulated socket.
+
+    Like the datagram transports of asyncio mode it offers sendto() and
+    close(), which is all a server needs. Datagrams sent to the multicast
+    group reach every transport opened with on_multicast, the sender's
+    own included.
+    """
+    def __init__(self, network, addr, on_datagram, on_multicast=None):
+        self.network = network
+        self.addr = addr
+        self.on_datagram = on_datagram
+        self.on_multicast = on_multicast
+
+    def sendto(self, data, addr):
+        self.network.send(self, data, addr)
+
+    def close(self):
+        self.network.close(self)
+
+
+class SimNetwork:
+    """
+    In-memory datagram network on virtual time.
+
+    Deliveries and timers are events on one heap ordered by virtual time
+    and run one after the other in the calling thread, so a whole cluster
+    runs in one process. Latency, loss and reordering are drawn from one
+    seeded generator, which makes a run reproducible. Partitions drop
+    everything between addresses on different sides.
+
+    The network also stands in for the asyncio event loop: call_later(),
+    call_soon_threadsafe() and time() are all a server uses of it.
+    """
+    def __init__(self, seed=0, latency=LATENCY, jitter=JITTER, loss=0.0, reorder=0.0):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+
+        self.now = 0.0
+        # (due, tie breaker, handle, fn, args)
+        self.events = []
+        self.counter = itertools.count()
+
+        self.transports = {}
+        self.members = []
+        self.sides = None
+
+        # Statistics
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.events_run = 0
+        self.errors = 0
+
+    def time(self):
+        return self.now
+
+    def random(self):
+        """
+        A generator of its own for one simulated server, seeded from the
+        network's.
+        """
+        return random.Random(self.rng.random())
+
+    def call_later(self, delay, fn, *args):
+        handle = TimerHandle()
+        heapq.heappush(self.events, (self.now + max(delay, 0), next(self.counter), handle, fn, args))
+        return handle
+
+    def call_soon_threadsafe(self, fn, *args):
+        return self.call_later(0, fn, *args)
+
+    def open(self, addr, on_datagram, on_multicast=None):
+        transport = SimTransport(self, addr, on_datagram, on_multicast)
+        self.transports[addr] = transport
+        if on_multicast is not None:
+            self.members.append(transport)
+        return transport
+
+    def close(self, transport):
+        if self.transports.get(transport.addr) is transport:
+            del self.transports[transport.addr]
+        if transport in self.members:
+            self.members.remove(transport)
+
+    def partition(self, *sides):
+        """
+        Splits the network into sides of addresses. Datagrams only reach
+        the sender's side, addresses on no side form one more.
+        """
+        self.sides = {addr: i for i, side in enumerate(sides) for addr in side}
+
+    def heal(self):
+        self.sides = None
+
+    def __reachable(self, src, dst):
+        if self.sides is None:
+            return True
+        return self.sides.get(src, -1) == self.sides.get(dst, -1)
+
+    def send(self, sender, data, addr):
+        self.sent += 1
+        self.bytes += len(data)
+        multicast = addr == (MCAST_GRP, MCAST_PORT)
+        if multicast:
+            targets = list(self.members)
+        else:
+            target = self.transports.get(addr)
+            targets = [target] if target is not None else []
+            if target is None:
+                self.dropped += 1
+
+        for target in targets:
+            if not self.__reachable(sender.addr, target.addr) or (self.loss and self.rng.random() < self.loss):
+                self.dropped += 1
+                continue
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            if self.reorder and self.rng.random() < self.reorder:
+                delay += self.rng.uniform(0, REORDER_DELAY * self.latency)
+            self.call_later(delay, self.__deliver, target, sender.addr, data, multicast)
+
+    def __deliver(self, target, src, data, multicast):
+        if self.transports.get(target.addr) is not target:
+            # Closed while the datagram was on its way
+            self.dropped += 1
+            return
+        self.delivered += 1
+        if multicast:
+            target.on_multicast(data, src)
+        else:
+            target.on_datagram(data, src)
+
+    def run(self, until=None):
+        """
+        Runs events in order until the virtual time until, or until none
+        are left. Like the asyncio loop it reports a failing callback and
+        goes on.
+        """
+        while self.events:
+            due, _, handle, fn, args = self.events[0]
+            if until is not None and due > until:
+                break
+            heapq.heappop(self.events)
+            if handle.cancelled:
+                continue
+            self.now = due
+            self.events_run += 1
+            try:
+                fn(*args)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc(file=sys.stderr)
+
+        if until is not None:
+            self.now = max(self.now, until)
@@ -0,0 +1,166 @@
+import threading
+from collections import deque
+
+
+# Entries kept for catching up backups, older ones need a snapshot
+LOG_RETAIN = 10000
+
+# Time the leader collects mutations before sending them as one batch
+REPL_WINDOW = 0.002
+
+# When a client gets its reply
+DURABILITY_NONE = "none"      # once the leader applied the change
+DURABILITY_ONE = "one"        # once one backup acknowledged it
+DURABILITY_QUORUM = "quorum"  # once a majority of servers hold it
+DURABILITY_MODES = [DURABILITY_NONE, DURABILITY_ONE, DURABILITY_QUORUM]
+
+
+class ReplicationLog:
+    """
+    Sequenced log of state mutations.
+
+    The leader appends every mutation under the next index. Replicas
+    insert entries received in any order and apply them strictly in index
+    order; entries after a gap are held back until the gap is filled.
+    Every server keeps the entries it applied, so any of them can serve a
+    missing range after a failover. Only the newest retain entries are
+    kept; a server that needs older ones gets a snapshot instead.
+    """
+    def __init__(self, retain=LOG_RETAIN):
+        self.retain = retain
+        self.entries = {}
+        self.first_index = 1
+        self.last_index = 0
+
+        # Out of order entries waiting for a gap to be filled
+        self.held = {}
+
+        # Leader side: highest contiguous index acknowledged per backup
+        self.acked = {}
+
+    def append(self, op):
+        self.last_index += 1
+        self.entries[self.last_index] = op
+        self.__trim()
+        return self.last_index
+
+    def __trim(self):
+        while self.last_index - self.first_index >= self.retain:
+            self.entries.pop(self.first_index, None)
+            self.first_index += 1
+
+    def reset(self, index):
+        """
+        Continues the log after a snapshot taken at index.
+        Returns held entries that became applicable.
+        """
+        self.entries = {}
+        self.first_index = index + 1
+        self.last_index = index
+
+        held = self.held
+        self.held = {}
+        ready = []
+        for i in sorted(held):
+            ready.extend(self.receive(i, held[i]))
+        return ready
+
+    def receive(self, index, op):
+        """
+        Stores an entry from another server.
+        Returns the entries that became applicable, in order.
+        """
+        if index <= self.last_index:
+            return []
+
+        self.held[index] = op
+        ready = []
+        while self.last_index + 1 in self.held:
+            self.last_index += 1
+            op = self.held.pop(self.last_index)
+            self.entries[self.last_index] = op
+            ready.append((self.last_index, op))
+        self.__trim()
+        return ready
+
+    def gap(self):
+        """
+        (first, last) index of the first missing range, or None.
+        """
+        if not self.held:
+            return None
+        return self.last_index + 1, min(self.held) - 1
+
+    def range(self, start, end=None):
+        """
+        Entries start..end (inclusive), or None if start is no longer held.
+        """
+        if end is None or end > self.last_index:
+            end = self.last_index
+        if start < self.first_index:
+            return None
+        return [(i, self.entries[i]) for i in range(start, end + 1)]
+
+    def ack(self, server_id, index):
+        # A backup reports what it holds, which may also go down after a restart
+        self.acked[server_id] = index
+
+    def durable_index(self, backups, needed):
+        """
+        Highest index held by the leader and at least needed of backups.
+        """
+        if needed <= 0:
+            return self.last_index
+        acks = sorted((self.acked.get(b, 0) for b in backups), reverse=True)
+        return acks[needed - 1]
+
+    def lag(self, server_id):
+        """
+        Entries a backup is missing, None if it never acknowledged.
+        """
+        acked = self.acked.get(server_id)
+        if acked is None:
+            return None
+        return self.last_index - acked
+
+
+class DurabilityWaiters:
+    """
+    Callbacks waiting for log indexes to become durable.
+
+    Indexes only grow, so waiters are queued in index order and released
+    from the front.
+    """
+    def __init__(self, mode=DURABILITY_NONE):
+        self.mode = mode
+        self.waiting = deque()
+        self.lock = threading.Lock()
+
+    def needed(self, backups):
+        """
+        Backup acknowledgements the mode requires with this many backups.
+        """
+        if self.mode == DURABILITY_ONE:
+            return min(1, backups)
+        if self.mode == DURABILITY_QUORUM:
+            # A majority of backups + 1 servers, the leader included
+            return (backups + 1) // 2
+        return 0
+
+    def add(self, index, fn):
+        with self.lock:
+            self.waiting.append((index, fn))
+
+    def pop_ready(self, durable):
+        ready = []
+        with self.lock:
+            while self.waiting and self.waiting[0][0] <= durable:
+                ready.append(self.waiting.popleft()[1])
+        return ready
+
+    def clear(self):
+        with self.lock:
+            self.waiting.clear()
+
+    def __len__(self):
+        return len(self.waiting)
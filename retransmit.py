@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import random
+import threading
+
+
+# Per-recipient retransmission backoff (seconds)
+INITIAL_DELAY = 0.5
+MAX_DELAY = 8.0
+JITTER = 0.2
+
+
+class RetransmitScheduler:
+    """
+    Deadline heap for FO multicast retransmissions.
+
+    Every pending (key, recipient) pair has exactly one live heap entry,
+    due at its next retransmission; it backs off exponentially with jitter
+    after every resend. Every key also has a deadline entry. Acked or
+    cancelled entries are dropped lazily when they reach the top.
+    """
+    def __init__(self, initial=INITIAL_DELAY, maximum=MAX_DELAY, jitter=JITTER, rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+
+        # (due, tie breaker, key, recipient or None for the deadline)
+        self.heap = []
+        self.counter = itertools.count()
+
+        self.deadlines = {}
+        self.recipients = {}
+        self.attempts = {}
+
+        # Statistics
+        self.retransmits = 0
+
+    def __delay(self, attempt):
+        delay = min(self.initial * (2 ** attempt), self.maximum)
+        return delay * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def __push(self, due, key, recipient):
+        heapq.heappush(self.heap, (due, next(self.counter), key, recipient))
+
+    def add(self, key, recipients, deadline, now):
+        with self.lock:
+            self.deadlines[key] = deadline
+            self.recipients[key] = set(recipients)
+            self.__push(deadline, key, None)
+
+            for r in recipients:
+                self.attempts[(key, r)] = 0
+                due = now + self.__delay(0)
+                if due < deadline:
+                    self.__push(due, key, r)
+
+    def ack(self, key, recipient):
+        with self.lock:
+            self.attempts.pop((key, recipient), None)
+            pending = self.recipients.get(key)
+            if pending is not None:
+                pending.discard(recipient)
+
+    def cancel(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+            for r in self.recipients.pop(key, ()):
+                self.attempts.pop((key, r), None)
+
+    def __is_live(self, due, key, recipient):
+        if key not in self.deadlines:
+            return False
+        if recipient is None:
+            return self.deadlines[key] == due
+        return (key, recipient) in self.attempts
+
+    def next_due(self):
+        """
+        Time of the next live event, or None if nothing is scheduled.
+        """
+        with self.lock:
+            while self.heap:
+                due, _, key, recipient = self.heap[0]
+                if self.__is_live(due, key, recipient):
+                    return due
+                heapq.heappop(self.heap)
+            return None
+
+    def pop_due(self, now):
+        """
+        Pops all events due at now.
+        Returns ({key: [recipients to resend to]}, [keys whose deadline passed]).
+        """
+        resend = {}
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, _, key, recipient = heapq.heappop(self.heap)
+                if not self.__is_live(due, key, recipient):
+                    continue
+
+                if recipient is None:
+                    expired.append(key)
+                    continue
+
+                attempt = self.attempts[(key, recipient)] + 1
+                self.attempts[(key, recipient)] = attempt
+                resend.setdefault(key, []).append(recipient)
+                self.retransmits += 1
+
+                next_due = now + self.__delay(attempt)
+                if next_due < self.deadlines[key]:
+                    self.__push(next_due, key, recipient)
+
+        return resend, expired
+
+    def __len__(self):
+        return len(self.deadlines)
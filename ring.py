@@ -0,0 +1,77 @@
+import hashlib
+from bisect import bisect_left
+
+
+# Client requests for a group, handled by the server owning it
+PARTITIONED_TYPES = {"START_VOTE", "VOTE_ACK"}
+
+# Read-only client queries, answered by any server whose copy is recent
+# enough
+READ_TYPES = {"GET_GROUPS", "JOINED_GROUPS"}
+
+# Ops ordered by the owner of their group instead of the leader
+PARTITION_OPS = {"start_vote", "vote", "complete"}
+
+# Ring successors keeping a copy of a server's groups
+BACKUPS = 2
+
+
+def position(key):
+    """
+    Place on the ring, stable across processes unlike hash().
+    """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of group names onto servers.
+
+    Servers and groups are hashed onto the same circle and a group belongs
+    to the first server at or after its position. A server joining or
+    leaving only moves the groups between it and its predecessor, and the
+    groups of a failed server go to its successor, which is the first of
+    its backups.
+    """
+    def __init__(self, servers=()):
+        self.nodes = sorted(set(servers), key=position)
+        self.points = [position(s) for s in self.nodes]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, server):
+        return server in self.nodes
+
+    def owner(self, group):
+        if not self.nodes:
+            return None
+        i = bisect_left(self.points, position(group))
+        return self.nodes[i % len(self.nodes)]
+
+    def successors(self, server, n=BACKUPS):
+        """
+        Up to n servers following server on the ring.
+        """
+        if server not in self.nodes:
+            return []
+        i = self.nodes.index(server)
+        count = min(n, len(self.nodes) - 1)
+        return [self.nodes[(i + k) % len(self.nodes)] for k in range(1, count + 1)]
+
+
+def leader_reply(leader, ring, epoch):
+    # LEADER:<id>|<id>,<id>,...|<epoch> with the ring in ring order
+    return f"LEADER:{leader}|{','.join(ring.nodes)}|{epoch}"
+
+
+def parse_leader_reply(text):
+    """
+    Returns (leader id, HashRing, epoch) of a leader reply, None for
+    anything else.
+    """
+    if not text.startswith("LEADER:"):
+        return None
+    leader, _, rest = text[len("LEADER:"):].partition("|")
+    servers, _, epoch = rest.partition("|")
+    return leader, HashRing(s for s in servers.split(",") if s), int(epoch) if epoch.isdecimal() else 0
@@ -1,17 +1,88 @@
-import socket
+import asyncio
 import json
+import os
+import socket
 import threading
 import time
 import signal
+import subprocess
+import sys
 import click
-import secrets
 import uuid
 from collections import defaultdict
 
+import codec
+import snapshot
 from config import MCAST_GRP, MCAST_PORT, BUF
+from dispatch import Dispatcher
+from fanout import FanOut
+from retransmit import RetransmitScheduler
+from tally import Tally, CLOSE_ALL, CLOSE_POLICIES
+from membership import Membership
+from catalogue import Catalogue
+from tokens import Signer, TOKEN_TTL, INVALID, token_codec
+from failure import PhiAccrualDetector, HEARTBEAT_INTERVAL, PHI_SUSPECT, PHI_CRASH
+from swim import ServerList, ALIVE, SUSPECT, DEAD, RANK, INDIRECT_PROBES, DEAD_TIMEOUT
+from replication import ReplicationLog, DurabilityWaiters, REPL_WINDOW, DURABILITY_NONE, DURABILITY_MODES
+from ring import HashRing, PARTITIONED_TYPES, PARTITION_OPS, READ_TYPES, leader_reply
+from snapshot import SnapshotSender, SnapshotReceiver
+from storage import Storage
+from metrics import Metrics, udp_drops
+from logger import Logger, LEVELS, DEBUG, INFO, WARNING, ERROR
+from shards import ShardLink, SHARDED_TYPES, DATAGRAM, shard_of
+
+
+# Broadcast ticks a new server announces itself on, later it only does
+# while it knows no other server
+ANNOUNCE_TICKS = 3
+
+# Heartbeat ticks between probes of a random dead server. One that was
+# only cut off by a partition refutes, and the two sides merge again.
+DEAD_PROBE_TICKS = 10
+
+# Payload budget of one MEMBERS message
+MEMBERS_BYTES = BUF - 512
+
+# Time between declaring a crash and starting the election, so that the
+# other servers have dropped the crashed one from their ring
+ELECTION_DELAY = 0.2
+
+# Seconds after declaring a crash during which an ack from the server
+# proves it was only slow
+FALSE_POSITIVE_WINDOW = 10.0
+
+# Time a new leader waits for backups to report their log position
+SYNC_TIMEOUT = 0.5
+
+# Payload budget of one REPL_APPEND frame
+REPL_FRAME_BYTES = BUF - 512
+
+# Log entries a server may be behind when it is put on the ring
+RING_JOIN_LAG = 100
+
+# Time a new owner waits for the state of groups handed over to it
+HANDOFF_TIMEOUT = 1.0
+
+# Directory of the server's own partition below --data-dir
+PARTITION_DIR = "partition"
+
+# Seconds since a backup last caught up with the leader during which it
+# answers reads itself. The leader confirms this on every broadcast tick.
+READ_STALENESS = 2.0
+
+# Most groups in one GET_GROUPS_OK, and the bytes they may take, leaving
+# room for the ring and the other keys
+GROUPS_PAGE = 100
+GROUPS_PAGE_BYTES = BUF - 1024
 
+# Changes that make up the catalogue feed, collected for FEED_WINDOW
+# seconds into one push
+FEED_OPS = {"create_group", "join_group", "leave_group"}
+FEED_WINDOW = 0.1
+FEED_BYTES = BUF - 512
 
-HEARTBEAT_TIMEOUT = 5.0
+# Log entries a new leader pushes again, the old one may not have
+FEED_REPLAY = 100
 
 
 def get_local_ip():
@@ -23,96 +94,305 @@ def get_local_ip():
         s.close()
 
 
-def requires_auth(fn):
-    def wrapper(self, msg, addr):
-        if not self.is_authenticated(msg):
-            self.send_error(addr, "AUTH_FAILED")
-            return
-        return fn(self, msg, addr)
-    return wrapper
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Forwards every datagram of an asyncio endpoint to a callback.
+    All callbacks run on the event loop thread.
+    """
+    def __init__(self, on_datagram, on_error):
+        self.on_datagram = on_datagram
+        self.on_error = on_error
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        self.on_error(exc)
 
 
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, durability=DURABILITY_NONE, repl_window=REPL_WINDOW, data_dir=None, host=None, logger=None, shard=0, shards=1, read_staleness=READ_STALENESS,
+                 secret=None, token_ttl=TOKEN_TTL, heartbeat_interval=HEARTBEAT_INTERVAL, phi_suspect=PHI_SUSPECT, phi_crash=PHI_CRASH,
+                 network=None):
+        if not secret:
+            raise ValueError("Servers need a shared secret to sign session tokens")
+        self.logger = logger or Logger("SERVER")
+
+        # On a simulated network (see netsim.py) the server has no sockets
+        # and runs on the network's virtual clock and event loop
+        self.network = network
+        self.clock = network.time if network is not None else time.time
+        self.rng = network.random() if network is not None else None
+
+        # With shards > 1 the leader's groups are split across worker
+        # processes sharing the port, shard 0 is this main process
+        self.shard = shard
+        self.shards = shards
+        self.is_worker = shard > 0
+
         # Communication socket
-        self.ip = get_local_ip()
+        self.ip = host or get_local_ip()
         self.port = port
         self.id = f"{self.ip}:{self.port}"
-        self.__open_client_side_socket()
-
-        # Server-side discovery (HS algorithm)
-        self.servers = set()
+        self.sock = None
+        if network is None:
+            self.__open_client_side_socket()
+        self.fanout = FanOut(self.sock, self.__sendto)
+
+        # Server-side discovery (HS algorithm), servers join by multicast
+        # and membership changes are gossiped on the heartbeats
+        self.servers = ServerList(self.id, self.rng, self.clock)
+        self.announced = 0
         self.left = None
         self.right = None
         self.leader = None
         self.is_leader = False
+        # Number of the election that made self.leader the leader, a
+        # leader heard of with a lower one is outdated
+        self.epoch = 0
         self.phase = 0
         self.pending_replies = 0
         self.election_in_progress = False
-        self.__open_discovery_socket()
+        if not self.is_worker and network is None:
+            self.__open_discovery_socket()
+
+        # Session tokens are signed with a key the cluster shares out of
+        # band, it never goes into the log where any sender could fetch it
+        self.token_ttl = token_ttl
+        self.signer = Signer(secret, token_ttl)
 
-        # Client authentication
+        # Address and codec of clients, known from the changes they made
         self.clients = {}
 
+        # Wire codec negotiated per client address
+        self.peer_codecs = {}
+
         # Vote application
         self.groups = {}
+        self.catalogue = Catalogue()
+        self.membership = Membership()
+
+        # Clients the catalogue feed is pushed to, and the leader's log
+        # index it was pushed up to
+        self.subscribers = set()
+        self.feed_sent = 0
+        self.feed_pending = False
         self.votes = {}
 
         # FO reliable multicast S^p_g
         self.S = {}
         self.fo_pending = {}
+        self.retransmit = RetransmitScheduler(rng=self.rng)
+        self.retransmit_wakeup = threading.Event()
+        self.retransmit_timer = None
+
+        # Failure detection of the left neighbour from its heartbeat acks
+        self.heartbeat_interval = heartbeat_interval
+        self.phi_suspect = phi_suspect
+        self.phi_crash = phi_crash
+        self.detector = PhiAccrualDetector(heartbeat_interval)
+        self.suspected = False
+        self.declared = False
+        self.heartbeat_at = None
+        self.heartbeat_ticks = 0
+        # Neighbours declared crashed and when, to count the ones that were
+        # only slow, and when the last failover began
+        self.crashes = {}
+        self.failover_started = None
+
+        # Replication log of clients, groups, memberships and the ring,
+        # ordered by the leader
+        self.log = ReplicationLog()
+        self.syncing = False
+        self.sync_backlog = []
+        self.__register_appliers()
+
+        # Replication pipeline: commits are batched over repl_window and
+        # replies wait until the durability mode is satisfied
+        self.repl_window = repl_window
+        self.replicated = 0
+        self.repl_wakeup = threading.Event()
+        self.repl_flush_pending = False
+        self.durable = DurabilityWaiters(durability)
+
+        # Bounded staleness reads: when this backup last had everything
+        # the leader had replicated
+        self.read_staleness = read_staleness
+        self.synced_at = None
+
+        # Clients waiting until a group's owner applied their change
+        self.applied_waiters = {}
+
+        # Partitioning: the polls of a group are led by the server owning it
+        # on the hash ring and logged in that server's partition log, which
+        # its ring successors copy. partitions maps owner -> log, the own
+        # one included.
+        self.ring = HashRing()
+        self.partitions = {self.id: ReplicationLog()}
+        self.part_replicated = 0
+        self.part_durable = DurabilityWaiters(durability)
+        self.partition_out = {}
+        self.partition_in = {}
+
+        # Groups taken over from a live server, until their state arrives
+        self.handoffs = {}
+        self.handoff_backlog = []
+        # Handed over before this server applied the ring change
+        self.early_handoffs = set()
+
+        # Optional on-disk state, restored before anything else happens
+        self.storage = None
+        self.partition_storage = None
+        self.restoring = False
+        if data_dir is not None:
+            self.storage = Storage(data_dir)
+            self.partition_storage = Storage(os.path.join(data_dir, PARTITION_DIR))
+            self.__restore()
+
+        # Snapshot transfers for servers the log can no longer catch up
+        self.snapshots_out = {}
+        self.snapshot_in = None
+
+        # Message dispatch
+        self.metrics = Metrics()
+        self.__register_gauges()
+        self.dispatcher = Dispatcher(self.is_authenticated, self.__auth_failed, self.__log, self.metrics, self.__is_peer)
+        self.__register_handlers()
+
+        # Local link between the shard processes
+        self.link = None
+        self.link_handlers = {
+            "SHARD_HELLO": self.__shard_hello,
+            "SHARD_COMMIT": self.__shard_commit,
+            "SHARD_LEADER": self.__shard_leader,
+        }
+        if shards > 1:
+            self.link = ShardLink(port, shard, self.__log)
+
+        # Asyncio mode (None in threaded mode)
+        self.loop = None
+        self.transport = None
+        self.stopped = None
 
-        # Heartbeat state
-        self.last_heartbeat_time = time.time()
-        self.heartbeat_ack_received = True
+        # In threaded mode every thread holds this while it touches the
+        # server state, so they take turns like callbacks on the loop do
+        self.state_lock = threading.RLock()
 
         # Shutdown handling
         self.stop_event = threading.Event()
-        signal.signal(signal.SIGINT, self.__shutdown)
-        signal.signal(signal.SIGTERM, self.__shutdown)
-
-    def __send_replicate_state(self, new_leader):
-        # Ensure all sets are converted to lists before sending
-        state = {
-            "type": "REPL_STATE",
-            "clients": {cid: {"token": client["token"], "addr": client["addr"]} for cid, client in self.clients.items()},
-            "groups": {name: {"owner": group["owner"], "members": list(group["members"])} for name, group in self.groups.items()},
-            "votes": self.votes,
-            "S": self.S,
-            "fo_pending": self.fo_pending,
-        }
-        self.__leader_send(new_leader, state)
+        if network is None:
+            signal.signal(signal.SIGINT, self.__shutdown)
+            signal.signal(signal.SIGTERM, self.__shutdown)
 
     def __tell_clients_about_new_leader(self):
-        for cid, client in self.clients.items():
-            self.__leader_send(client["addr"], {"type": "NEW_LEADER", "id": self.id})
-
-    def __replicate_state(self, msg):
-        # Convert sets to lists
-        self.clients = {cid: {"token": client["token"], "addr": tuple(client["addr"])} for cid, client in msg["clients"].items()}
-        
-        self.groups = {name: {
-            "owner": group["owner"],
-            "members": list(group["members"])
-        } for name, group in msg["groups"].items()}
-
-        self.votes = msg["votes"]
-        self.S = msg["S"]
-        self.fo_pending = msg["fo_pending"]
-
-        # Tell clients that this is the new leader
-        self.__tell_clients_about_new_leader()
+        # The ring tells clients which server leads the polls of a group
+        self.__fan_out(self.clients, {"type": "NEW_LEADER", "id": self.id, "epoch": self.epoch, "ring": self.ring.nodes})
 
     def is_authenticated(self, msg):
-        cid = msg.get("id")
-        token = msg.get("token")
-        return cid in self.clients and self.clients[cid]["token"] == token
+        return self.signer.verify(msg.get("id"), msg.get("token")) is None
+
+    def __is_peer(self, msg, addr):
+        # addr is None for control messages from the main process over the shard link
+        sid = msg["id"]
+        if addr is None:
+            return True
+        return isinstance(sid, str) and (sid == self.leader or sid in self.servers) and self.__addr(sid) == tuple(addr)
 
     def send_error(self, addr, err):
         self.__send(addr, {"type": "ERROR", "error": err})
 
-    def __log(self, msg):
-        print(f"[SERVER] {msg}")
+    def __auth_failed(self, addr, msg):
+        reason = self.signer.verify(msg.get("id"), msg.get("token")) or INVALID
+        self.metrics.count(f"error.{reason}")
+        self.send_error(addr, reason)
+
+    def __session(self, msg, addr):
+        """
+        Where an authenticated client is reached, carried by its changes
+        so that the servers fanning out to it know.
+        """
+        return {"addr": addr, "codec": token_codec(msg["token"], codec.JSON)}
+
+    def __register_gauges(self):
+        gauge = self.metrics.gauge
+        gauge("clients", lambda: len(self.clients))
+        gauge("groups", lambda: len(self.groups))
+        gauge("catalogue.version", lambda: self.catalogue.version)
+        gauge("feed.subscribers", lambda: len(self.subscribers))
+        gauge("fo_pending", lambda: len(self.fo_pending))
+        gauge("retransmit.scheduled", lambda: len(self.retransmit))
+        gauge("retransmit.sent", lambda: self.retransmit.retransmits)
+        gauge("repl.index", lambda: self.log.last_index)
+        gauge("repl.lag", lambda: {s: self.log.lag(s) for s in self.log.acked})
+        gauge("repl.lag_max", lambda: max((self.log.lag(s) for s in self.log.acked), default=0))
+        gauge("repl.waiting_replies", lambda: len(self.durable))
+        gauge("socket.drops", lambda: udp_drops(self.port))
+        gauge("log.dropped", lambda: self.logger.dropped)
+        gauge("log.suppressed", lambda: self.logger.suppressed)
+        gauge("shard.forwarded", lambda: self.link.forwarded if self.link else 0)
+        gauge("ring.size", lambda: len(self.ring))
+        gauge("partition.groups", lambda: len(self.__owned_groups()))
+        gauge("partition.index", lambda: self.partitions[self.id].last_index)
+        gauge("partition.lag", lambda: {s: self.partitions[self.id].lag(s) for s in self.ring.successors(self.id)})
+        gauge("partition.waiting_replies", lambda: len(self.part_durable))
+        gauge("read.staleness", self.__staleness)
+        gauge("members", lambda: len(self.servers))
+        gauge("members.gossip_pending", lambda: len(self.servers.pending))
+        gauge("failure.phi", lambda: round(self.detector.phi(self.clock()), 2))
+
+    def __register_handlers(self):
+        """
+        Declares every message type with its required keys.
+        Handlers marked mutates change replicated state and only run on
+        the leader, peer_only ones only serve the servers of the cluster.
+        """
+        register = self.dispatcher.register
+
+        # Election
+        register("HS_ELECTION", self.__hs_election, required=("id", "hop", "direction"))
+        register("HS_REPLY", self.__hs_reply, required=("id", "direction"))
+        register("HS_LEADER", self.__hs_leader, required=("id",))
+
+        # Client requests
+        register("REGISTER", self.__register, required=("id",))
+        register("CREATE_GROUP", self.__create_group, required=("id", "group"), requires_auth=True, mutates=True)
+        register("GET_GROUPS", self.__get_groups, requires_auth=True)
+        register("JOIN_GROUP", self.__join_group, required=("id", "group"), requires_auth=True, mutates=True)
+        register("JOINED_GROUPS", self.__joined_groups, required=("id",), requires_auth=True)
+        register("LEAVE_GROUP", self.__leave_group, required=("id", "group"), requires_auth=True, mutates=True)
+        register("SUBSCRIBE", self.__subscribe, required=("id",), requires_auth=True, mutates=True)
+        register("UNSUBSCRIBE", self.__unsubscribe, required=("id",), requires_auth=True, mutates=True)
+        register("FEED_FETCH", self.__feed_fetch, required=("id", "since"), requires_auth=True)
+        register("START_VOTE", self.__start_vote, required=("id", "group", "topic", "options", "timeout"), requires_auth=True, mutates=True)
+        register("VOTE_ACK", self.__vote_ack, required=("id", "vote_id", "group", "S", "vote"), requires_auth=True, log=False, mutates=True)
+
+        # Replication
+        register("REPL_APPEND", self.__repl_append, required=("id", "entries"), log=False, peer_only=True)
+        register("REPL_ACK", self.__repl_ack, required=("id", "index"), log=False, peer_only=True)
+        register("REPL_FETCH", self.__repl_fetch, required=("id", "from"), peer_only=True)
+        register("REPL_SYNC", self.__repl_sync, required=("id", "index"), peer_only=True)
+        register("SNAP_BEGIN", self.__snap_begin, required=("id", "snap_id", "index", "chunks", "size", "crc"), peer_only=True)
+        register("SNAP_CHUNK", self.__snap_chunk, required=("id", "snap_id", "seq", "crc", "data"), log=False, peer_only=True)
+        register("SNAP_END", self.__snap_end, required=("id", "snap_id"), peer_only=True)
+        register("SNAP_NACK", self.__snap_nack, required=("id", "snap_id", "missing"), peer_only=True)
+
+        # Partitions
+        register("PART_APPEND", self.__part_append, required=("id", "entries"), log=False, peer_only=True)
+        register("PART_ACK", self.__part_ack, required=("id", "index"), log=False, peer_only=True)
+        register("PART_FETCH", self.__part_fetch, required=("id", "from"), peer_only=True)
+        register("ROUTED", self.__routed, required=("id", "addr", "msg"), log=False)
+
+        # Heartbeat
+        register("HEARTBEAT", self.__heartbeat, required=("id",), log=False)
+        register("HEARTBEAT_ACK", self.__heartbeat_ack, required=("id",), log=False)
+        register("PING_REQ", self.__ping_req, required=("id", "target"), log=False)
+        register("MEMBERS", self.__members, required=("id", "members"), log=False)
+
+        # Local monitoring
+        register("STATS", self.__stats, log=False)
+
+    def __log(self, msg, level=INFO, category=None, **fields):
+        self.logger.log(level, msg, category, **fields)
 
     def __open_discovery_socket(self):
         self.__log("Opening discovery service")
@@ -126,114 +406,380 @@ class Server:
     def __open_client_side_socket(self):
         self.__log("Opening communication socket")
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.shards > 1:
+            # Every shard process binds the same port, the kernel spreads
+            # clients across them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((self.ip, self.port))
         self.sock.settimeout(1.0)
 
+    def __open_broadcast_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        return sock
+
     def __shutdown(self, *_):
         self.__log("Shutting down...")
         self.stop_event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__stop_loop)
+
+    def __stop_loop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def __call_later(self, delay, fn):
+        """
+        Runs fn after delay seconds. In asyncio mode this is an event loop
+        timer, in threaded mode a daemon timer thread.
+        """
+        if self.loop is not None:
+            self.loop.call_later(delay, fn)
+        else:
+            timer = threading.Timer(delay, self.__locked, (fn,))
+            timer.daemon = True
+            timer.start()
+
+    def __on_discovery(self, data, addr):
+        msg = data.decode()
+        if msg.startswith("SERVER:"):
+            sid, incarnation = self.__announced(msg)
+            known = sid in self.servers
+            if self.__claim(sid, ALIVE, incarnation or 0):
+                self.__build_ring()
+            if not known and sid != self.id and self.servers.successor(sid) == self.id:
+                # The server after a new one on the ring tells it everybody
+                self.__send_members(sid)
+        elif msg == "WHO_IS_LEADER":
+            self.__log("Discovery service got leader request", DEBUG, "discovery")
+            # Every server that knows the leader answers, clients keep the
+            # answer with the highest epoch
+            if self.leader is not None and not self.election_in_progress:
+                self.__sendto(leader_reply(self.leader, self.ring, self.epoch).encode(), addr)
+                self.__log("Replied to leader request", DEBUG, "discovery")
+        elif msg.startswith("CRASH:"):
+            sid, incarnation = self.__announced(msg)
+            known = self.servers.state(sid)
+            if incarnation is None:
+                incarnation = known[1] if known else 0
+            if self.__claim(sid, DEAD, incarnation):
+                self.__log("Crash discovered, rebuild ring")
+                self.__build_ring()
+
+    def __announced(self, msg):
+        """
+        Server id and incarnation (None if not given) of a SERVER: or
+        CRASH: announcement.
+        """
+        sid, _, incarnation = msg.split(":", 1)[1].partition("|")
+        return sid, int(incarnation) if incarnation.isdigit() else None
+
+    def __claim(self, sid, state, incarnation):
+        """
+        Takes in what somebody says about a server, returns True if that
+        was news.
+        """
+        if not self.servers.apply(sid, state, incarnation):
+            return False
+
+        if sid == self.id:
+            self.metrics.count("members.refuted")
+            self.__log(f"Refuting being {state}, incarnation now {self.servers.incarnation}", WARNING)
+            # Servers that dropped this one hear of it sooner
+            self.announced = 0
+        else:
+            self.__log(f"Server {sid} {state} at incarnation {incarnation}", INFO, "discovery")
+            if state == ALIVE:
+                self.__alive_again(sid)
+        return True
+
+    def __gossip(self, msg, key="updates"):
+        """
+        Takes in the membership changes a message carries, and that its
+        sender is alive.
+        """
+        changed = False
+        if isinstance(msg.get("inc"), int):
+            changed |= self.__claim(msg["id"], ALIVE, msg["inc"])
+        updates = msg.get(key)
+        for update in updates if isinstance(updates, list) else ():
+            if not isinstance(update, list) or len(update) != 3:
+                continue
+            sid, state, incarnation = update
+            if isinstance(sid, str) and state in RANK and isinstance(incarnation, int):
+                changed |= self.__claim(sid, state, incarnation)
+        if changed:
+            self.__build_ring()
+
+    def __send_members(self, server_id):
+        frame = []
+        size = 0
+        for entry in self.servers.digest():
+            n = len(json.dumps(entry))
+            if frame and size + n > MEMBERS_BYTES:
+                self.__send(server_id, {"type": "MEMBERS", "id": self.id, "members": frame})
+                frame = []
+                size = 0
+            frame.append(entry)
+            size += n
+        if frame:
+            self.__send(server_id, {"type": "MEMBERS", "id": self.id, "members": frame})
+
+    def __members(self, msg, addr):
+        self.__gossip(msg, "members")
 
     def __discovery_service(self):
         while not self.stop_event.is_set():
             try:
                 data, addr = self.mcast.recvfrom(1024)
-                msg = data.decode()
-                if msg.startswith("SERVER:"):
-                    _, sid = msg.split(":", 1)
-                    if sid not in self.servers:
-                        self.__log(f"Discovery service found server: {sid}")
-                        self.servers.add(sid)
-                        self.__build_ring()
-
-                        # If the server joined itself, start HS
-                        # if self.id == sid:
-                        #     time.sleep(2)  # Needed with >1s so that other servers can discover it
-                        #     self.__hs_start()
-                elif msg == "WHO_IS_LEADER":
-                        self.__log(f"Discovery service got leader request")
-                        if self.is_leader:
-                            self.sock.sendto(f"LEADER:{self.id}".encode(), addr)
-                            self.__log("Replied to leader request")
-                elif msg.startswith("CRASH:"):
-                    self.__log("Crash discovered, rebuild ring")
-                    _, sid = msg.split(":", 1)
-                    self.servers.remove(sid)
-                    self.__build_ring()
+                self.__locked(self.__on_discovery, data, addr)
             except socket.timeout:
                 continue
-    
-    def __discovery_service_broadcast(self, interval=1.0):
-        self.__log("Starting continuous discovery broadcast thread")
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
-        msg = f"SERVER:{self.id}".encode()
 
-        while not self.stop_event.is_set():
-            # Broadcast for discovery
+    def __broadcast_tick(self, sock):
+        # Announce this server while it joins or knows nobody, the
+        # heartbeats spread everything else
+        if self.announced < ANNOUNCE_TICKS or len(self.servers) < 2:
+            self.announced += 1
             try:
-                sock.sendto(msg, (MCAST_GRP, MCAST_PORT))
+                sock.sendto(f"SERVER:{self.id}|{self.servers.incarnation}".encode(), (MCAST_GRP, MCAST_PORT))
             except Exception as e:
-                self.__log(f"Error broadcasting discovery: {e}")
-
-            # Heartbeat
-            current_time = time.time()
-            if current_time - self.last_heartbeat_time > HEARTBEAT_TIMEOUT:
-                if self.heartbeat_ack_received:
-                    self.heartbeat_ack_received = False
-                    self.__log(f"Heartbeat timeout for {self.left}, assuming crash.")
-                    try:
-                        sock.sendto(f"CRASH:{self.left}".encode(), (MCAST_GRP, MCAST_PORT))
-                    except Exception as e:
-                        self.__log(f"Error broadcasting heartbeat discovered crash: {e}")
-
-                    time.sleep(2)  # Needed with >1s so that other servers can discover it
-
-                    # Start new HS to get a new leader
-                    self.__hs_start()
-                    
-            self.__send_heartbeat()
+                self.__log(f"Broadcasting discovery failed: {e}", ERROR)
+
+        self.__sync_storage()
+
+        if self.is_leader and not self.syncing:
+            self.__repair_backups()
+            self.__send_beat()
+            if self.__update_ring():
+                self.__tell_clients_about_new_leader()
+
+            # Backups may have left, which lowers what is needed
+            self.__release_durable()
+
+        if self.__serving():
+            self.__repair_partition()
+
+    def __discovery_service_broadcast(self, interval=1.0):
+        self.__log("Starting continuous discovery broadcast thread")
 
+        sock = self.__open_broadcast_socket()
+        while not self.stop_event.is_set():
+            self.__locked(self.__broadcast_tick, sock)
             time.sleep(interval)
 
         sock.close()
 
-    def __send_heartbeat(self):
+    def __heartbeat_tick(self, sock):
+        """
+        Sends a heartbeat to the left neighbour and checks how overdue its
+        acks are. Another heartbeat goes to a random server, so that the
+        gossip on them spreads across the ring in a few rounds.
+        """
+        now = self.clock()
+        previous, self.heartbeat_at = self.heartbeat_at, now
+        self.heartbeat_ticks += 1
+        if self.heartbeat_ticks % DEAD_PROBE_TICKS == 0:
+            self.__probe_dead()
         if self.left is None or self.left == self.id:
-            self.last_heartbeat_time = time.time()
-            self.heartbeat_ack_received = True
             return
-        self.__send(self.left, {"type": "HEARTBEAT", "id": self.id})
+        if self.detector.peer != self.left:
+            self.detector.reset(self.left, now)
+            self.suspected = False
+            self.declared = False
+
+        self.__send(self.left, self.__heartbeat_msg(sent=now))
+        for server in self.servers.sample(1, exclude=(self.left,)):
+            self.__send(server, self.__heartbeat_msg())
+        if self.declared:
+            return
+        if previous is not None and now - previous > 2 * self.heartbeat_interval:
+            # This server was paused itself, acks may be waiting unread
+            self.metrics.count("failure.paused")
+            return
 
-    def __build_ring(self):
-        ordered = sorted(self.servers)
-        self.__log(f"Ordered ring: {ordered}")
+        phi = self.detector.phi(now)
+        if phi >= self.phi_crash:
+            self.declared = True
+            self.__declare_crash(sock, phi, now)
+        elif phi >= self.phi_suspect and not self.suspected:
+            self.suspected = True
+            self.metrics.count("failure.suspected")
+            self.__log(f"Heartbeat of {self.left} overdue (phi {phi:.1f}), suspecting crash", WARNING)
+
+            # Others probe it too, in case only the link to it is bad.
+            # Telling everybody lets it refute if it is alive.
+            state = self.servers.state(self.left)
+            if self.__claim(self.left, SUSPECT, state[1] if state else 0):
+                self.__build_ring()
+            for server in self.servers.sample(INDIRECT_PROBES, exclude=(self.left,)):
+                self.__send(server, {"type": "PING_REQ", "id": self.id, "target": self.left})
+
+    def __probe_dead(self):
+        """
+        Heartbeats a random dead server and tells it that it is dead. One
+        that is alive behind a healed partition refutes in its ack, and
+        tells this server what its side thinks of this one. Servers dead
+        for DEAD_TIMEOUT are forgotten instead of probed forever.
+        """
+        for sid in self.servers.evict():
+            self.metrics.count("members.evicted")
+            self.__log(f"Forgetting {sid}, dead for {DEAD_TIMEOUT:.0f}s", INFO, "discovery")
+        dead = self.servers.dead()
+        if not dead:
+            return
+        target = self.servers.rng.choice(dead)
+        msg = self.__heartbeat_msg()
+        msg["updates"].append([target, DEAD, self.servers.state(target)[1]])
+        self.metrics.count("members.dead_probes")
+        self.__send(target, msg)
+
+    def __heartbeat_msg(self, sent=None):
+        msg = {"type": "HEARTBEAT", "id": self.id, "inc": self.servers.incarnation, "updates": self.servers.updates()}
+        if sent is not None:
+            msg["sent"] = sent
+        return msg
+
+    def __declare_crash(self, sock, phi, now):
+        crashed = self.left
+        silence = self.detector.silence(now)
+        self.metrics.count("failure.declared")
+        self.metrics.record("failure.detection", silence)
+        self.__log(f"No heartbeat of {crashed} for {silence:.2f}s (phi {phi:.1f}), assuming crash.", WARNING)
+
+        self.crashes = {sid: t for sid, t in self.crashes.items() if now - t < FALSE_POSITIVE_WINDOW}
+        self.crashes[crashed] = now
+        # Measured from the last sign of life, the crash happened after it
+        self.failover_started = now - silence
+
+        # The heartbeats gossip it reliably, one multicast gets everybody's
+        # ring right before the election
+        state = self.servers.state(crashed)
+        incarnation = state[1] if state else 0
+        self.__claim(crashed, DEAD, incarnation)
+        self.__build_ring()
+        try:
+            sock.sendto(f"CRASH:{crashed}|{incarnation}".encode(), (MCAST_GRP, MCAST_PORT))
+        except Exception as e:
+            self.__log(f"Broadcasting heartbeat discovered crash failed: {e}", ERROR)
+
+        # Start new HS to get a new leader
+        self.__call_later(ELECTION_DELAY, self.__hs_start)
+
+    def __heartbeat_service(self):
+        self.__log("Starting heartbeat thread")
+
+        sock = self.__open_broadcast_socket()
+        while not self.stop_event.wait(self.heartbeat_interval):
+            self.__locked(self.__heartbeat_tick, sock)
 
-        idx = ordered.index(self.id)
-        self.left = ordered[(idx - 1) % len(ordered)]
-        self.right = ordered[(idx + 1) % len(ordered)]
-        self.__log(f"Created ring left={self.left}, right={self.right}")
+        sock.close()
 
-    def __send(self, server_id, msg):
+    def __failover_done(self):
+        if self.failover_started is not None:
+            self.metrics.record("failover", self.clock() - self.failover_started)
+            self.failover_started = None
+
+    def __build_ring(self):
+        left, right = self.servers.neighbours()
+        if (left, right) != (self.left, self.right):
+            self.left = left
+            self.right = right
+            self.__log(f"Created ring left={self.left}, right={self.right}")
+
+    def __sendto(self, data, addr):
+        if self.transport is not None:
+            self.transport.sendto(data, addr)
+        else:
+            self.sock.sendto(data, addr)
+
+    def __addr(self, server_id):
         if type(server_id) is not tuple:
             ip, port = server_id.split(":")
-            self.sock.sendto(json.dumps(msg).encode(), (ip, int(port)))
-        else:
-            self.sock.sendto(json.dumps(msg).encode(), server_id)
+            return (ip, int(port))
+        return server_id
+
+    def __encode(self, addr, msg):
+        # Servers talk JSON, clients whatever they negotiated
+        return codec.encode(msg, self.peer_codecs.get(addr, codec.JSON))
+
+    def __send(self, server_id, msg):
+        if self.is_worker and server_id == self.id:
+            # Workers share the main process' id, it needs no acks from them
+            return
+        addr = self.__addr(server_id)
+        self.__sendto(self.__encode(addr, msg), addr)
 
     def __leader_send(self, server_id, msg):
         """
-        This is for the communication with the client.
-        Only the leader communicates with the client.
+        Replies to changes of the leader's log come from the leader only,
+        reads are answered by any server fresh enough.
         """
         if not self.is_leader:
+            # Lost the leadership before the change was durable
+            self.__redirect(server_id)
             return
-        
-        if type(server_id) is not tuple:
-            ip, port = server_id.split(":")
-            self.sock.sendto(json.dumps(msg).encode(), (ip, int(port)))
-        else:
-            self.sock.sendto(json.dumps(msg).encode(), server_id)
+
+        addr = self.__addr(server_id)
+        self.__sendto(self.__encode(addr, msg), addr)
+
+    def __redirect(self, addr, msg_type=None, owner=None):
+        """
+        Tells a client that sent msg_type to the wrong server which server
+        leads, and with owner which one owns the group. Nothing while no
+        leader is known, the client finds it by multicast then.
+        """
+        if self.leader is None or self.election_in_progress:
+            return
+        msg = {"type": "REDIRECT", "id": self.id, "leader": self.leader, "epoch": self.epoch}
+        if msg_type is not None:
+            msg["for"] = msg_type
+        if owner is not None:
+            msg["owner"] = owner
+        self.metrics.count("redirect.sent")
+        self.__send(addr, msg)
+
+    def __owner_send(self, server_id, msg):
+        """
+        Poll traffic goes out from the server owning the group.
+        """
+        if not self.__serving():
+            return
+
+        addr = self.__addr(server_id)
+        self.__sendto(self.__encode(addr, msg), addr)
+
+    def __fan_out(self, cids, msg):
+        """
+        Sends msg to every client in cids. The message is encoded once per
+        codec in use and handed to the fan-out sender in batches.
+        Returns (sent, failed).
+        """
+        if not self.__serving():
+            return 0, 0
+
+        by_codec = defaultdict(list)
+        failed = 0
+        for cid in cids:
+            client = self.clients.get(cid)
+            if client is None:
+                failed += 1
+                continue
+            by_codec[client["codec"]].append(client["addr"])
+
+        sent = 0
+        for name, addrs in by_codec.items():
+            s, f = self.fanout.send(codec.encode(msg, name), addrs)
+            sent += s
+            failed += f
+
+        self.metrics.count("fanout.sent", sent)
+        if failed:
+            self.metrics.count("fanout.failed", failed)
+
+        if failed:
+            self.__log(f"Fan-out of {msg.get('type')}: {sent} sent, {failed} failed", WARNING, "fanout")
+        return sent, failed
 
     def __hs_start(self):
         if self.election_in_progress:
@@ -243,9 +789,16 @@ class Server:
         if self.left is None or self.right is None:
             self.__build_ring()
             
+        if self.is_leader:
+            # Pending replies belong to whoever wins, polls stay with
+            # the owners of their groups
+            self.durable.clear()
+            self.applied_waiters = {}
+
         self.election_in_progress = True
         self.leader = None
         self.is_leader = False
+        self.__update_workers()
         self.phase = 0
         self.__log("Starting Hirschberg-Sinclair election...")
         self.__hs_send_neighbors()
@@ -260,30 +813,19 @@ class Server:
                 "id": self.id,
                 "phase": self.phase,
                 "direction": direction,
-                "hop": distance
+                "hop": distance,
+                "epoch": self.epoch
             }
             neighbor = self.left if direction == "LEFT" else self.right
             self.__send(neighbor, msg)
 
-    def __hs_election(self, msg):
-        cid = msg.get("id")
-        hop = msg.get("hop")
-        direction = msg.get("direction")
-
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
-            return
-        
-        if hop is None:
-            self.__log(f"Error: Expected key 'hop': {msg}")
-            return
-
-        if direction is None:
-            self.__log(f"Error: Expected key 'direction': {msg}")
-            return
+    def __hs_election(self, msg, addr):
+        cid = msg["id"]
+        hop = msg["hop"]
+        direction = msg["direction"]
 
         if direction not in ["LEFT", "RIGHT"]:
-            self.__log(f"Error: Wrong value of 'direction': {direction}")
+            self.__log(f"Wrong value of 'direction': {direction}", ERROR)
             return
 
         neighbor = self.left if direction == "LEFT" else self.right
@@ -293,40 +835,39 @@ class Server:
             if not self.election_in_progress:
                 self.__hs_start()
             return
-        
+
+        # The winner's messages pass every server, so it learns the
+        # highest epoch any of them knows
+        epoch = max(msg.get("epoch", 0), self.epoch)
         if hop > 1:
             msg["hop"] -= 1
+            msg["epoch"] = epoch
             self.__send(neighbor, msg)
         else:
             reply = {
                 "type": "HS_REPLY",
                 "id": cid,
-                "direction": msg["direction"]
+                "direction": msg["direction"],
+                "epoch": epoch
             }
             self.__send(neighbor, reply)
 
-    def __hs_reply(self, msg):
-        cid = msg.get("id")
-        direction = msg.get("direction")
-
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
-            return
-
-        if direction is None:
-            self.__log(f"Error: Expected key 'direction': {msg}")
-            return
+    def __hs_reply(self, msg, addr):
+        cid = msg["id"]
+        direction = msg["direction"]
 
         if direction not in ["LEFT", "RIGHT"]:
-            self.__log(f"Error: Wrong value of 'direction': {direction}")
+            self.__log(f"Wrong value of 'direction': {direction}", ERROR)
             return
 
         neighbor = self.left if direction == "LEFT" else self.right
 
         if cid != self.id:
+            msg["epoch"] = max(msg.get("epoch", 0), self.epoch)
             self.__send(neighbor, msg)
             return
-        
+
+        self.epoch = max(self.epoch, msg.get("epoch", 0))
         self.pending_replies -= 1
 
         if self.pending_replies == 0:
@@ -340,387 +881,1559 @@ class Server:
         self.__log("HS: I am the leader")
         self.leader = self.id
         self.is_leader = True
+        self.epoch += 1
         self.election_in_progress = False
-        msg = {"type": "HS_LEADER", "id": self.id}
+        self.__failover_done()
+        msg = {"type": "HS_LEADER", "id": self.id, "epoch": self.epoch}
         self.__send(self.left, msg)
+        self.__become_leader()
 
-    def __hs_leader(self, msg):
-        cid = msg.get("id")
-        
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
-            return
-        
-        # If this server was the leader before,
-        # replicate its whole state to the new leader.
-        if self.is_leader and cid != self.id:
-            self.__send_replicate_state(cid)
+    def __hs_leader(self, msg, addr):
+        cid = msg["id"]
 
         self.leader = cid
         self.is_leader = (self.leader == self.id)
+        self.epoch = max(self.epoch, msg.get("epoch", 0))
         self.election_in_progress = False
-        self.__log(f"HS: Leader elected: {self.leader}")
+        self.__failover_done()
+        self.__log(f"HS: Leader elected: {self.leader} (epoch {self.epoch})")
+        self.__update_workers()
 
         if self.left != cid:
             self.__send(self.left, msg)
 
-    def __register(self, msg, addr):
-        cid = msg.get("id")
+    def __register_appliers(self):
+        """
+        Every state mutation is an op. The leader applies and logs it,
+        the backups apply the same ops in log order.
+        """
+        self.appliers = {
+            "register": self.__apply_register,
+            "create_group": self.__apply_create_group,
+            "join_group": self.__apply_join_group,
+            "leave_group": self.__apply_leave_group,
+            "subscribe": self.__apply_subscribe,
+            "unsubscribe": self.__apply_unsubscribe,
+            "start_vote": self.__apply_start_vote,
+            "vote": self.__apply_vote,
+            "complete": self.__apply_complete,
+            "ring": self.__apply_ring,
+        }
+
+    def __apply(self, op):
+        return self.appliers[op["op"]](op)
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
+    def __apply_entry(self, index, op):
+        """
+        Applies an entry replicated or restored from disk. One that fails
+        is reported and skipped, so the entries after it still apply.
+        """
+        try:
+            self.__apply(op)
+        except Exception as e:
+            self.metrics.count("repl.apply_failed")
+            self.__log(f"Could not apply log entry {index} ({op.get('op')}): {e!r}", ERROR)
+
+    def __restore(self):
+        start = time.perf_counter()
+        self.restoring = True
+        count = 0
+        for storage, log in ((self.storage, self.log), (self.partition_storage, self.partitions[self.id])):
+            index, state, entries = storage.load()
+            if state is not None and log is self.log:
+                self.__install_state(state)
+            elif state is not None:
+                self.__install_partition(state["groups"])
+            log.reset(index)
+
+            for i, op in entries:
+                for j, ready in log.receive(i, op):
+                    self.__apply_entry(j, ready)
+            count += len(entries)
+        self.restoring = False
+
+        elapsed = (time.perf_counter() - start) * 1000
+        self.__log(f"Restored state at log index {self.log.last_index}, partition index "
+                   f"{self.partitions[self.id].last_index} ({count} WAL entries) in {elapsed:.1f} ms")
+
+    def __persist(self, index, op):
+        """
+        Writes an applied mutation to the WAL, and a snapshot when one is due.
+        Polls of this server's own groups have a WAL of their own.
+        """
+        if self.storage is None:
             return
 
-        token = secrets.token_hex(16)
-        self.clients[cid] = {
-            "token": token,
-            "addr": addr
-        }
+        if op["op"] in PARTITION_OPS:
+            storage = self.partition_storage
+            storage.append(index, op)
+            if storage.snapshot_due():
+                storage.snapshot(index, {"groups": self.__partition_state(self.__owned_groups())})
+            return
 
-        # Replicate to other servers
-        if self.is_leader:
-            for server in self.servers:
-                if server != self.id:
-                    self.__leader_send(server, {
-                        "type": "REPL_REGISTER",
-                        "id": cid,
-                        "token": token,
-                        "addr": addr
-                    })
-
-        self.__leader_send(addr, {"type": "REGISTER_OK", "token": token})
-
-    @requires_auth
-    def __create_group(self, msg, addr):
-        cid = msg.get("id")
-        name = msg.get("group")
+        self.storage.append(index, op)
+        if self.storage.snapshot_due():
+            # A backup received the whole frame before applying any of it,
+            # the log tip may be ahead of the state
+            state = self.__snapshot_state()
+            state["index"] = index
+            self.storage.snapshot(index, state)
+
+    def __sync_storage(self):
+        if self.storage is not None:
+            self.storage.sync()
+            self.partition_storage.sync()
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
+    def __commit(self, op):
+        """
+        Applies a state mutation and replicates it: polls through this
+        server's partition log, everything else through the leader's log.
+        Returns what the applier returned.
+        """
+        if self.is_worker:
+            # The main process logs it, the echo in its mirror is skipped
+            op["origin"] = self.shard
+            result = self.__apply(op)
+            self.link.send_control(0, {"type": "SHARD_COMMIT", "op": op})
+            return result
+
+        # Logged only once it applied, an op that fails must not reach
+        # the backups
+        partition = op["op"] in PARTITION_OPS
+        result = self.__apply(op)
+        index = (self.partitions[self.id] if partition else self.log).append(op)
+        self.__persist(index, op)
+        if not partition:
+            self.__mirror(index, op)
+        self.__schedule_flush()
+        if op["op"] in FEED_OPS and self.subscribers:
+            self.__schedule_feed()
+        return result
+
+    def __schedule_flush(self):
+        if self.loop is not None:
+            if not self.repl_flush_pending:
+                self.repl_flush_pending = True
+                self.loop.call_later(self.repl_window, self.__flush_replication)
+        else:
+            self.repl_wakeup.set()
+
+    def __flush_replication(self):
+        """
+        Sends everything committed since the last flush to all backups,
+        encoded once per frame: the leader's log to every server and the
+        partition log to this server's ring successors.
+        """
+        self.repl_flush_pending = False
+        if self.stop_event.is_set():
             return
 
-        if name is None:
-            self.__log(f"Error: Expected key 'group': {msg}")
+        # One fsync for the whole batch, before any backup sees it
+        self.__sync_storage()
+
+        # Backups receiving a snapshot catch up when it is installed
+        backups = [s for s in self.servers if s != self.id and s not in self.snapshots_out]
+        self.replicated = self.__replicate(self.log, self.replicated, backups, "REPL_APPEND")
+
+        seeding = {server for server, _, seed in self.partition_out.values() if seed}
+        backups = [s for s in self.ring.successors(self.id) if s not in seeding]
+        self.part_replicated = self.__replicate(self.partitions[self.id], self.part_replicated, backups, "PART_APPEND")
+
+    def __replicate(self, log, sent, backups, msg_type):
+        """
+        Sends the entries of log after index sent to backups.
+        Returns the index sent up to.
+        """
+        if sent >= log.last_index:
+            return sent
+
+        entries = log.range(sent + 1)
+        if backups and entries is not None:
+            addrs = [self.__addr(s) for s in backups]
+            for frame in self.__frames(entries, msg_type):
+                self.fanout.send(codec.encode(frame), addrs)
+        return log.last_index
+
+    def __replication_loop(self):
+        while not self.stop_event.is_set():
+            if not self.repl_wakeup.wait(1.0):
+                continue
+            self.repl_wakeup.clear()
+
+            # Group commit: let more mutations join the batch
+            if self.repl_window > 0:
+                time.sleep(self.repl_window)
+            self.__locked(self.__flush_replication)
+
+    def __when_durable(self, fn, partition=False):
+        """
+        Runs fn once everything committed so far is durable, in this
+        server's partition log with partition.
+        """
+        if partition:
+            self.part_durable.add(self.partitions[self.id].last_index, fn)
+        else:
+            self.durable.add(self.log.last_index, fn)
+        self.__release_durable()
+
+    def __release_durable(self):
+        backups = [s for s in self.servers if s != self.id]
+        needed = self.durable.needed(len(backups))
+        for fn in self.durable.pop_ready(self.log.durable_index(backups, needed)):
+            fn()
+
+        own = self.partitions[self.id]
+        backups = self.ring.successors(self.id)
+        needed = self.part_durable.needed(len(backups))
+        for fn in self.part_durable.pop_ready(own.durable_index(backups, needed)):
+            fn()
+
+    def __when_applied(self, server, fn):
+        """
+        Runs fn once server applied everything in the log so far.
+        """
+        if server is None or server == self.id:
+            fn()
             return
+        waiters = self.applied_waiters.setdefault(server, DurabilityWaiters())
+        waiters.add(self.log.last_index, fn)
+        self.__release_applied(server)
 
-        if name in self.groups:
-            self.__log(f"Error: Group already exists: {name}")
+    def __release_applied(self, server, everything=False):
+        waiters = self.applied_waiters.get(server)
+        if waiters is None:
             return
+        index = float("inf") if everything else self.log.acked.get(server, 0)
+        for fn in waiters.pop_ready(index):
+            fn()
 
-        # Create group
-        self.groups[name] = {
-            "owner": cid,
-            "members": {cid}
-        }
+    def __reply(self, addr, msg, group=None):
+        """
+        Answers a client request once its change is durable. With group,
+        also not before the group's owner applied it, so that the client
+        can turn to the owner right away.
+        """
+        # Reads from backups are at least this recent with the version
+        msg["version"] = self.log.last_index
+        send = lambda: self.__leader_send(addr, msg)
+        if group is None:
+            self.__when_durable(send)
+        else:
+            self.__when_durable(lambda: self.__when_applied(self.ring.owner(group), send))
+
+    def __owner_reply(self, addr, msg):
+        """
+        Answers a poll request once its change is durable in the partition.
+        """
+        self.__when_durable(lambda: self.__owner_send(addr, msg), partition=True)
+
+    def __apply_register(self, op):
+        # Logs written before tokens were signed
+        self.__note_client(op["id"], op)
+
+    def __note_client(self, cid, op):
+        if "addr" not in op:
+            return
+        addr = tuple(op["addr"])
+        self.clients[cid] = {"addr": addr, "codec": op["codec"]}
+        self.peer_codecs[addr] = op["codec"]
+
+    def __apply_create_group(self, op):
+        name = op["group"]
+        self.__note_client(op["owner"], op)
+        self.groups[name] = {"owner": op["owner"]}
+        self.catalogue.add(name)
+        self.membership.create(name)
+        self.membership.join(name, op["owner"])
 
         # Initialize sequence counter for group
         self.S[name] = 0
-        
-        self.__leader_send(addr, {"type": "CREATE_GROUP_OK", "group": name})
 
-    @requires_auth
+    def __apply_join_group(self, op):
+        self.__note_client(op["id"], op)
+        self.membership.join(op["group"], op["id"])
+
+    def __apply_leave_group(self, op):
+        self.membership.leave(op["group"], op["id"])
+
+    def __apply_subscribe(self, op):
+        self.__note_client(op["id"], op)
+        self.subscribers.add(op["id"])
+
+    def __apply_unsubscribe(self, op):
+        self.subscribers.discard(op["id"])
+
+    def __apply_start_vote(self, op):
+        """
+        Creates the vote and buffers its FO multicast:
+        - piggyback S_pg
+        - increment S_pg
+        Returns the key of the pending FO entry.
+        """
+        name = op["group"]
+        vote_id = op["vote_id"]
+        members = self.membership.members_of(name)
+        seq = self.S.get(name, 0)
+
+        # Create entry for the vote
+        self.votes[vote_id] = {
+            "group": name,
+            "topic": op["topic"],
+            "options": op["options"],
+            "close": op["close"],
+            "electorate": len(members),
+            "started": op.get("started"),
+            "tally": Tally(op["options"])
+        }
+
+        # Buffer pending requests
+        self.fo_pending[(name, seq)] = {
+            "pending": set(members),
+            "deadline": op["deadline"],
+            "msg": {
+                "S": seq,
+                # The group, not the owner: whoever owns it next carries on with S
+                "sender": name,
+                "type": "VOTE",
+                "vote_id": vote_id,
+                "group": name,
+                "topic": op["topic"],
+                "options": op["options"]
+            },
+            "vote_id": vote_id
+        }
+
+        # Increment S_pg
+        self.S[name] = seq + 1
+        return (name, seq)
+
+    def __apply_vote(self, op):
+        vote = self.votes.get(op["vote_id"])
+        if vote is None:
+            # A copy that missed the poll, the owner's next snapshot has it
+            return
+        vote["tally"].cast(op["id"], op["vote"])
+
+        fo_entry = self.fo_pending.get((op["group"], op["S"]))
+        if fo_entry is not None:
+            fo_entry["pending"].discard(op["id"])
+
+    def __apply_complete(self, op):
+        """
+        Closes a poll. Returns its vote ID, None if it was not pending.
+        """
+        entry = self.fo_pending.pop((op["group"], op["S"]), None)
+        if entry is None:
+            return None
+
+        vote = self.votes.get(entry["vote_id"])
+        if vote is None:
+            return None
+        winner = vote["tally"].winner()
+        vote["winner"] = winner if winner is not None else "No votes, no winner"
+        vote["reason"] = op["reason"]
+        return entry["vote_id"]
+
+    def __apply_ring(self, op):
+        old = self.ring
+        self.ring = HashRing(op["servers"])
+        if self.restoring:
+            # The leader puts a restarted server back on the ring
+            return
+        self.__log(f"Ring: {self.ring.nodes}")
+        self.__rebalance(old)
+        self.__update_workers()
+
+    def __register(self, msg, addr):
+        """
+        Any server hands out a session with the shared key, nothing is
+        replicated. A repeated REGISTER just gets a fresh token.
+        """
+        chosen = codec.negotiate(msg.get("codecs"))
+        token = self.signer.mint(msg["id"], chosen)
+        self.peer_codecs[addr] = chosen
+        self.__send(addr, {"type": "REGISTER_OK", "token": token, "codec": chosen})
+
+    def __create_group(self, msg, addr):
+        cid = msg["id"]
+        name = msg["group"]
+
+        if name in self.groups:
+            self.metrics.count("error.GROUP_EXISTS")
+            self.__log(f"Group already exists: {name}", ERROR)
+            return
+
+        self.__commit({"op": "create_group", "group": name, "owner": cid, **self.__session(msg, addr)})
+        self.__reply(addr, {"type": "CREATE_GROUP_OK", "group": name}, group=name)
+
     def __get_groups(self, msg, addr):
-        groups = [g for g in self.groups.keys()]
-        self.__leader_send(addr, {"type": "GET_GROUPS_OK", "groups": groups})
+        """
+        A page of group names after cursor, optionally only those starting
+        with prefix and containing contains. The reply's cursor asks for
+        the next page. A client sending the catalogue version it knows as
+        since gets not_modified, or the groups added since.
+        """
+        cursor = msg.get("cursor")
+        prefix = msg.get("prefix", "")
+        contains = msg.get("contains", "")
+        since = msg.get("since")
+        limit = msg.get("limit", GROUPS_PAGE)
+        if not (isinstance(prefix, str) and isinstance(contains, str) and isinstance(cursor, (str, type(None)))
+                and isinstance(since, (int, type(None))) and isinstance(limit, int) and limit > 0):
+            self.metrics.count("error.INVALID_QUERY")
+            self.send_error(addr, "INVALID_QUERY")
+            return
 
-    @requires_auth
-    def __join_group(self, msg, addr):
-        cid = msg.get("id")
-        name = msg.get("group")
+        reply = {
+            "type": "GET_GROUPS_OK",
+            "catalogue": self.catalogue.version,
+            "ring": self.ring.nodes,
+            "version": self.log.last_index
+        }
+        matches = lambda g: g.startswith(prefix) and contains in g
+
+        delta = self.catalogue.delta(since) if since is not None and cursor is None else None
+        if delta is not None:
+            added = [g for g in delta if matches(g)]
+            if not added:
+                reply["not_modified"] = True
+                self.metrics.count("catalogue.not_modified")
+                self.__send(addr, reply)
+                return
+            if len(added) <= limit and self.__listing_size(added) <= GROUPS_PAGE_BYTES:
+                reply.update(added=added, routes={g: self.ring.owner(g) for g in added})
+                self.metrics.count("catalogue.delta")
+                self.__send(addr, reply)
+                return
+            # Too much changed, the client starts over with the first page
+
+        groups = []
+        size = 0
+        for name in self.catalogue.select(cursor, prefix, contains):
+            n = self.__listing_size([name])
+            if len(groups) >= min(limit, GROUPS_PAGE) or (groups and size + n > GROUPS_PAGE_BYTES):
+                reply["cursor"] = groups[-1]
+                break
+            groups.append(name)
+            size += n
+        reply.update(groups=groups, routes={g: self.ring.owner(g) for g in groups})
+        self.metrics.count("catalogue.page")
+        self.__send(addr, reply)
+
+    def __subscribe(self, msg, addr):
+        cid = msg["id"]
+        if cid not in self.subscribers:
+            self.__commit({"op": "subscribe", "id": cid, **self.__session(msg, addr)})
+        # Changes after seq are pushed, the client lists what came before
+        self.__reply(addr, {"type": "SUBSCRIBE_OK", "seq": self.log.last_index, "catalogue": self.catalogue.version})
+
+    def __unsubscribe(self, msg, addr):
+        cid = msg["id"]
+        if cid in self.subscribers:
+            self.__commit({"op": "unsubscribe", "id": cid})
+        self.__reply(addr, {"type": "UNSUBSCRIBE_OK"})
+
+    def __schedule_feed(self):
+        if not self.feed_pending:
+            self.feed_pending = True
+            self.__call_later(FEED_WINDOW, self.__flush_feed)
+
+    def __flush_feed(self):
+        """
+        Leader: pushes the catalogue changes committed since the last push
+        to every subscriber.
+        """
+        self.feed_pending = False
+        if not self.is_leader or self.stop_event.is_set() or self.feed_sent >= self.log.last_index:
+            return
+        since, self.feed_sent = self.feed_sent, self.log.last_index
+        for msg in self.__feed(since, self.feed_sent):
+            self.__fan_out(list(self.subscribers), msg)
+            self.metrics.count("feed.pushed")
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
+    def __feed(self, since, until):
+        """
+        Yields FEED messages with the catalogue changes of the log entries
+        after since up to until, split to fit a datagram. Each names the
+        index the previous one ended at as prev and its own as seq, so a
+        client that missed one sees prev run ahead of what it has. Member
+        counts are current values, a change delivered twice does no harm.
+        """
+        entries = self.log.range(since + 1, until)
+        if entries is None:
+            # Trimmed from the log, the client lists the catalogue again
+            yield {"type": "FEED", "prev": since, "seq": until, "resync": True}
             return
 
-        if name is None:
-            self.__log(f"Error: Expected key 'group': {msg}")
+        prev = since
+        added = []
+        members = {}
+        size = 0
+        for index, op in entries:
+            if op["op"] not in FEED_OPS:
+                continue
+            group = op["group"]
+            created = op["op"] == "create_group"
+            name_size = len(json.dumps(group))
+            cost = (name_size if created else 0) + (0 if group in members else name_size + 8)
+
+            # Full: send what came before this entry, it starts the next frame
+            if size and size + cost > FEED_BYTES:
+                yield {"type": "FEED", "prev": prev, "seq": index - 1, "added": added, "members": members}
+                prev = index - 1
+                added = []
+                members = {}
+                size = 0
+                cost = (name_size if created else 0) + name_size + 8
+
+            if created:
+                added.append(group)
+            if group not in members:
+                members[group] = len(self.membership.members_of(group))
+            size += cost
+
+        yield {
+            "type": "FEED",
+            "prev": prev,
+            "seq": until,
+            "added": added,
+            "members": members,
+            "catalogue": self.catalogue.version
+        }
+
+    def __feed_fetch(self, msg, addr):
+        """
+        Repairs a gap in a subscriber's feed from the log.
+        """
+        since = msg["since"]
+        if not isinstance(since, int):
+            self.metrics.count("error.INVALID_QUERY")
+            self.send_error(addr, "INVALID_QUERY")
             return
+        self.metrics.count("feed.fetched")
+        until = self.log.last_index
+        for reply in self.__feed(min(since, until), until):
+            self.__send(addr, reply)
+
+    def __listing_size(self, groups):
+        # Each name is listed and keys its route, which is a server id
+        return sum(2 * len(json.dumps(g)) + len(json.dumps(self.ring.owner(g))) + 4 for g in groups)
+
+    def __join_group(self, msg, addr):
+        cid = msg["id"]
+        name = msg["group"]
 
         if name not in self.groups:
-            self.__log(f"Error: Group does not exist: {name}")
+            self.metrics.count("error.UNKNOWN_GROUP")
+            self.__log(f"Group does not exist: {name}", ERROR)
             return
 
-        self.groups[name]["members"].add(cid)
-        self.__leader_send(addr, {"type": "JOIN_GROUP_OK", "group": name})
+        if not self.membership.is_member(name, cid):
+            self.__commit({"op": "join_group", "group": name, "id": cid, **self.__session(msg, addr)})
+        self.__reply(addr, {"type": "JOIN_GROUP_OK", "group": name}, group=name)
 
-    @requires_auth
     def __joined_groups(self, msg, addr):
-        cid = msg.get("id")
+        cid = msg["id"]
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
-            return
+        groups = list(self.membership.groups_of(cid))
+        self.__send(addr, {"type": "JOINED_GROUPS_OK", "groups": groups, "version": self.log.last_index})
 
-        groups = [g for g in self.groups.keys() if cid in self.groups[g]["members"]]
-        self.__leader_send(addr, {"type": "JOINED_GROUPS_OK", "groups": groups})
-
-    @requires_auth
     def __leave_group(self, msg, addr):
-        cid = msg.get("id")
-        name = msg.get("group")
+        cid = msg["id"]
+        name = msg["group"]
+
+        if name not in self.groups:
+            self.metrics.count("error.UNKNOWN_GROUP")
+            self.__log(f"Group does not exist: {name}", ERROR)
+            return
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
+        if not self.membership.is_member(name, cid):
+            self.metrics.count("error.NOT_A_MEMBER")
+            self.__log(f"Not a member in group {name}", ERROR)
             return
 
-        if name is None:
-            self.__log(f"Error: Expected key 'group': {msg}")
+        self.__commit({"op": "leave_group", "group": name, "id": cid})
+        self.__reply(addr, {"type": "LEAVE_GROUP_OK", "group": name})
+
+    def __fo_multicast(self, key):
+        """
+        FO-multicast(g, m) of a buffered entry: B-multicast it and
+        retransmit until everybody acknowledged or the deadline passed.
+        """
+        entry = self.fo_pending[key]
+        self.__schedule_retransmits(key)
+        self.__fan_out(entry["pending"], entry["msg"])
+
+    def __start_vote(self, msg, addr):
+        cid = msg["id"]
+        name = msg["group"]
+        topic = msg["topic"]
+        options = msg["options"]
+        timeout = msg["timeout"]
+        close = msg.get("close", CLOSE_ALL)
+
+        # Checked before the poll is committed, the backups apply it as is
+        if not (isinstance(topic, str) and isinstance(options, list) and options
+                and all(isinstance(o, str) for o in options) and len(set(options)) == len(options)
+                and isinstance(timeout, (int, float)) and not isinstance(timeout, bool)
+                and 0 < timeout < float("inf")):
+            self.metrics.count("error.INVALID_POLL")
+            self.send_error(addr, "INVALID_POLL")
             return
 
         if name not in self.groups:
-            self.__log(f"Error: Group does not exist: {name}")
+            self.metrics.count("error.UNKNOWN_GROUP")
+            self.__log(f"Group does not exist: {name}", ERROR)
+            return
+
+        if not self.membership.is_member(name, cid):
+            self.metrics.count("error.NOT_A_MEMBER")
+            self.__log(f"Not a member in group {name}", ERROR)
             return
 
-        if cid not in self.groups[name]["members"]:
-            self.__log(f"Error: Not a member in group {name}")
+        if close not in CLOSE_POLICIES:
+            self.metrics.count("error.UNKNOWN_CLOSE_POLICY")
+            self.__log(f"Unknown close policy: {close}", ERROR)
             return
 
-        self.groups[name]["members"].remove(cid)
-        self.__leader_send(addr, {"type": "LEAVE_GROUP_OK", "group": name})
+        now = self.clock()
+        key = self.__commit({
+            "op": "start_vote",
+            "vote_id": str(uuid.uuid4()),
+            "group": name,
+            "topic": topic,
+            "options": options,
+            "close": close,
+            "started": now,
+            "deadline": now + timeout
+        })
+
+        self.__owner_reply(addr, {"type": "START_VOTE_OK", "group": name, "topic": topic, "options": options, "timeout": timeout, "close": close})
+
+        # FO reliable multicast it to the group
+        self.__when_durable(lambda: self.__fo_multicast(key), partition=True)
 
-    def __fo_multicast(self, group, payload, timeout):
+    def __vote_ack(self, msg, addr):
+        vote_id = msg["vote_id"]
+        group = msg["group"]
+        sender_seq = msg["S"]
+        key = (group, sender_seq)
+
+        # Find the pending FO multicast entry for that sequence
+        fo_entry = self.fo_pending.get(key)
+        if not fo_entry:
+            self.metrics.count("error.OUT_OF_ORDER_VOTE_ACK")
+            self.__log(f"Out-of-order or unknown VOTE_ACK for {group}, seq={sender_seq}", WARNING, "vote")
+            return
+
+        vote = self.votes.get(vote_id)
+        if vote is None or fo_entry["vote_id"] != vote_id:
+            self.metrics.count("error.UNKNOWN_VOTE")
+            self.__log(f"Unknown vote {vote_id} for {group}, seq={sender_seq}", ERROR)
+            return
+
+        # Only members the poll was sent to may vote
+        sender_id = msg["id"]
+        tally = vote["tally"]
+        if sender_id not in fo_entry["pending"] and sender_id not in tally.ballots:
+            self.metrics.count("error.NOT_IN_VOTE")
+            self.__log(f"{sender_id} is not part of vote {vote_id}", ERROR)
+            return
+
+        if not tally.is_option(msg["vote"]):
+            self.metrics.count("error.INVALID_OPTION")
+            self.__log(f"Invalid option for vote {vote_id}: {msg['vote']}", ERROR)
+            return
+
+        # A retransmitted ballot changes nothing
+        if tally.ballots.get(sender_id) == msg["vote"]:
+            return
+
+        self.__commit({
+            "op": "vote",
+            "group": group,
+            "S": sender_seq,
+            "vote_id": vote_id,
+            "id": sender_id,
+            "vote": msg["vote"]
+        })
+        self.retransmit.ack(key, sender_id)
+        self.__log("Vote acknowledged", DEBUG, "vote", vote_id=vote_id, voter=sender_id, vote=msg["vote"])
+
+        # Close early once the poll's close policy is satisfied
+        if tally.should_close(vote["close"], vote["electorate"]):
+            self.__fo_complete(key, vote["close"])
+
+    def __send_entries(self, server_id, start, end=None):
         """
-        FO-multicast(g, m):
-        - piggyback S_pg
-        - increment S_pg
-        - B-multicast
+        Sends log entries start..end to a server, in frames that fit a datagram.
         """
-        seq = self.S[group]
+        entries = self.log.range(start, end)
+        if entries is None:
+            # Trimmed from the log, the server needs the whole state
+            self.__send_snapshot(server_id)
+            return
 
-        msg = {
-            "S": seq,
-            "sender": self.id,
-            **payload
-        }
+        for frame in self.__frames(entries):
+            self.__send(server_id, frame)
 
-        pending = set(self.groups[group]["members"])
+    def __frames(self, entries, msg_type="REPL_APPEND"):
+        """
+        Splits log entries into REPL_APPEND (or PART_APPEND) messages that
+        fit a datagram. They carry the epoch, servers that joined after the
+        election learn it from them.
+        """
+        frame = []
+        size = 0
+        for entry in entries:
+            n = len(json.dumps(entry))
+            if frame and size + n > REPL_FRAME_BYTES:
+                yield {"type": msg_type, "id": self.id, "epoch": self.epoch, "entries": frame}
+                frame = []
+                size = 0
+            frame.append(entry)
+            size += n
+
+        if frame:
+            yield {"type": msg_type, "id": self.id, "epoch": self.epoch, "entries": frame}
+
+    def __repl_append(self, msg, addr):
+        if self.leader is None and not self.election_in_progress and not self.is_worker:
+            # Started after the election, whoever replicates to us leads
+            self.leader = msg["id"]
+            self.epoch = max(self.epoch, msg.get("epoch", 0))
+            self.__log(f"Following leader {self.leader} (epoch {self.epoch})")
+            self.__update_workers()
+        elif msg["id"] == self.leader:
+            self.epoch = max(self.epoch, msg.get("epoch", 0))
+
+        ready = []
+        for index, op in msg["entries"]:
+            ready.extend(self.log.receive(index, op))
+
+        for index, op in ready:
+            if self.is_worker and op.get("origin") == self.shard:
+                # Applied when this worker committed it
+                continue
+            self.__apply_entry(index, op)
+            self.__persist(index, op)
+            self.__mirror(index, op)
+        self.__sync_storage()
+
+        # Ask only for what is missing
+        gap = self.log.gap()
+        if gap is not None:
+            self.__send(msg["id"], {"type": "REPL_FETCH", "id": self.id, "from": gap[0], "to": gap[1]})
+
+        last = msg.get("last")
+        if last is not None and msg["id"] == self.leader and self.log.last_index >= last:
+            self.synced_at = self.clock()
+
+        self.__send(msg["id"], {"type": "REPL_ACK", "id": self.id, "index": self.log.last_index})
+
+    def __repl_ack(self, msg, addr):
+        backup = msg["id"]
+        index = msg["index"]
+        self.log.ack(backup, index)
+        if self.is_leader:
+            self.__release_durable()
+            self.__release_applied(backup)
+
+        sender = self.snapshots_out.get(backup)
+        if sender is not None and index >= sender.index:
+            del self.snapshots_out[backup]
+            self.__log(f"Snapshot {sender.snap_id} installed on {backup}")
+
+        if index > self.log.last_index:
+            if self.syncing:
+                # The old leader got further with this backup than with us
+                self.__send(backup, {"type": "REPL_FETCH", "id": self.id, "from": self.log.last_index + 1, "to": index})
+            else:
+                self.__log(f"{backup} is ahead of the leader ({index} > {self.log.last_index})", ERROR)
 
-        # Buffer pending requests
-        self.fo_pending[(group, seq)] = {
-            "pending": set(self.groups[group]["members"]),
-            "deadline": time.time() + timeout,
-            "msg": msg,
-            "vote_id": payload["vote_id"]
+    def __repl_fetch(self, msg, addr):
+        self.__send_entries(msg["id"], msg["from"], msg.get("to"))
+
+    def __repl_sync(self, msg, addr):
+        self.__send(msg["id"], {"type": "REPL_ACK", "id": self.id, "index": self.log.last_index})
+
+    def __snapshot_state(self):
+        """
+        The state replicated through the leader's log as of its current
+        index, in plain JSON types. Polls are in the partitions.
+        """
+        return {
+            "index": self.log.last_index,
+            "clients": self.clients,
+            "groups": self.groups,
+            "catalogue": self.catalogue.version,
+            "membership": self.membership.to_dict(),
+            "subscribers": sorted(self.subscribers),
+            "ring": self.ring.nodes
         }
 
-        # Increment S_pg
-        self.S[group] += 1
+    def __install_state(self, state):
+        self.clients = {}
+        self.peer_codecs = {}
+        for cid, client in state["clients"].items():
+            addr = tuple(client["addr"])
+            self.clients[cid] = {"addr": addr, "codec": client["codec"]}
+            self.peer_codecs[addr] = client["codec"]
+
+        self.groups = state["groups"]
+        self.catalogue = Catalogue(self.groups, state.get("catalogue", 0))
+        self.membership = Membership.from_dict(state["membership"])
+        self.subscribers = set(state.get("subscribers", ()))
+        for name in self.groups:
+            self.S.setdefault(name, 0)
+
+        servers = state.get("ring", [])
+        if servers != self.ring.nodes:
+            self.__apply_ring({"op": "ring", "servers": servers})
+
+    def __owned_groups(self):
+        return [g for g in self.groups if self.ring.owner(g) == self.id]
+
+    def __partition_state(self, groups):
+        """
+        Sequence numbers and open polls of groups, in plain JSON types.
+        """
+        state = {g: {"S": self.S.get(g, 0), "polls": []} for g in groups}
+        for (group, seq), entry in self.fo_pending.items():
+            vote = self.votes.get(entry["vote_id"])
+            if group not in state or vote is None:
+                continue
+            vote = dict(vote)
+            vote["tally"] = vote["tally"].to_dict()
+            state[group]["polls"].append({
+                "S": seq,
+                "pending": list(entry["pending"]),
+                "deadline": entry["deadline"],
+                "msg": entry["msg"],
+                "vote_id": entry["vote_id"],
+                "vote": vote
+            })
+        return state
+
+    def __install_partition(self, groups):
+        """
+        Replaces what is known about the polls of groups.
+        """
+        for key in [k for k in self.fo_pending if k[0] in groups]:
+            self.votes.pop(self.fo_pending.pop(key)["vote_id"], None)
+
+        for group, state in groups.items():
+            self.S[group] = state["S"]
+            for poll in state["polls"]:
+                vote = poll["vote"]
+                vote["tally"] = Tally.from_dict(vote["tally"])
+                self.votes[poll["vote_id"]] = vote
+                self.fo_pending[(group, poll["S"])] = {
+                    "pending": set(poll["pending"]),
+                    "deadline": poll["deadline"],
+                    "msg": poll["msg"],
+                    "vote_id": poll["vote_id"]
+                }
+
+    def __send_snapshot(self, server_id):
+        """
+        Streams a snapshot to a server. A transfer already under way is
+        resumed: SNAP_END makes the receiver ask for what it is missing.
+        """
+        sender = self.snapshots_out.get(server_id)
+        if sender is not None and sender.index >= self.log.first_index - 1:
+            self.__send(server_id, sender.end())
+            return
 
-        # B-multicast
-        for cid in pending:
-            self.__leader_send(self.clients[cid]["addr"], msg)
+        data = snapshot.encode(self.__snapshot_state())
+        sender = SnapshotSender(self.id, str(uuid.uuid4()), self.log.last_index, data)
+        self.snapshots_out[server_id] = sender
+        self.__log(f"Sending snapshot {sender.snap_id} at index {sender.index} to {server_id} ({len(sender.chunks)} chunks)")
+
+        self.__send(server_id, sender.begin())
+        for seq in range(len(sender.chunks)):
+            self.__send(server_id, sender.chunk(seq))
+        self.__send(server_id, sender.end())
+
+    def __snap_nack(self, msg, addr):
+        sender = self.snapshots_out.get(msg["id"])
+        if sender is None or sender.snap_id != msg["snap_id"]:
+            transfer = self.partition_out.get(msg["snap_id"])
+            if transfer is None:
+                return
+            sender = transfer[1]
+
+        # BEGIN again in case it was the one that got lost
+        self.__send(msg["id"], sender.begin())
+        for seq in msg["missing"]:
+            if 0 <= seq < len(sender.chunks):
+                self.__send(msg["id"], sender.chunk(seq))
+        self.__send(msg["id"], sender.end())
+
+    def __snap_begin(self, msg, addr):
+        if msg.get("partition") is not None:
+            if msg["snap_id"] not in self.partition_in:
+                self.partition_in[msg["snap_id"]] = SnapshotReceiver(msg)
+            return
 
-    @requires_auth
-    def __start_vote(self, msg, addr):
-        cid = msg.get("id")
-        name = msg.get("group")
-        topic = msg.get("topic")
-        options = msg.get("options")
-        timeout = msg.get("timeout")
+        if self.is_leader and not self.syncing and not self.is_worker:
+            return
 
-        if cid is None:
-            self.__log(f"Error: Expected key 'id': {msg}")
+        if self.snapshot_in is not None and self.snapshot_in.snap_id == msg["snap_id"]:
             return
 
-        if options is None:
-            self.__log(f"Error: Expected key 'options': {msg}")
+        if msg["index"] <= self.log.last_index:
+            # Already past it
+            self.__send(msg["id"], {"type": "REPL_ACK", "id": self.id, "index": self.log.last_index})
             return
 
-        if timeout is None:
-            self.__log(f"Error: Expected key 'timeout': {msg}")
+        self.snapshot_in = SnapshotReceiver(msg)
+
+    def __receiver(self, snap_id):
+        if self.snapshot_in is not None and self.snapshot_in.snap_id == snap_id:
+            return self.snapshot_in
+        return self.partition_in.get(snap_id)
+
+    def __snap_chunk(self, msg, addr):
+        receiver = self.__receiver(msg["snap_id"])
+        if receiver is None:
             return
 
-        if topic is None:
-            self.__log(f"Error: Expected key 'timeout': {msg}")
+        if not receiver.add(msg):
+            self.metrics.count("error.CORRUPT_CHUNK")
+            self.__log(f"Dropping corrupt chunk {msg['seq']} of snapshot {msg['snap_id']}", ERROR)
+
+    def __snap_end(self, msg, addr):
+        receiver = self.__receiver(msg["snap_id"])
+        if receiver is None:
+            # BEGIN got lost, the NACK brings it back
+            self.__send(msg["id"], {"type": "SNAP_NACK", "id": self.id, "snap_id": msg["snap_id"], "missing": []})
             return
 
-        if name is None:
-            self.__log(f"Error: Expected key 'group': {msg}")
+        missing = receiver.missing()
+        if missing:
+            self.__send(msg["id"], {"type": "SNAP_NACK", "id": self.id, "snap_id": receiver.snap_id, "missing": missing})
             return
 
-        if name not in self.groups:
-            self.__log(f"Error: Group does not exist: {name}")
+        data = receiver.assemble()
+        if data is None:
+            self.__log(f"Snapshot {receiver.snap_id} failed its checksum, fetching it again", ERROR)
+            receiver.chunks = {}
+            self.__send(msg["id"], {"type": "SNAP_NACK", "id": self.id, "snap_id": receiver.snap_id, "missing": receiver.missing()})
             return
 
-        if cid not in self.groups[name]["members"]:
-            self.__log(f"Error: Not a member in group {name}")
+        if receiver.partition is not None:
+            del self.partition_in[receiver.snap_id]
+            index = self.__install_partition_snapshot(receiver, snapshot.decode(data))
+            self.__send(msg["id"], {"type": "PART_ACK", "id": self.id, "index": index, "snap_id": receiver.snap_id})
             return
 
-        self.__leader_send(addr, {"type": "START_VOTE_OK", "group": name, "topic": topic, "options": options, "timeout": timeout})
+        self.snapshot_in = None
+        state = snapshot.decode(data)
+        self.__install_state(state)
+        if self.storage is not None:
+            self.storage.snapshot(receiver.index, state)
+        for index, op in self.log.reset(receiver.index):
+            self.__apply_entry(index, op)
+            self.__persist(index, op)
+        self.__sync_storage()
+        self.__sync_workers()
+        self.__log(f"Installed snapshot {receiver.snap_id} at index {receiver.index}")
+
+        self.__send(msg["id"], {"type": "REPL_ACK", "id": self.id, "index": self.log.last_index})
+
+    def __repair_backups(self):
+        """
+        Leader: resends the tail of the log to backups that are behind
+        and asks unknown backups for their position.
+        """
+        for server in self.servers:
+            if server == self.id:
+                continue
+            acked = self.log.acked.get(server)
+            if acked is None:
+                self.__send(server, {"type": "REPL_SYNC", "id": self.id, "index": self.log.last_index})
+            elif acked < self.log.last_index:
+                self.__send_entries(server, acked + 1)
 
-        vote_id = str(uuid.uuid4())
+    def __send_beat(self):
+        """
+        Leader: tells backups how far the log was replicated, an empty
+        REPL_APPEND. Backups that have it all answer reads for a while.
+        """
+        addrs = [self.__addr(s) for s in self.servers if s != self.id]
+        if addrs:
+            beat = {"type": "REPL_APPEND", "id": self.id, "entries": [], "last": self.replicated}
+            self.fanout.send(codec.encode(beat), addrs)
 
-        # Create entry for the vote
-        self.votes[vote_id] = {
-            "group": name,
-            "topic": topic,
-            "options": options,
-            "votes": []
-        }
+    def __staleness(self):
+        if self.is_leader:
+            return 0.0
+        if self.synced_at is None:
+            return None
+        return self.clock() - self.synced_at
 
-        # Replicate vote state to other servers
+    def __fresh(self, msg):
+        """
+        Whether this server may answer a read: the leader always, a
+        backup within the staleness bound that has caught up with what
+        the client has already seen.
+        """
         if self.is_leader:
-            for server in self.servers:
-                if server != self.id:
-                    self.__leader_send(server, {
-                        "type": "REPL_VOTE",
-                        "vote_id": vote_id,
-                        "group": name,
-                        "topic": topic,
-                        "options": options,
-                        "timeout": timeout,
-                        "votes": []
-                    })
+            return True
+        staleness = self.__staleness()
+        if staleness is None or staleness > self.read_staleness:
+            return False
+        version = msg.get("min_version", 0)
+        return isinstance(version, int) and version <= self.log.last_index
+
+    def __become_leader(self):
+        """
+        Before accepting changes the new leader collects log entries the
+        old leader only got to some of the backups.
+        """
+        self.syncing = True
+        self.replicated = self.log.last_index
+        for server in self.servers:
+            if server != self.id:
+                self.__send(server, {"type": "REPL_SYNC", "id": self.id, "index": self.log.last_index})
+        self.__call_later(SYNC_TIMEOUT, self.__finish_sync)
+
+    def __finish_sync(self):
+        if not self.is_leader or not self.syncing:
+            return
+        self.syncing = False
+        self.__log(f"Leader in sync at log index {self.log.last_index}")
 
-        # FO reliable multicast it to the group
-        payload = {
-            "type": "VOTE",
-            "vote_id": vote_id,
-            "group": name,
-            "topic": topic,
-            "options": options
-        }
-        self.__fo_multicast(name, payload, timeout)
+        self.__reschedule_retransmits()
+        self.__update_ring()
+        self.__tell_clients_about_new_leader()
+        self.__update_workers()
 
-    @requires_auth
-    def __vote_ack(self, msg, addr):
-        vote_id = msg.get("vote_id")
-        group = msg.get("group")
-        sender_seq = msg.get("S")
+        # The old leader may have died before pushing its last changes
+        self.feed_sent = max(self.log.first_index - 1, self.log.last_index - FEED_REPLAY)
+        if self.subscribers:
+            self.__schedule_feed()
+
+        backlog, self.sync_backlog = self.sync_backlog, []
+        for msg, addr in backlog:
+            self.__handle_message(msg, addr)
+
+    def __serving(self):
+        """
+        Whether this server leads the polls of its groups: it is on the
+        ring and not in the middle of an election.
+        """
+        if self.is_worker:
+            return self.is_leader
+        return self.leader is not None and not self.election_in_progress and self.id in self.ring
+
+    def __holds(self, group):
+        """
+        Whether this server owns group or keeps a copy of it.
+        """
+        owner = self.ring.owner(group)
+        return owner == self.id or self.id in self.ring.successors(owner)
 
-        if not vote_id or not group or sender_seq is None:
-            self.__log(f"Error in VOTE_ACK: Missing vote_id, group, or S")
+    def __update_ring(self):
+        """
+        Leader: puts servers on the ring once they caught up with the log
+        and takes off those that are gone. Returns True if it changed.
+        """
+        current = set(self.ring.nodes)
+        servers = set()
+        for server in self.servers:
+            lag = self.log.lag(server)
+            if server == self.id or server in current or (lag is not None and lag <= RING_JOIN_LAG):
+                servers.add(server)
+
+        if servers == current:
+            return False
+        self.__commit({"op": "ring", "servers": sorted(servers)})
+        return True
+
+    def __rebalance(self, old):
+        """
+        After a ring change: hands the polls of groups this server gave
+        away to their new owner, takes over those of a failed server and
+        waits for the state of groups taken from a live one.
+        """
+        if self.is_worker:
+            self.__reschedule_retransmits()
             return
 
-        # Find the pending FO multicast entry for that sequence
-        fo_entry = self.fo_pending.get((group, sender_seq))
-        if not fo_entry:
-            self.__log(f"Out-of-order or unknown VOTE_ACK for {group}, seq={sender_seq}")
+        moving = defaultdict(list)
+        adopted = []
+        early = self.early_handoffs
+        for group in self.groups:
+            before = old.owner(group)
+            after = self.ring.owner(group)
+            if before == after:
+                continue
+            if before == self.id:
+                moving[after].append(group)
+            elif after == self.id and before in self.ring and group not in early:
+                self.handoffs[group] = self.clock() + HANDOFF_TIMEOUT
+            elif after == self.id:
+                # This server was its backup, or the old owner was quicker
+                adopted.append(group)
+
+        if self.id in self.ring:
+            # Taken over now, or meant for a ring this one replaced
+            self.early_handoffs = set()
+
+        for server, groups in moving.items():
+            self.__send_partition(server, groups)
+        if self.handoffs:
+            self.__call_later(HANDOFF_TIMEOUT, self.__finish_handoffs)
+
+        # Copies of groups this server no longer backs up
+        for key in [k for k in self.fo_pending if not self.__holds(k[0]) and k[0] not in early]:
+            self.votes.pop(self.fo_pending.pop(key)["vote_id"], None)
+        for owner in list(self.partitions):
+            if owner != self.id and self.id not in self.ring.successors(owner):
+                del self.partitions[owner]
+
+        # Transfers and acks of servers that are no longer backups
+        backups = self.ring.successors(self.id)
+        own = self.partitions[self.id]
+        for server in list(own.acked):
+            if server not in backups:
+                del own.acked[server]
+        for snap_id, (server, _, _) in list(self.partition_out.items()):
+            if server not in self.ring:
+                del self.partition_out[snap_id]
+        for server in list(self.applied_waiters):
+            if server not in self.ring:
+                self.__release_applied(server, everything=True)
+
+        self.__reschedule_retransmits()
+        if adopted:
+            self.__adopt(adopted)
+        else:
+            self.__repair_partition()
+
+    def __adopt(self, groups):
+        """
+        Takes over the polls of groups that moved to this server.
+        """
+        self.__reschedule_retransmits()
+        if self.is_worker:
             return
+        self.__log(f"Took over {len(groups)} groups")
+
+        # Backups and workers have not seen these groups yet
+        own = self.partitions[self.id]
+        own.acked.clear()
+        for snap_id, (_, _, seed) in list(self.partition_out.items()):
+            if seed:
+                del self.partition_out[snap_id]
+        self.__repair_partition()
+        self.__sync_worker_partitions(groups)
+        if self.partition_storage is not None:
+            self.partition_storage.snapshot(own.last_index, {"groups": self.__partition_state(self.__owned_groups())})
+
+        backlog, self.handoff_backlog = self.handoff_backlog, []
+        for msg, addr in backlog:
+            if msg.get("group") in self.handoffs:
+                self.handoff_backlog.append((msg, addr))
+            else:
+                self.__handle_local(msg, addr)
 
-        # Remove sender from pending
-        sender_id = msg.get("id")
-        if sender_id in fo_entry["pending"]:
-            fo_entry["pending"].remove(sender_id)
+    def __finish_handoffs(self):
+        now = self.clock()
+        late = [g for g, deadline in self.handoffs.items() if deadline <= now]
+        if not late:
+            return
+        for group in late:
+            del self.handoffs[group]
+        self.__log(f"No state arrived for {len(late)} groups, taking them over as they are", WARNING)
+        self.__adopt(late)
 
-        # Record the vote
-        self.votes[vote_id]["votes"].append(msg)
-        self.__log(f"Vote Acknowledged: {msg}")
+    def __send_partition(self, server_id, groups=None):
+        """
+        Streams the polls of this server's groups to a backup, or those of
+        groups handed over to their new owner. A backup's transfer already
+        under way is resumed.
+        """
+        seed = groups is None
+        if seed:
+            for server, sender, is_seed in self.partition_out.values():
+                if server == server_id and is_seed:
+                    self.__send(server_id, sender.end())
+                    return
+            groups = self.__owned_groups()
+
+        own = self.partitions[self.id]
+        data = snapshot.encode({"groups": self.__partition_state(groups), "seed": seed})
+        sender = SnapshotSender(self.id, str(uuid.uuid4()), own.last_index, data, partition=self.id)
+        self.partition_out[sender.snap_id] = (server_id, sender, seed)
+        self.__log(f"Sending {'partition' if seed else 'handoff'} {sender.snap_id} of {len(groups)} groups to {server_id}")
+
+        self.__send(server_id, sender.begin())
+        for seq in range(len(sender.chunks)):
+            self.__send(server_id, sender.chunk(seq))
+        self.__send(server_id, sender.end())
+
+    def __install_partition_snapshot(self, receiver, state):
+        """
+        Installs the polls another server sent. Returns the index to
+        acknowledge.
+        """
+        owner = receiver.partition
+        self.__install_partition(state["groups"])
+
+        log = self.partitions.get(owner)
+        if state["seed"]:
+            # A copy of the owner's partition, continued by its log
+            log = self.partitions.setdefault(owner, ReplicationLog())
+            for index, op in log.reset(receiver.index):
+                self.__apply_entry(index, op)
+        self.__log(f"Installed {'partition' if state['seed'] else 'handoff'} {receiver.snap_id} "
+                   f"of {len(state['groups'])} groups from {owner}")
+
+        adopted = [g for g in state["groups"] if self.ring.owner(g) == self.id]
+        if not state["seed"]:
+            self.early_handoffs.update(g for g in state["groups"] if g not in adopted)
+        for group in adopted:
+            self.handoffs.pop(group, None)
+        if adopted:
+            self.__adopt(adopted)
+        return log.last_index if log is not None else receiver.index
+
+    def __repair_partition(self):
+        """
+        Resends the tail of this server's partition log to backups that
+        are behind and seeds new backups with a snapshot.
+        """
+        if self.is_worker:
+            return
+        own = self.partitions[self.id]
+        for backup in self.ring.successors(self.id):
+            acked = own.acked.get(backup)
+            if acked is None:
+                self.__send_partition(backup)
+            elif acked < own.last_index:
+                self.__send_partition_entries(backup, acked + 1)
+
+    def __send_partition_entries(self, server_id, start, end=None):
+        entries = self.partitions[self.id].range(start, end)
+        if entries is None:
+            # Trimmed from the log, the backup needs a new copy
+            self.partitions[self.id].acked.pop(server_id, None)
+            self.__send_partition(server_id)
+            return
 
-    def __handle_message(self, msg, addr):
-        t = msg.get("type")
-        if t == "HS_ELECTION":
-            self.__log("Got: HS_ELECTION")
-            self.__hs_election(msg)
-        elif t == "HS_REPLY":
-            self.__log("Got: HS_REPLY")
-            self.__hs_reply(msg)
-        elif t == "HS_LEADER":
-            self.__log("Got: HS_LEADER")
-            self.__hs_leader(msg)
-        elif t == "REGISTER":
-            self.__log("Got: REGISTER")
-            self.__register(msg, addr)
-        elif t == "CREATE_GROUP":
-            self.__log("Got: CREATE_GROUP")
-            self.__create_group(msg, addr)
-        elif t == "GET_GROUPS":
-            self.__log("Got: GET_GROUPS")
-            self.__get_groups(msg, addr)
-        elif t == "JOIN_GROUP":
-            self.__log("Got: JOIN_GROUP")
-            self.__join_group(msg, addr)
-        elif t == "JOINED_GROUPS":
-            self.__log("Got: JOINED_GROUPS")
-            self.__joined_groups(msg, addr)
-        elif t == "LEAVE_GROUP":
-            self.__log("Got: LEAVE_GROUP")
-            self.__leave_group(msg, addr)
-        elif t == "START_VOTE":
-            self.__log("Got: START_VOTE")
-            self.__start_vote(msg, addr)
-        elif t == "VOTE_ACK":
-            self.__log("Got: VOTE_ACK")
-            self.__vote_ack(msg, addr)
-        elif t == "REPL_REGISTER":
-            self.__log("Got: REPL_REGISTER")
-            cid = msg["id"]
-            token = msg["token"]
-            addr = tuple(msg["addr"])
-
-            # Replicate clients
-            self.clients[cid] = {"token": token, "addr": addr}
-        elif t == "REPL_VOTE":
-            self.__log("Got: REPL_VOTE")
-            vote_id = msg.get("vote_id")
-            group = msg.get("group")
-            topic = msg.get("topic")
-            options = msg.get("options")
-            timeout = msg.get("timeout")
-            votes = msg.get("votes", [])
-
-            # Replicate the vote in local state
-            self.votes[vote_id] = {
-                "group": group,
-                "topic": topic,
-                "options": options,
-                "votes": votes
-            }
+        for frame in self.__frames(entries, "PART_APPEND"):
+            self.__send(server_id, frame)
 
-            # Now add this vote to the pending list for FO multicast
-            if group not in self.S:
-                self.S[group]
-
-            # Create an entry in the pending queue for this vote
-            self.fo_pending[(group, self.S[group])] = {
-                "pending": set(self.groups[group]["members"]),
-                "deadline": time.time() + timeout,
-                "msg": {
-                    "type": "VOTE",
-                    "vote_id": vote_id,
-                    "group": group,
-                    "topic": topic,
-                    "options": options
-                },
-                "vote_id": vote_id
-            }
+    def __part_append(self, msg, addr):
+        owner = msg["id"]
+        log = self.partitions.get(owner)
+        if log is None:
+            # Nothing to apply them to before the owner's snapshot arrived
+            return
+
+        ready = []
+        for index, op in msg["entries"]:
+            ready.extend(log.receive(index, op))
+        for index, op in ready:
+            self.__apply_entry(index, op)
 
-            # Increment the sequence number after adding it to pending
-            self.S[group] += 1
-        elif t == "REPL_STATE":
-            self.__log("Got: REPL_STATE")
-            self.__replicate_state(msg)
-        elif t == "HEARTBEAT":
-            # self.__log("Got: HEARTBEAT")
-            self.__send(addr, {"type": "HEARTBEAT_ACK", "id": self.id})
-        elif t == "HEARTBEAT_ACK":
-            # self.__log("Got: HEARTBEAT_ACK")
-            sender_id = msg.get("id")
-            if sender_id == self.left:
-                # Ackknowledge heartbeat
-                self.last_heartbeat_time = time.time()
-                self.heartbeat_ack_received = True
+        gap = log.gap()
+        if gap is not None:
+            self.__send(owner, {"type": "PART_FETCH", "id": self.id, "from": gap[0], "to": gap[1]})
+
+        self.__send(owner, {"type": "PART_ACK", "id": self.id, "index": log.last_index})
+
+    def __part_ack(self, msg, addr):
+        backup = msg["id"]
+        transfer = self.partition_out.pop(msg.get("snap_id"), None)
+        if transfer is not None and not transfer[2]:
+            # A handoff, the new owner is not necessarily a backup
+            return
+        if backup in self.ring.successors(self.id):
+            self.partitions[self.id].ack(backup, msg["index"])
+            self.__release_durable()
+
+    def __part_fetch(self, msg, addr):
+        self.__send_partition_entries(msg["id"], msg["from"], msg.get("to"))
+
+    def __forward(self, msg, addr):
+        """
+        Passes a poll request on to the server owning its group.
+        Returns False if this server handles it itself.
+        """
+        group = msg.get("group")
+        if msg.get("type") not in PARTITIONED_TYPES or not isinstance(group, str):
+            return False
+        owner = self.ring.owner(group)
+        if owner is None or owner == self.id:
+            return False
+
+        self.__send(owner, {"type": "ROUTED", "id": self.id, "addr": list(addr), "msg": msg})
+        self.metrics.count("partition.forwarded")
+        return True
+
+    def __routed(self, msg, addr):
+        # Never forwarded again, the client gets the new ring soon enough
+        inner = msg["msg"]
+        if inner.get("type") in READ_TYPES and not self.__fresh(inner):
+            self.metrics.count("error.STALE_READ")
+            return
+        self.__handle_local(inner, tuple(msg["addr"]))
+
+    def __handle_local(self, msg, addr):
+        """
+        Handles a client request on this server, or the worker owning it.
+        """
+        if self.link is not None and self.__route(codec.encode(msg), msg, addr):
+            return
+        self.__handle_message(msg, addr)
+
+    def __heartbeat(self, msg, addr):
+        self.__gossip(msg)
+        ack = {"type": "HEARTBEAT_ACK", "id": self.id, "inc": self.servers.incarnation, "updates": self.servers.updates()}
+        state = self.servers.state(msg["id"])
+        if state is not None and state[0] != ALIVE:
+            # The sender may not know what others think of it, and refute
+            ack["updates"].append([msg["id"], state[0], state[1]])
+        for key in ("sent", "for"):
+            if key in msg:
+                ack[key] = msg[key]
+        self.__send(addr, ack)
+
+    def __heartbeat_ack(self, msg, addr):
+        self.__gossip(msg)
+        sender_id = msg.get("id")
+        relay = msg.get("for")
+        if relay is not None and relay != self.id:
+            # Probed on behalf of relay, which could not reach the sender
+            if relay in self.servers:
+                self.__send(relay, {"type": "HEARTBEAT_ACK", "id": sender_id, "inc": msg.get("inc")})
+            return
+
+        now = self.clock()
+        if isinstance(msg.get("sent"), (int, float)):
+            self.metrics.record("heartbeat.rtt", now - msg["sent"])
+
+        self.__alive_again(sender_id)
+        if sender_id == self.left and self.detector.peer == sender_id:
+            self.detector.heartbeat(now)
+            self.suspected = False
+            self.declared = False
+
+    def __alive_again(self, sid):
+        declared = self.crashes.pop(sid, None)
+        if declared is not None and self.clock() - declared < FALSE_POSITIVE_WINDOW:
+            self.metrics.count("failure.false_positive")
+            self.__log(f"{sid} was declared crashed but is alive", WARNING)
+
+    def __ping_req(self, msg, addr):
+        # Only servers get probed, this is no reflector
+        if msg["target"] in self.servers and msg["target"] != self.id:
+            self.__send(msg["target"], dict(self.__heartbeat_msg(), **{"for": msg["id"]}))
+
+    def __owns(self, group):
+        if self.ring.owner(group) != self.id:
+            return False
+        return self.shards == 1 or shard_of(group, self.shards) == self.shard
+
+    def __owner(self, msg):
+        group = msg.get("group")
+        if msg.get("type") not in SHARDED_TYPES or not isinstance(group, str):
+            return 0
+        if self.ring.owner(group) != self.id or group in self.handoffs:
+            # The main process passes it on or holds it back
+            return 0
+        return shard_of(group, self.shards)
+
+    def __route(self, data, msg, addr):
+        """
+        Hands a datagram to the shard that owns it.
+        Returns False if this process handles it itself.
+        """
+        owner = self.__owner(msg)
+        if self.is_worker:
+            known = self.is_leader and msg.get("id") in self.clients
+            if known and owner == self.shard:
+                return False
+            # Unknown clients go through the main process, which learns
+            # about them before this worker's mirror does
+            target = owner if known and owner != 0 else 0
+        else:
+            if not self.__serving() or owner == 0:
+                return False
+            target = owner
+
+        self.link.send_datagram(target, data, addr)
+        self.metrics.count("shard.forwarded")
+        return True
+
+    def __on_link(self, kind, payload, addr):
+        if kind == DATAGRAM:
+            # Datagrams forwarded to a worker are never routed on again
+            self.__on_message(payload, addr, routed=self.is_worker)
+            return
+
+        handler = self.link_handlers.get(payload.get("type"))
+        if handler is not None:
+            handler(payload)
         else:
-            self.__log(f"Error: Got invalid message: {msg}")
+            self.dispatcher.dispatch(payload, None)
+
+    def __link_handling(self):
+        while not self.stop_event.is_set():
+            try:
+                kind, payload, addr = self.link.recv()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                self.__log(f"Invalid local message: {e}", WARNING)
+                continue
+            self.__locked(self.__on_link, kind, payload, addr)
 
-        # Leader multicasts all incoming requests to 
-        # non leader servers so that they can continue
-        # in the case he fails / crashes.
-        if self.is_leader and t not in ["HS_ELECTION", "HS_REPLY", "HS_LEADER", "REGISTER", "START_VOTE", "REPL_STATE"]:
-            for server in self.servers:
-                if server != self.id:
-                    self.__leader_send(server, msg)
+    def __on_link_readable(self):
+        while True:
+            try:
+                kind, payload, addr = self.link.recv()
+            except BlockingIOError:
+                return
+            except Exception as e:
+                self.__log(f"Invalid local message: {e}", WARNING)
+                return
+            self.__on_link(kind, payload, addr)
+
+    def __mirror(self, index, op):
+        """
+        Main process: passes every applied entry on to the workers.
+        """
+        if self.link is None or self.is_worker:
+            return
+        msg = {"type": "REPL_APPEND", "id": self.id, "entries": [[index, op]]}
+        for shard in range(1, self.shards):
+            self.link.send_control(shard, msg)
+
+    def __stream_to_workers(self, sender, shard=None):
+        for k in ([shard] if shard is not None else range(1, self.shards)):
+            self.link.send_control(k, sender.begin())
+            for seq in range(len(sender.chunks)):
+                self.link.send_control(k, sender.chunk(seq))
+            self.link.send_control(k, sender.end())
+
+    def __sync_workers(self, shard=None):
+        """
+        Main process: replaces the state of one or all workers with a snapshot.
+        """
+        if self.link is None or self.is_worker:
+            return
+        state = self.__snapshot_state()
+        self.__stream_to_workers(SnapshotSender(self.id, str(uuid.uuid4()), state["index"], snapshot.encode(state)), shard)
+        self.__update_workers()
+
+    def __sync_worker_partitions(self, groups, shard=None):
+        """
+        Main process: hands the polls of groups to the workers owning them.
+        """
+        if self.link is None or self.is_worker:
+            return
+        data = snapshot.encode({"groups": self.__partition_state(groups), "seed": False})
+        sender = SnapshotSender(self.id, str(uuid.uuid4()), self.partitions[self.id].last_index, data, partition=self.id)
+        self.__stream_to_workers(sender, shard)
+
+    def __update_workers(self):
+        if self.link is None or self.is_worker:
+            return
+        msg = {"type": "SHARD_LEADER", "leader": self.leader, "epoch": self.epoch, "active": self.__serving()}
+        for shard in range(1, self.shards):
+            self.link.send_control(shard, msg)
+
+    def __shard_hello(self, msg):
+        self.__log(f"Worker {msg['shard']} started")
+        self.__sync_workers(msg["shard"])
+        self.__sync_worker_partitions(self.__owned_groups(), msg["shard"])
+
+    def __shard_commit(self, msg):
+        self.__commit(msg["op"])
+
+    def __shard_leader(self, msg):
+        self.leader = msg["leader"]
+        self.epoch = msg.get("epoch", self.epoch)
+        if msg["active"] and not self.is_leader:
+            self.is_leader = True
+            self.__reschedule_retransmits()
+            self.__log(f"Serving shard {self.shard} of {self.shards}")
+        elif not msg["active"] and self.is_leader:
+            self.is_leader = False
+            self.retransmit = RetransmitScheduler(rng=self.rng)
+            self.durable.clear()
+
+    def __stats(self, msg, addr):
+        # Only for monitoring tools on this host
+        if not (addr[0].startswith("127.") or addr[0] == self.ip):
+            self.metrics.count("error.STATS_DENIED")
+            return
+        self.__send(addr, {"type": "STATS_OK", "id": self.id, "metrics": self.metrics.snapshot()})
+
+    def __handle_message(self, msg, addr):
+        handler = self.dispatcher.handlers.get(msg.get("type"))
+        if handler is not None and handler.mutates and msg.get("type") in PARTITIONED_TYPES:
+            # Polls only change on the server owning the group
+            group = msg.get("group")
+            if not self.__serving():
+                self.metrics.count("error.NOT_SERVING")
+                self.__log(f"Ignoring {msg['type']}, not serving", WARNING, "msg")
+                return
+            if isinstance(group, str) and not self.__owns(group):
+                self.metrics.count("error.NOT_OWNER")
+                self.__log(f"Redirecting {msg['type']}, not the owner of {group}", WARNING, "msg")
+                owner = self.ring.owner(group)
+                if owner != self.id:
+                    self.__redirect(addr, msg["type"], owner)
+                return
+            if group in self.handoffs:
+                self.handoff_backlog.append((msg, addr))
+                return
+        elif msg.get("type") in READ_TYPES and not self.__fresh(msg):
+            # Too stale to answer, the leader does
+            if self.leader is not None and self.leader != self.id:
+                self.__send(self.leader, {"type": "ROUTED", "id": self.id, "addr": list(addr), "msg": msg})
+                self.metrics.count("read.forwarded")
+            return
+        elif handler is not None and handler.mutates:
+            # State only changes through the leader's log
+            if not self.is_leader:
+                self.metrics.count("error.NOT_LEADER")
+                self.__log(f"Redirecting {msg['type']}, not the leader", WARNING, "msg")
+                self.__redirect(addr, msg["type"])
+                return
+            if self.syncing:
+                self.sync_backlog.append((msg, addr))
+                return
+
+        self.dispatcher.dispatch(msg, addr)
+
+    def __on_message(self, data, addr, routed=False):
+        if data:
+            try:
+                msg = codec.decode(data)
+                if self.link is not None and not routed and self.__route(data, msg, addr):
+                    return
+                if not routed and self.__forward(msg, addr):
+                    return
+                self.__handle_message(msg, addr)
+            except Exception as e:
+                self.metrics.count("error.INVALID_MESSAGE")
+                self.__log(f"Invalid message: {e}", WARNING, "msg")
+
+    def __on_socket_error(self, exc):
+        self.__log(f"Socket error: {exc}", WARNING)
 
     def __message_handling(self):
         while not self.stop_event.is_set():
             try:
                 data, addr = self.sock.recvfrom(BUF)
-                if data:
-                    try:
-                        msg = json.loads(data.decode())
-                        self.__handle_message(msg, addr)
-                    except Exception as e:
-                        self.__log(f"Invalid message: {e}")
+                self.__locked(self.__on_message, data, addr)
             except:
                 continue
 
@@ -732,105 +2445,373 @@ class Server:
             self.__log(f"Vote {vote_id} not found")
             return
 
-        # Select winner
-        winner = "No votes, no winner"
-        if len(vote["votes"]) > 0:
-            vote_counts = defaultdict(int)
-            for vote_entry in vote["votes"]:
-                vote_counts[vote_entry["vote"]] += 1
-
-            winner = max(vote_counts, key=vote_counts.get)
-
         # Announce the result via group multicast
         result_msg = {
             "type": "VOTE_RESULT",
             "vote_id": vote_id,
             "group": vote["group"],
             "topic": vote["topic"],
-            "winner": winner
+            "winner": vote["winner"],
+            "reason": vote["reason"]
         }
 
-        for cid in self.groups[vote["group"]]["members"]:
-            self.__leader_send(self.clients[cid]["addr"], result_msg)
+        self.__fan_out(self.membership.members_of(vote["group"]), result_msg)
 
-    def __fo_retransmit_loop(self):
-        while not self.stop_event.is_set():
-            now = time.time()
-            finished = []
+    def __schedule_retransmits(self, key):
+        entry = self.fo_pending[key]
+        self.retransmit.add(key, entry["pending"], entry["deadline"], self.clock())
+        self.__wake_retransmit()
 
-            for key, entry in list(self.fo_pending.items()):
-                group, seq = key
+    def __reschedule_retransmits(self):
+        self.retransmit = RetransmitScheduler(rng=self.rng)
+        for key in self.fo_pending:
+            if self.__owns(key[0]):
+                self.__schedule_retransmits(key)
 
-                if now > entry["deadline"] or not entry["pending"]:
-                    finished.append(key)
-                    continue
+    def __fo_complete(self, key, reason="timeout"):
+        if not self.__owns(key[0]) or key not in self.fo_pending:
+            return
+        self.retransmit.cancel(key)
 
-                for cid in entry["pending"]:
-                    self.__leader_send(self.clients[cid]["addr"], entry["msg"])
+        group, seq = key
+        vote_id = self.__commit({"op": "complete", "group": group, "S": seq, "reason": reason})
+        if vote_id:
+            started = self.votes[vote_id].get("started")
+            if started is not None:
+                self.metrics.record("poll_lifetime", self.clock() - started)
+            self.metrics.count(f"poll.closed.{reason}")
+            self.__finalize_vote(vote_id)
 
-            for key in finished:
-                group, seq = key
-                entry = self.fo_pending.pop(key)
+        self.__log(f"FO multicast completed: {group}, seq={seq} ({reason})")
 
-                vote_id = entry.get("vote_id")
-                if vote_id:
-                    self.__finalize_vote(vote_id)
+    def __fo_retransmit_tick(self):
+        """
+        Handles all retransmissions and deadlines that are due.
+        Returns when the next one is due (None if nothing is pending).
+        """
+        if not self.__serving():
+            return None
 
-                self.__log(f"FO multicast completed: {group}, seq={seq}")
+        resend, expired = self.retransmit.pop_due(self.clock())
 
-            time.sleep(0.5)
+        for key, cids in resend.items():
+            entry = self.fo_pending.get(key)
+            if entry is not None:
+                self.__fan_out(cids, entry["msg"])
 
-    def run(self):
-        # Discovery via multicast in other threads
-        discovery_thread = threading.Thread(target=self.__discovery_service)
-        discovery_thread.start()
+        for key in expired:
+            self.__fo_complete(key)
 
-        broadcast_thread = threading.Thread(target=self.__discovery_service_broadcast)
-        broadcast_thread.start()
+        return self.retransmit.next_due()
 
-        # CLI is in another thread to not interrupt the server
-        message_thread = threading.Thread(target=self.__message_handling)
-        message_thread.start()
+    def __wake_retransmit(self):
+        if self.loop is not None:
+            self.__arm_retransmit_timer()
+        else:
+            self.retransmit_wakeup.set()
 
-        # FO multicast thread
-        retransmit_thread = threading.Thread(target=self.__fo_retransmit_loop)
-        retransmit_thread.start()
+    def __arm_retransmit_timer(self):
+        """
+        Asyncio mode: one loop timer, always armed for the earliest due event.
+        """
+        if self.retransmit_timer is not None:
+            self.retransmit_timer.cancel()
+            self.retransmit_timer = None
 
-        # CLI
+        due = self.retransmit.next_due()
+        if due is not None and not self.stop_event.is_set():
+            delay = max(due - self.clock(), 0)
+            self.retransmit_timer = self.loop.call_later(delay, self.__on_retransmit_timer)
+
+    def __on_retransmit_timer(self):
+        self.retransmit_timer = None
+        self.__fo_retransmit_tick()
+        self.__arm_retransmit_timer()
+
+    def __fo_retransmit_loop(self):
+        while not self.stop_event.is_set():
+            due = self.__locked(self.__fo_retransmit_tick)
+            timeout = 1.0 if due is None else min(max(due - self.clock(), 0), 1.0)
+            self.retransmit_wakeup.wait(timeout)
+            self.retransmit_wakeup.clear()
+
+    def __cli(self, call):
+        """
+        Interactive menu. Every action goes through call() so that it
+        runs on the loop thread, or under the state lock in threaded mode.
+        """
         while not self.stop_event.is_set():
             print("\n--- Menu ---")
             print("1) Show discovered servers")
             print("2) Start HS election")
             print("3) Show leader")
-            print("4) Exit")
+            print("4) Show message stats")
+            print("5) Show replication status")
+            print("6) Show metrics")
+            print("7) Exit")
             choice = int(input("Choose: "))
             if choice == 1:
                 print(f"Servers: {sorted(self.servers)}")
             elif choice == 2:
-                self.__hs_start()
+                call(self.__hs_start)
             elif choice == 3:
                 print(f"Leader: {self.leader}")
+                print(f"Ring: {self.ring.nodes}")
             elif choice == 4:
-                self.stop_event.set()
+                for t, stats in sorted(self.dispatcher.stats().items()):
+                    print(f"{t}: {stats}")
+            elif choice == 5:
+                print(f"Log index: {self.log.last_index} ({self.durable.mode} durability, {len(self.durable)} waiting)")
+                for server, index in sorted(self.log.acked.items()):
+                    print(f"  {server}: acked {index}")
+                for server, sender in sorted(self.snapshots_out.items()):
+                    print(f"  {server}: snapshot at {sender.index} in transfer")
+                own = self.partitions[self.id]
+                print(f"Partition index: {own.last_index} ({len(self.__owned_groups())} groups, {len(self.part_durable)} waiting)")
+                for server in self.ring.successors(self.id):
+                    print(f"  {server}: acked {own.acked.get(server)}")
+                staleness = self.__staleness()
+                print(f"Read staleness: {'unknown' if staleness is None else f'{staleness:.1f}s'} (bound {self.read_staleness}s)")
+            elif choice == 6:
+                print(json.dumps(self.metrics.snapshot(), indent=2, sort_keys=True))
+            elif choice == 7:
+                self.__shutdown()
             else:
                 print("Invalid choice")
 
-        # Clean exit
-        discovery_thread.join()
-        broadcast_thread.join()
-        message_thread.join()
-        retransmit_thread.join()
+    def __wait_for_shutdown(self):
+        """
+        Headless replacement for the CLI.
+        """
+        while not self.stop_event.wait(1.0):
+            pass
+
+    def __start_link(self):
+        if self.is_worker:
+            # Ask the main process for the current state
+            self.link.send_control(0, {"type": "SHARD_HELLO", "shard": self.shard})
+
+    def __close(self):
+        if self.storage is not None:
+            self.storage.close()
+            self.partition_storage.close()
+        if self.link is not None:
+            self.link.close()
         self.sock.close()
-        self.mcast.close()
+        if not self.is_worker:
+            self.mcast.close()
         self.__log("Shutdown")
+        self.logger.close()
+
+    def run(self, headless=False, elect_after=None):
+        threads = []
+        if not self.is_worker:
+            # Discovery via multicast in other threads
+            threads.append(threading.Thread(target=self.__discovery_service))
+            threads.append(threading.Thread(target=self.__discovery_service_broadcast))
+            threads.append(threading.Thread(target=self.__heartbeat_service))
+
+            # Replication pipeline
+            threads.append(threading.Thread(target=self.__replication_loop))
+
+        # CLI is in another thread to not interrupt the server
+        threads.append(threading.Thread(target=self.__message_handling))
+
+        # FO multicast thread
+        threads.append(threading.Thread(target=self.__fo_retransmit_loop))
+
+        # Messages from the other shard processes
+        if self.link is not None:
+            threads.append(threading.Thread(target=self.__link_handling))
+
+        for thread in threads:
+            thread.start()
+        if self.link is not None:
+            self.__start_link()
+
+        if elect_after is not None:
+            self.__call_later(elect_after, self.__hs_start)
+
+        # CLI
+        if headless or self.is_worker:
+            self.__wait_for_shutdown()
+        else:
+            self.__cli(self.__locked)
+
+        # Clean exit
+        for thread in threads:
+            thread.join()
+        self.__close()
+
+    def __locked(self, fn, *args):
+        """
+        Threaded mode: runs fn holding the state lock.
+        """
+        with self.state_lock:
+            return fn(*args)
+
+    def __every(self, interval, fn, *args):
+        """
+        Periodic event loop timer replacing a sleep loop.
+        """
+        if self.stop_event.is_set():
+            return
+        fn(*args)
+        self.loop.call_later(interval, self.__every, interval, fn, *args)
+
+    async def __serve(self, headless, elect_after):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.__shutdown)
+
+        # Both sockets are driven by the event loop, so all state is
+        # only ever touched from this single thread.
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self.__on_message, self.__on_socket_error),
+            sock=self.sock
+        )
+
+        mcast_transport = None
+        broadcast_sock = None
+        if not self.is_worker:
+            mcast_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: DatagramProtocol(self.__on_discovery, self.__on_socket_error),
+                sock=self.mcast
+            )
+
+            broadcast_sock = self.__open_broadcast_socket()
+            broadcast_sock.setblocking(False)
+            self.__every(1.0, self.__broadcast_tick, broadcast_sock)
+            self.__every(self.heartbeat_interval, self.__heartbeat_tick, broadcast_sock)
+        self.__arm_retransmit_timer()
+
+        if self.link is not None:
+            self.link.sock.setblocking(False)
+            self.loop.add_reader(self.link.sock.fileno(), self.__on_link_readable)
+            self.__start_link()
+
+        if elect_after is not None:
+            self.__call_later(elect_after, self.__hs_start)
+
+        # CLI blocks on input(), so it runs beside the loop
+        if not headless and not self.is_worker:
+            cli_thread = threading.Thread(
+                target=self.__cli,
+                args=(lambda fn: self.loop.call_soon_threadsafe(fn),),
+                daemon=True
+            )
+            cli_thread.start()
+
+        await self.stopped
+
+        # Clean exit
+        if self.link is not None:
+            self.loop.remove_reader(self.link.sock.fileno())
+        if mcast_transport is not None:
+            mcast_transport.close()
+            broadcast_sock.close()
+        self.transport.close()
+        if self.storage is not None:
+            self.storage.close()
+            self.partition_storage.close()
+        if self.link is not None:
+            self.link.close()
+        self.__log("Shutdown")
+        self.logger.close()
+
+    def run_asyncio(self, headless=False, elect_after=None):
+        self.__log("Running in asyncio mode")
+        asyncio.run(self.__serve(headless, elect_after))
+
+    def run_simulated(self, elect_after=None):
+        """
+        Starts the server on its simulated network and returns. The
+        network's event loop drives it from then on, like asyncio does in
+        asyncio mode, with one transport for both unicast and multicast.
+        """
+        self.loop = self.network
+        self.transport = self.network.open((self.ip, self.port), self.__on_message, self.__on_discovery)
+
+        self.__every(1.0, self.__broadcast_tick, self.transport)
+        self.__every(self.heartbeat_interval, self.__heartbeat_tick, self.transport)
+        self.__arm_retransmit_timer()
+
+        if elect_after is not None:
+            self.__call_later(elect_after, self.__hs_start)
+
+    def stop(self):
+        """
+        Stops a simulated server the way a crash would, without a goodbye.
+        """
+        self.stop_event.set()
+        self.transport.close()
 
 
 @click.command()
 @click.argument("port")
-def main(port):
+@click.option("--asyncio", "use_asyncio", is_flag=True, help="Run on a single asyncio event loop instead of threads.")
+@click.option("--durability", type=click.Choice(DURABILITY_MODES), default=DURABILITY_NONE, help="When clients get their reply: at once, after one backup or after a quorum acknowledged the change.")
+@click.option("--repl-window", type=float, default=REPL_WINDOW, help="Seconds mutations are collected into one replication batch.")
+@click.option("--data-dir", type=click.Path(file_okay=False), default=None, help="Keep state on disk in this directory and restore it at startup.")
+@click.option("--host", default=None, help="Address to bind, e.g. 127.0.0.1. Defaults to the outgoing interface.")
+@click.option("--headless", is_flag=True, help="Run without the interactive menu.")
+@click.option("--elect-after", type=float, default=None, help="Start an election this many seconds after startup.")
+@click.option("--log-level", type=click.Choice(list(LEVELS)), default="info")
+@click.option("--log-json", is_flag=True, help="Write log records as JSON lines.")
+@click.option("--log-sample", multiple=True, metavar="CATEGORY=N", help="Keep only every N-th record of a category (msg, vote, discovery, fanout).")
+@click.option("--log-rate", multiple=True, metavar="CATEGORY=N", help="Keep at most N records per second of a category.")
+@click.option("--secret", envvar="VOTECAST_SECRET", required=True, help="Key shared by all servers to sign session tokens.")
+@click.option("--token-ttl", type=float, default=TOKEN_TTL, help="Seconds a session token is valid.")
+@click.option("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL, help="Seconds between heartbeats to the neighbour in the ring.")
+@click.option("--phi-suspect", type=float, default=PHI_SUSPECT, help="Phi at which a neighbour is suspected to have crashed, only logged.")
+@click.option("--phi-threshold", type=float, default=PHI_CRASH, help="Phi at which a neighbour is declared crashed. Lower detects faster, with more false alarms.")
+@click.option("--read-staleness", type=float, default=READ_STALENESS, help="Seconds a backup may lag behind the leader and still answer GET_GROUPS and JOINED_GROUPS.")
+@click.option("--workers", type=click.IntRange(1), default=1, help="Processes sharing the port, each owning a share of the groups.")
+@click.option("--shard", type=int, default=0, hidden=True)
+def main(port, use_asyncio, durability, repl_window, data_dir, host, headless, elect_after, log_level, log_json, log_sample, log_rate, secret, token_ttl, heartbeat_interval, phi_suspect, phi_threshold, read_staleness, workers, shard):
+    if workers > 1 and durability != DURABILITY_NONE:
+        raise click.UsageError("--workers only supports --durability none")
+
+    logger = Logger(f"SERVER/{shard}" if shard else "SERVER", LEVELS[log_level], log_json)
+    for option in log_sample:
+        category, n = option.split("=", 1)
+        logger.sample(category, int(n))
+    for option in log_rate:
+        category, n = option.split("=", 1)
+        logger.limit(category, float(n))
+
     port = int(port)
-    Server(port).run()
-    pass
+    server = Server(port, durability, repl_window, data_dir, host, logger, shard, workers, read_staleness, secret, token_ttl,
+                    heartbeat_interval, phi_suspect, phi_threshold)
+
+    procs = []
+    if workers > 1 and shard == 0:
+        args = [sys.executable, "-u", __file__, str(port), "--host", server.ip, "--workers", str(workers), "--log-level", log_level,
+                "--token-ttl", str(token_ttl)]
+        if use_asyncio:
+            args.append("--asyncio")
+        if log_json:
+            args.append("--log-json")
+        for option in log_sample:
+            args += ["--log-sample", option]
+        for option in log_rate:
+            args += ["--log-rate", option]
+        # The secret goes through the environment, not the process list
+        env = dict(os.environ, VOTECAST_SECRET=secret)
+        for k in range(1, workers):
+            procs.append(subprocess.Popen(args + ["--shard", str(k)], stdin=subprocess.DEVNULL, env=env))
+
+    try:
+        if use_asyncio:
+            server.run_asyncio(headless, elect_after)
+        else:
+            server.run(headless, elect_after)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
 
 
 if __name__ == "__main__":
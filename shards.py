@@ -0,0 +1,113 @@
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+
+# Poll traffic, handled by the worker owning its group. Catalogue and
+# membership changes go through the main process.
+SHARDED_TYPES = {"START_VOTE", "VOTE_ACK"}
+
+# Frame kinds on the local link
+DATAGRAM = b"D"
+CONTROL = b"C"
+
+# A forwarded datagram carries the client address in front
+ADDR = struct.Struct("!4sH")
+
+MAX_FRAME = 256 * 1024
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+# A peer that is still starting is retried for a while
+SEND_RETRIES = 100
+RETRY_DELAY = 0.05
+
+
+def shard_of(group, shards):
+    """
+    Stable across processes, unlike hash().
+    """
+    return zlib.crc32(group.encode()) % shards
+
+
+def link_address(port, shard):
+    # Abstract namespace, nothing to clean up on disk
+    return f"\0votecast-{port}-{shard}"
+
+
+class ShardLink:
+    """
+    Local datagram link between the processes of one server.
+
+    Every process binds its own address, so any shard can reach any other
+    directly. Sends are queued and written by a sender thread: a handler
+    never waits for a busy peer, which could otherwise deadlock two
+    processes sending to each other. Local datagrams are neither lost nor
+    reordered.
+    """
+    def __init__(self, port, shard, log):
+        self.port = port
+        self.shard = shard
+        self.log = log
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.sock.bind(link_address(port, shard))
+        self.sock.settimeout(1.0)
+
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.outbox = queue.SimpleQueue()
+        self.sender = threading.Thread(target=self.__send_loop, daemon=True)
+        self.sender.start()
+
+        # Statistics
+        self.forwarded = 0
+        self.failed = 0
+
+    def __send_loop(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                break
+            shard, frame = item
+            for _ in range(SEND_RETRIES):
+                try:
+                    self.out.sendto(frame, link_address(self.port, shard))
+                    break
+                except (ConnectionRefusedError, FileNotFoundError):
+                    time.sleep(RETRY_DELAY)
+                except OSError as e:
+                    self.log(f"Local link to shard {shard} failed: {e}")
+                    self.failed += 1
+                    break
+            else:
+                self.failed += 1
+
+    def send_datagram(self, shard, data, addr):
+        ip, port = addr
+        self.forwarded += 1
+        self.outbox.put((shard, DATAGRAM + ADDR.pack(socket.inet_aton(ip), port) + data))
+
+    def send_control(self, shard, msg):
+        self.outbox.put((shard, CONTROL + json.dumps(msg).encode()))
+
+    def recv(self):
+        """
+        Returns (DATAGRAM, data, client addr) or (CONTROL, msg, None).
+        """
+        frame = self.sock.recv(MAX_FRAME)
+        kind = frame[:1]
+        if kind == DATAGRAM:
+            ip, port = ADDR.unpack_from(frame, 1)
+            return DATAGRAM, frame[1 + ADDR.size:], (socket.inet_ntoa(ip), port)
+        return CONTROL, json.loads(frame[1:]), None
+
+    def close(self):
+        self.outbox.put(None)
+        self.sender.join(1.0)
+        self.sock.close()
+        self.out.close()
@@ -0,0 +1,377 @@
+import json
+import os
+import sys
+import time
+
+import click
+
+import codec
+from bench import git_commit, summarize, SMALL_GROUP_SIZE
+from failure import HEARTBEAT_INTERVAL
+from logger import Logger, LEVELS
+from netsim import SimNetwork, LATENCY, JITTER
+from ring import HashRing, PARTITIONED_TYPES
+from server import Server
+
+
+# Servers are 10.0.x.y, clients 10.1.x.y, all on this port
+PORT = 7000
+
+# Virtual seconds the servers discover each other before the election
+ELECT_AFTER = 2.5
+
+# Virtual seconds a stage may take before it counts as not converged
+STAGE_TIMEOUT = 120.0
+
+# A new leader first syncs with its backups and puts them on the ring
+SETTLE = 3.0
+
+# Virtual seconds between checks whether a stage is over
+STEP = 0.001
+
+REQUEST_TIMEOUT = 2.0
+
+HS_TYPES = ("HS_ELECTION", "HS_REPLY", "HS_LEADER")
+
+# Key the simulated servers sign session tokens with
+SECRET = "simbench"
+
+# Python randomizes str hashes per process, and with them the order of
+# sets of ids, so runs only repeat with a fixed hash seed
+HASH_SEED = "0"
+
+
+def address(net, i):
+    return f"10.{net}.{i // 250}.{i % 250 + 1}", PORT
+
+
+class SimClient:
+    """
+    A bench client on the simulated network. Nothing may wait in real
+    time there, so requests take a callback for their reply instead of
+    being awaited.
+    """
+    def __init__(self, bench, i):
+        self.bench = bench
+        self.id = f"sim-{i}"
+        self.token = None
+        self.waiting = None
+        self.requests = 0
+        self.voted = set()
+        self.transport = bench.network.open(address(1, i), self.__on_datagram)
+
+    def __on_datagram(self, data, addr):
+        msg = codec.decode(data)
+        msg_type = msg.get("type")
+        if self.waiting is not None and msg_type == self.waiting[0]:
+            _, then, timer, request_type, started = self.waiting
+            self.waiting = None
+            timer.cancel()
+            self.bench.record(request_type, self.bench.network.now - started)
+            then(msg)
+        elif msg_type == "VOTE":
+            self.__vote(msg)
+        elif msg_type == "VOTE_RESULT":
+            self.bench.poll_done(msg)
+        elif msg_type == "NEW_LEADER":
+            self.bench.new_leader(msg)
+        elif msg_type == "ERROR":
+            self.bench.errors += 1
+
+    def send(self, msg):
+        msg["id"] = self.id
+        if self.token is not None:
+            msg["token"] = self.token
+        self.transport.sendto(codec.encode(msg), self.bench.route(msg))
+
+    def request(self, msg, reply_type, then):
+        """
+        Sends msg, then(reply) follows with the reply or None on timeout.
+        """
+        network = self.bench.network
+        self.requests += 1
+        timer = network.call_later(REQUEST_TIMEOUT, self.__timeout, self.requests)
+        self.waiting = (reply_type, then, timer, msg["type"], network.now)
+        self.send(msg)
+
+    def __timeout(self, request):
+        if self.waiting is None or request != self.requests:
+            # Answered, or replaced by a newer request
+            return
+        then = self.waiting[1]
+        self.waiting = None
+        self.bench.timeouts += 1
+        then(None)
+
+    def __vote(self, msg):
+        key = (msg["group"], msg["S"])
+        if key not in self.voted:
+            self.voted.add(key)
+            self.bench.votes += 1
+        # Retransmissions get acked again, the server ignores duplicates
+        self.send({"type": "VOTE_ACK", "vote_id": msg["vote_id"], "group": msg["group"], "S": msg["S"], "vote": "yes"})
+
+
+class SimBench:
+    """
+    One run of a whole cluster on a simulated network: election, polls
+    in small groups and optionally the failover after a leader crash.
+    """
+    def __init__(self, network, servers, clients, polls, poll_timeout):
+        self.network = network
+        self.servers = servers
+        self.n_clients = clients
+        self.polls = polls
+        self.poll_timeout = poll_timeout
+
+        self.leader = None
+        self.ring = HashRing()
+
+        self.latencies = {}
+        self.poll_started = {}
+        self.poll_next = {}
+        self.completions = []
+        self.teams_left = 0
+        self.finished_at = None
+        self.votes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.lost_polls = 0
+
+    def alive(self):
+        return [s for s in self.servers if not s.stop_event.is_set()]
+
+    def agreed_leader(self, previous=None):
+        """
+        The leader all running servers agree on, None while they do not.
+        """
+        alive = self.alive()
+        leader = alive[0].leader
+        if leader is None or leader == previous or leader not in {s.id for s in alive}:
+            return None
+        if any(s.leader != leader or s.election_in_progress for s in alive):
+            return None
+        return leader
+
+    def hs_messages(self):
+        return sum(s.dispatcher.handlers[t].calls for s in self.servers for t in HS_TYPES)
+
+    def run_until(self, done, timeout=STAGE_TIMEOUT):
+        """
+        Runs the network until done() holds, returns the virtual seconds
+        that took or None on timeout.
+        """
+        start = self.network.now
+        while not done():
+            if self.network.now - start > timeout:
+                return None
+            self.network.run(self.network.now + STEP)
+        return self.network.now - start
+
+    def election(self, previous=None):
+        messages = self.hs_messages()
+        sent = self.network.sent
+        elapsed = self.run_until(lambda: self.agreed_leader(previous) is not None)
+        leader = self.agreed_leader(previous)
+        return {
+            "converged": elapsed is not None,
+            "virtual_s": elapsed,
+            "leader": leader,
+            "hs_messages": self.hs_messages() - messages,
+            "datagrams": self.network.sent - sent
+        }
+
+    def route(self, msg):
+        server = None
+        if msg["type"] in PARTITIONED_TYPES and len(self.ring):
+            server = self.ring.owner(msg["group"])
+        ip, port = (server or self.leader).split(":")
+        return ip, int(port)
+
+    def new_leader(self, msg):
+        self.leader = msg["id"]
+        self.ring = HashRing(msg.get("ring", []))
+
+    def record(self, msg_type, seconds):
+        self.latencies.setdefault(msg_type, []).append(seconds)
+
+    def poll_done(self, msg):
+        topic = msg.get("topic")
+        started = self.poll_started.pop(topic, None)
+        if started is None:
+            return
+        self.completions.append(self.network.now - started)
+        self.poll_next.pop(topic)()
+
+    def __poll(self, owner, group, left):
+        if left == 0:
+            self.teams_left -= 1
+            self.finished_at = self.network.now
+            return
+        topic = f"{group}-{left}"
+        self.poll_started[topic] = self.network.now
+        self.poll_next[topic] = lambda: self.__poll(owner, group, left - 1)
+
+        def started(reply):
+            if reply is None:
+                self.__lost(topic)
+            else:
+                self.network.call_later(self.poll_timeout + REQUEST_TIMEOUT, self.__lost, topic)
+
+        owner.request({"type": "START_VOTE", "group": group, "topic": topic, "options": ["yes", "no"],
+                       "timeout": self.poll_timeout}, "START_VOTE_OK", started)
+
+    def __lost(self, topic):
+        if self.poll_started.pop(topic, None) is not None:
+            self.lost_polls += 1
+            self.poll_next.pop(topic)()
+
+    def __form_group(self, team, group):
+        owner, members = team[0], team[1:]
+        joined = []
+
+        def join(reply):
+            joined.append(reply)
+            if len(joined) == len(members):
+                self.__poll(owner, group, self.polls)
+
+        def created(reply):
+            if not members:
+                join(None)
+            for member in members:
+                member.request({"type": "JOIN_GROUP", "group": group}, "JOIN_GROUP_OK", join)
+
+        owner.request({"type": "CREATE_GROUP", "group": group}, "CREATE_GROUP_OK", created)
+
+    def __register(self, client, then):
+        def registered(reply):
+            if reply is not None:
+                client.token = reply["token"]
+            then()
+        client.request({"type": "REGISTER"}, "REGISTER_OK", registered)
+
+    def polls_stage(self):
+        leader = next(s for s in self.servers if s.id == self.leader)
+        self.ring = HashRing(leader.ring.nodes)
+
+        clients = [SimClient(self, i) for i in range(self.n_clients)]
+        teams = [clients[i:i + SMALL_GROUP_SIZE] for i in range(0, len(clients), SMALL_GROUP_SIZE)]
+        self.teams_left = len(teams)
+
+        registered = []
+
+        def start():
+            registered.append(None)
+            if len(registered) == len(clients):
+                for i, team in enumerate(teams):
+                    self.__form_group(team, f"sim-{i}")
+
+        sent = self.network.sent
+        began = self.network.now
+        for client in clients:
+            self.__register(client, start)
+        elapsed = self.run_until(lambda: self.teams_left == 0)
+        if elapsed is not None and clients:
+            elapsed = self.finished_at - began
+        for client in clients:
+            client.transport.close()
+
+        completed = len(self.completions)
+        return {
+            "virtual_s": elapsed,
+            "polls": completed,
+            "polls_per_s": completed / elapsed if elapsed else None,
+            "votes": self.votes,
+            "latency_ms": {t: summarize(v) for t, v in sorted(self.latencies.items())},
+            "poll_completion_ms": summarize(self.completions),
+            "lost_polls": self.lost_polls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "datagrams": self.network.sent - sent
+        }
+
+
+@click.command()
+@click.option("--servers", default=50, help="Servers in the simulated cluster.")
+@click.option("--clients", default=16, help="Simulated clients, in groups of four.")
+@click.option("--polls", default=5, help="Polls started by the first client of every group.")
+@click.option("--poll-timeout", default=5.0, help="Timeout of every poll in virtual seconds.")
+@click.option("--seed", default=0, help="Seed of the network, the same seed gives the same run.")
+@click.option("--latency", default=LATENCY, help="One-way delay of a datagram in seconds.")
+@click.option("--jitter", default=JITTER, help="Random delay added to every datagram, up to this many seconds.")
+@click.option("--loss", default=0.0, help="Probability that a datagram is lost.")
+@click.option("--reorder", default=0.0, help="Probability that a datagram is held back and overtaken.")
+@click.option("--heartbeat-interval", default=HEARTBEAT_INTERVAL, help="Seconds between heartbeats of the servers.")
+@click.option("--crash-leader", is_flag=True, help="Crash the leader after the polls and measure the failover.")
+@click.option("--log-level", type=click.Choice(list(LEVELS)), default="error")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Append the result as a JSON line to this file.")
+def main(servers, clients, polls, poll_timeout, seed, latency, jitter, loss, reorder, heartbeat_interval, crash_leader, log_level, output):
+    """
+    Runs a whole cluster in this process on a simulated network and
+    virtual time, and reports election and poll numbers.
+    """
+    if os.environ.get("PYTHONHASHSEED") != HASH_SEED:
+        os.environ["PYTHONHASHSEED"] = HASH_SEED
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    wall = time.perf_counter()
+    network = SimNetwork(seed, latency, jitter, loss, reorder)
+    logger = Logger("SIM", LEVELS[log_level])
+    cluster = []
+    for i in range(servers):
+        ip, port = address(0, i)
+        cluster.append(Server(port, host=ip, logger=logger, secret=SECRET, heartbeat_interval=heartbeat_interval, network=network))
+    for i, server in enumerate(cluster):
+        server.run_simulated(ELECT_AFTER if i == 0 else None)
+
+    bench = SimBench(network, cluster, clients, polls, poll_timeout)
+    result = {
+        "commit": git_commit(),
+        "time": time.time(),
+        "seed": seed,
+        "servers": servers,
+        "clients": clients,
+        "polls": polls,
+        "latency": latency,
+        "jitter": jitter,
+        "loss": loss,
+        "reorder": reorder
+    }
+
+    network.run(ELECT_AFTER)
+    result["election"] = bench.election()
+    if result["election"]["converged"]:
+        bench.leader = result["election"]["leader"]
+        network.run(network.now + SETTLE)
+        result["workload"] = bench.polls_stage()
+
+        if crash_leader:
+            old = bench.leader
+            next(s for s in cluster if s.id == old).stop()
+            result["failover"] = bench.election(old)
+
+    result["network"] = {
+        "virtual_s": network.now,
+        "sent": network.sent,
+        "delivered": network.delivered,
+        "dropped": network.dropped,
+        "bytes": network.bytes,
+        "events": network.events_run,
+        "errors": network.errors
+    }
+    result["wall_s"] = time.perf_counter() - wall
+
+    for server in cluster:
+        if not server.stop_event.is_set():
+            server.stop()
+    logger.close()
+
+    line = json.dumps(result)
+    print(line)
+    if output:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import base64
+import json
+import zlib
+
+
+# Raw bytes per chunk, base64 keeps a chunk message well below BUF
+CHUNK_BYTES = 2048
+
+# Most chunk numbers a receiver asks for in one SNAP_NACK
+MAX_NACK = 256
+
+
+def encode(state):
+    return zlib.compress(json.dumps(state).encode())
+
+
+def decode(data):
+    return json.loads(zlib.decompress(data).decode())
+
+
+class SnapshotSender:
+    """
+    One snapshot split into checksummed chunks.
+
+    The sender streams SNAP_BEGIN, every SNAP_CHUNK and SNAP_END. The
+    receiver answers SNAP_END with the chunks it is still missing and the
+    sender resends only those, until the receiver commits the snapshot.
+    """
+    def __init__(self, sender_id, snap_id, index, data, partition=None):
+        self.sender_id = sender_id
+        self.snap_id = snap_id
+        self.index = index
+        self.data = data
+        self.partition = partition
+        self.chunks = [data[i:i + CHUNK_BYTES] for i in range(0, len(data), CHUNK_BYTES)] or [b""]
+
+    def begin(self):
+        msg = {
+            "type": "SNAP_BEGIN",
+            "id": self.sender_id,
+            "snap_id": self.snap_id,
+            "index": self.index,
+            "chunks": len(self.chunks),
+            "size": len(self.data),
+            "crc": zlib.crc32(self.data)
+        }
+        if self.partition is not None:
+            # Polls of one server's groups rather than the whole state
+            msg["partition"] = self.partition
+        return msg
+
+    def chunk(self, seq):
+        data = self.chunks[seq]
+        return {
+            "type": "SNAP_CHUNK",
+            "id": self.sender_id,
+            "snap_id": self.snap_id,
+            "seq": seq,
+            "crc": zlib.crc32(data),
+            "data": base64.b64encode(data).decode()
+        }
+
+    def end(self):
+        return {"type": "SNAP_END", "id": self.sender_id, "snap_id": self.snap_id}
+
+
+class SnapshotReceiver:
+    """
+    Collects the chunks of one snapshot, in any order and across resends.
+    """
+    def __init__(self, begin):
+        self.snap_id = begin["snap_id"]
+        self.index = begin["index"]
+        self.count = begin["chunks"]
+        self.size = begin["size"]
+        self.crc = begin["crc"]
+        self.partition = begin.get("partition")
+        self.chunks = {}
+
+    def add(self, msg):
+        """
+        Stores a chunk. Returns False if its checksum does not match.
+        """
+        seq = msg["seq"]
+        if not 0 <= seq < self.count:
+            return False
+
+        data = base64.b64decode(msg["data"])
+        if zlib.crc32(data) != msg["crc"]:
+            return False
+
+        self.chunks[seq] = data
+        return True
+
+    def missing(self):
+        return [seq for seq in range(self.count) if seq not in self.chunks][:MAX_NACK]
+
+    def assemble(self):
+        """
+        The complete snapshot, or None if it fails the final checksum.
+        """
+        data = b"".join(self.chunks[seq] for seq in range(self.count))
+        if len(data) != self.size or zlib.crc32(data) != self.crc:
+            return None
+        return data
@@ -0,0 +1,164 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+WAL_FILE = "wal.log"
+SNAPSHOT_FILE = "snapshot.bin"
+
+# Log entries between two snapshots
+SNAPSHOT_EVERY = 10000
+
+# WAL record: payload length and CRC32, then [index, op] as JSON
+RECORD = struct.Struct("!II")
+
+# Snapshot file: magic, log index, body length and CRC32, then the
+# compressed state
+SNAPSHOT_MAGIC = b"SNP1"
+SNAPSHOT_HEADER = struct.Struct("!4sQII")
+
+
+class Storage:
+    """
+    Server state on disk: a write-ahead log of every applied mutation
+    and a snapshot of the whole state every SNAPSHOT_EVERY entries.
+
+    Appends are only buffered; sync() makes everything appended so far
+    durable with a single fsync, so callers batch as many mutations per
+    fsync as they can. A snapshot replaces the WAL, it is written to a
+    temporary file and renamed into place.
+    """
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        os.makedirs(path, exist_ok=True)
+
+        self.wal_path = os.path.join(path, WAL_FILE)
+        self.snapshot_path = os.path.join(path, SNAPSHOT_FILE)
+        self.wal = None
+        self.dirty = False
+        self.since_snapshot = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.fsyncs = 0
+
+    def load(self):
+        """
+        Reads the last snapshot and the WAL written after it.
+        Returns (snapshot index, state or None, [(index, op), ...]).
+        A torn record at the end of the WAL is cut off.
+        """
+        index, state = self.__read_snapshot()
+        entries, end = self.__read_wal()
+
+        with open(self.wal_path, "ab") as f:
+            if f.tell() != end:
+                f.truncate(end)
+
+        self.wal = open(self.wal_path, "ab")
+        entries = [(i, op) for i, op in entries if i > index]
+        self.since_snapshot = len(entries)
+        return index, state, entries
+
+    def __read_snapshot(self):
+        if not os.path.exists(self.snapshot_path) or os.path.getsize(self.snapshot_path) < SNAPSHOT_HEADER.size:
+            return 0, None
+
+        with open(self.snapshot_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, index, length, crc = SNAPSHOT_HEADER.unpack_from(m, 0)
+                view = memoryview(m)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length]
+                try:
+                    if magic != SNAPSHOT_MAGIC or len(view) != length or zlib.crc32(view) != crc:
+                        raise ValueError(f"Corrupt snapshot {self.snapshot_path}")
+                    state = json.loads(zlib.decompress(view))
+                finally:
+                    view.release()
+        return index, state
+
+    def __read_wal(self):
+        """
+        Returns the intact records and the offset where they end.
+        """
+        if not os.path.exists(self.wal_path) or os.path.getsize(self.wal_path) == 0:
+            return [], 0
+
+        entries = []
+        offset = 0
+        with open(self.wal_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                size = len(m)
+                while offset + RECORD.size <= size:
+                    length, crc = RECORD.unpack_from(m, offset)
+                    start = offset + RECORD.size
+                    payload = m[start:start + length]
+                    if len(payload) != length or zlib.crc32(payload) != crc:
+                        break
+                    index, op = json.loads(payload)
+                    entries.append((index, op))
+                    offset = start + length
+        return entries, offset
+
+    def append(self, index, op):
+        payload = json.dumps([index, op], separators=(",", ":")).encode()
+        with self.lock:
+            self.wal.write(RECORD.pack(len(payload), zlib.crc32(payload)))
+            self.wal.write(payload)
+            self.dirty = True
+            self.since_snapshot += 1
+
+    def sync(self):
+        """
+        Makes every append so far durable. Returns False if there was nothing to do.
+        """
+        with self.lock:
+            if not self.dirty:
+                return False
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.dirty = False
+            self.fsyncs += 1
+            return True
+
+    def snapshot_due(self):
+        return self.since_snapshot >= self.snapshot_every
+
+    def snapshot(self, index, state):
+        """
+        Writes a snapshot at index and starts an empty WAL after it.
+        """
+        body = zlib.compress(json.dumps(state, separators=(",", ":")).encode())
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, index, len(body), zlib.crc32(body))
+
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self.__sync_dir()
+
+        # Older records are covered by the snapshot now
+        with self.lock:
+            self.wal.close()
+            self.wal = open(self.wal_path, "wb")
+            self.dirty = False
+            self.since_snapshot = 0
+
+    def __sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.wal is not None:
+            self.sync()
+            self.wal.close()
+            self.wal = None
@@ -0,0 +1,183 @@
+import math
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+# At the same incarnation the worse news wins
+RANK = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+
+# Times a change is piggybacked, per log2 of the cluster size
+GOSSIP_FACTOR = 3
+
+# Changes carried by one heartbeat or ack
+MAX_UPDATES = 8
+
+# Servers asked to probe a suspected neighbour on this server's behalf
+INDIRECT_PROBES = 3
+
+# Seconds a dead server is still probed before it is forgotten. One that
+# comes back later is found again through its discovery announcements.
+DEAD_TIMEOUT = 300.0
+
+
+class ServerList:
+    """
+    SWIM style membership of the servers.
+
+    Every server is alive, suspect or dead at an incarnation. Only a
+    server raises its own incarnation, to refute being suspected or
+    declared dead, so between two claims about a server the higher
+    incarnation wins and at the same one the worse news does.
+
+    Changes are spread by piggybacking them on heartbeats, each about
+    GOSSIP_FACTOR * log2(n) times, so no server's traffic grows with the
+    cluster. The live servers are kept sorted, a server joining or
+    leaving is one bisect instead of sorting them all.
+    """
+    def __init__(self, own_id, rng=None, clock=time.monotonic):
+        self.id = own_id
+        self.incarnation = 0
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # id -> (state, incarnation), dead ones included
+        self.states = {}
+        # Dead ids -> when they were declared dead
+        self.died = {}
+        # Live (alive or suspect) ids in order, the ring
+        self.ordered = []
+        # Changes still to be piggybacked -> times they were
+        self.pending = {}
+
+        self.__set(own_id, ALIVE, 0)
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def __iter__(self):
+        return iter(list(self.ordered))
+
+    def __contains__(self, sid):
+        state = self.states.get(sid)
+        return state is not None and state[0] != DEAD
+
+    def state(self, sid):
+        """
+        (state, incarnation) of sid, None if it was never heard of.
+        """
+        return self.states.get(sid)
+
+    def __set(self, sid, state, incarnation):
+        was_live = sid in self
+        self.states[sid] = (state, incarnation)
+        if state != DEAD and not was_live:
+            insort(self.ordered, sid)
+        elif state == DEAD and was_live:
+            del self.ordered[bisect_left(self.ordered, sid)]
+        if state != DEAD:
+            self.died.pop(sid, None)
+        elif sid not in self.died:
+            self.died[sid] = self.clock()
+        self.pending[sid] = 0
+
+    def apply(self, sid, state, incarnation):
+        """
+        Takes in a claim about sid. Returns True if it changed what is
+        known, a claim that this server is not alive makes it refute.
+        """
+        with self.lock:
+            if sid == self.id:
+                if state == ALIVE or incarnation < self.incarnation:
+                    return False
+                self.incarnation = incarnation + 1
+                self.__set(sid, ALIVE, self.incarnation)
+                return True
+
+            current = self.states.get(sid)
+            if current is not None:
+                current_state, current_incarnation = current
+                if incarnation < current_incarnation:
+                    return False
+                if incarnation == current_incarnation and RANK[state] <= RANK[current_state]:
+                    return False
+            self.__set(sid, state, incarnation)
+            return True
+
+    def neighbours(self):
+        """
+        The live servers before and after this one on the ring.
+        """
+        with self.lock:
+            i = bisect_left(self.ordered, self.id)
+            n = len(self.ordered)
+            return self.ordered[(i - 1) % n], self.ordered[(i + 1) % n]
+
+    def successor(self, sid):
+        """
+        The live server after sid on the ring, sid itself not counted.
+        """
+        with self.lock:
+            others = len(self.ordered) - (sid in self)
+            if others == 0:
+                return None
+            i = bisect_right(self.ordered, sid) % len(self.ordered)
+            return self.ordered[i]
+
+    def dead(self):
+        """
+        Ids of the servers known as dead.
+        """
+        with self.lock:
+            return [sid for sid, (state, _) in self.states.items() if state == DEAD]
+
+    def evict(self, timeout=DEAD_TIMEOUT):
+        """
+        Forgets the servers dead for at least timeout seconds and
+        returns their ids.
+        """
+        with self.lock:
+            now = self.clock()
+            gone = [sid for sid, since in self.died.items() if now - since >= timeout]
+            for sid in gone:
+                del self.states[sid]
+                del self.died[sid]
+                self.pending.pop(sid, None)
+            return gone
+
+    def sample(self, k, exclude=()):
+        """
+        Up to k random live servers other than this one and exclude.
+        """
+        with self.lock:
+            candidates = [s for s in self.ordered if s != self.id and s not in exclude]
+        return self.rng.sample(candidates, min(k, len(candidates)))
+
+    def updates(self):
+        """
+        Changes for the next heartbeat or ack, the least spread first.
+        """
+        with self.lock:
+            limit = GOSSIP_FACTOR * max(math.ceil(math.log2(len(self.ordered) + 1)), 1)
+            picked = sorted(self.pending, key=self.pending.get)[:MAX_UPDATES]
+            out = []
+            for sid in picked:
+                state, incarnation = self.states[sid]
+                out.append([sid, state, incarnation])
+                self.pending[sid] += 1
+                if self.pending[sid] >= limit:
+                    del self.pending[sid]
+            return out
+
+    def digest(self):
+        """
+        Everything known, for a server that just joined.
+        """
+        with self.lock:
+            return [[sid, state, incarnation] for sid, (state, incarnation) in sorted(self.states.items())]
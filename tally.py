@@ -0,0 +1,101 @@
+# Close policies selectable at START_VOTE
+CLOSE_ALL = "all"
+CLOSE_MAJORITY = "majority"
+CLOSE_DECIDED = "decided"
+CLOSE_POLICIES = (CLOSE_ALL, CLOSE_MAJORITY, CLOSE_DECIDED)
+
+
+class Tally:
+    """
+    Running result of one poll.
+
+    Keeps a counter per option and the current ballot of every voter, so
+    every VOTE_ACK is O(1): duplicates are ignored and a changed vote moves
+    one count from the old option to the new one.
+    """
+    def __init__(self, options, ballots=None):
+        self.options = list(options)
+        self.counts = {option: 0 for option in self.options}
+        self.ballots = {}
+
+        for voter, option in (ballots or {}).items():
+            self.cast(voter, option)
+
+    def is_option(self, option):
+        try:
+            return option in self.counts
+        except TypeError:
+            return False
+
+    def cast(self, voter, option):
+        """
+        Records voter's ballot. Returns False if it was a duplicate.
+        Raises KeyError for options that are not part of the poll.
+        """
+        if option not in self.counts:
+            raise KeyError(option)
+
+        previous = self.ballots.get(voter)
+        if previous == option:
+            return False
+
+        if previous is not None:
+            self.counts[previous] -= 1
+        self.counts[option] += 1
+        self.ballots[voter] = option
+        return True
+
+    def total(self):
+        return len(self.ballots)
+
+    def winner(self):
+        """
+        Option with the most votes, ties go to the earlier option.
+        None if nobody voted.
+        """
+        if not self.ballots:
+            return None
+        return max(self.options, key=self.counts.__getitem__)
+
+    def has_majority(self, electorate):
+        """
+        True once one option holds more than half of the electorate.
+        """
+        return any(2 * count > electorate for count in self.counts.values())
+
+    def is_decided(self, electorate):
+        """
+        True once no distribution of the outstanding ballots can change
+        the winner.
+        """
+        leader = self.winner()
+        if leader is None:
+            return False
+
+        remaining = max(electorate - self.total(), 0)
+        lead = self.counts[leader]
+        rank = self.options.index(leader)
+        for i, option in enumerate(self.options):
+            if option == leader:
+                continue
+            best = self.counts[option] + remaining
+            # On a tie the earlier option wins
+            if best > lead or (best == lead and i < rank):
+                return False
+        return True
+
+    def should_close(self, policy, electorate):
+        if policy == CLOSE_ALL:
+            return self.total() >= electorate
+        if policy == CLOSE_MAJORITY:
+            return self.has_majority(electorate)
+        if policy == CLOSE_DECIDED:
+            return self.is_decided(electorate)
+        return False
+
+    def to_dict(self):
+        return {"options": self.options, "ballots": self.ballots}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["options"], data.get("ballots"))
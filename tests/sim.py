@@ -0,0 +1,82 @@
+import codec
+from logger import Logger, ERROR
+from netsim import SimNetwork
+from server import Server
+
+
+# Virtual seconds before the first server starts the election, and the
+# new leader takes to sync and put everybody on the ring
+ELECT_AFTER = 2.5
+SETTLE = 3.0
+
+# Key the servers sign session tokens with
+SECRET = "test"
+
+
+def address(sid):
+    ip, port = sid.split(":")
+    return ip, int(port)
+
+
+class Cluster:
+    """
+    Servers on a simulated network, elected and on the ring unless
+    elect is False.
+    """
+    def __init__(self, n, seed=0, elect=True, **options):
+        self.network = SimNetwork(seed)
+        self.logger = Logger("TEST", ERROR)
+        options.setdefault("secret", SECRET)
+        self.servers = [Server(7000, host=f"10.0.0.{i + 1}", logger=self.logger, network=self.network, **options)
+                        for i in range(n)]
+        for i, server in enumerate(self.servers):
+            server.run_simulated(ELECT_AFTER if elect and i == 0 else None)
+        self.run(ELECT_AFTER + SETTLE if elect else 0)
+
+    def run(self, seconds):
+        self.network.run(self.network.now + seconds)
+
+    def server(self, sid):
+        return next(s for s in self.servers if s.id == sid)
+
+    def leader(self):
+        return next(s for s in self.servers if s.is_leader)
+
+    def owner(self, group):
+        return self.server(self.leader().ring.owner(group))
+
+
+class Client:
+    """
+    A client on the simulated network that keeps what it receives.
+    """
+    def __init__(self, cluster, i=1):
+        self.cluster = cluster
+        self.id = f"client-{i}"
+        self.token = None
+        self.inbox = []
+        self.transport = cluster.network.open((f"10.1.0.{i}", 7000), self.__on_datagram)
+
+    def __on_datagram(self, data, addr):
+        self.inbox.append(codec.decode(data))
+
+    def send(self, server, msg):
+        msg.setdefault("id", self.id)
+        if self.token is not None:
+            msg.setdefault("token", self.token)
+        self.transport.sendto(codec.encode(msg), address(server.id))
+        self.cluster.run(0.5)
+
+    def received(self, msg_type):
+        return [m for m in self.inbox if m.get("type") == msg_type]
+
+    def register(self):
+        self.send(self.cluster.leader(), {"type": "REGISTER"})
+        self.token = self.received("REGISTER_OK")[-1]["token"]
+
+    def create_group(self, group):
+        self.send(self.cluster.leader(), {"type": "CREATE_GROUP", "group": group})
+
+    def start_vote(self, group, topic, options=("yes", "no"), timeout=30):
+        msg = {"type": "START_VOTE", "group": group, "topic": topic, "options": list(options), "timeout": timeout}
+        self.send(self.cluster.owner(group), msg)
@@ -0,0 +1,45 @@
+import json
+
+import client
+from ring import HashRing, leader_reply, parse_leader_reply
+
+
+def cached_client(tmp_path, monkeypatch, cached):
+    path = tmp_path / "leader.json"
+    path.write_text(json.dumps(cached))
+    monkeypatch.setattr(client, "LEADER_CACHE", str(path))
+    c = client.Client()
+    c.discover_leader()
+    return c
+
+
+def test_cached_epoch_is_not_trusted(tmp_path, monkeypatch):
+    # Written before a full restart of the cluster, which counts epochs anew
+    c = cached_client(tmp_path, monkeypatch, {"leader": "10.0.0.1:7000", "epoch": 5, "ring": ["10.0.0.1:7000"]})
+    assert c.leader == "10.0.0.1:7000"
+    assert c.epoch == 0
+
+    c._Client__handle_message({"type": "NEW_LEADER", "id": "10.0.0.2:7000", "epoch": 1, "ring": ["10.0.0.2:7000"]}, None)
+    assert (c.leader, c.epoch) == ("10.0.0.2:7000", 1)
+    assert json.loads((tmp_path / "leader.json").read_text()) == {"leader": "10.0.0.2:7000", "ring": ["10.0.0.2:7000"]}
+    c.logger.close()
+
+
+def test_redirect_from_the_leader_itself_is_followed(tmp_path, monkeypatch):
+    c = cached_client(tmp_path, monkeypatch, {"leader": "10.0.0.1:7000", "ring": ["10.0.0.1:7000"]})
+    c.epoch = 5
+
+    # Another server with an older epoch is outdated
+    c._Client__redirected({"type": "REDIRECT", "id": "10.0.0.3:7000", "leader": "10.0.0.3:7000", "epoch": 1})
+    assert c.leader == "10.0.0.1:7000"
+
+    # The leader itself says it no longer leads
+    c._Client__redirected({"type": "REDIRECT", "id": "10.0.0.1:7000", "leader": "10.0.0.2:7000", "epoch": 1})
+    assert (c.leader, c.epoch) == ("10.0.0.2:7000", 1)
+    c.logger.close()
+
+
+def test_leader_reply_carries_the_epoch():
+    ring = HashRing(["10.0.0.1:7000", "10.0.0.2:7000"])
+    leader, parsed, epoch = parse_leader_reply(leader_reply("10.0.0.1:7000", ring, 3))
+    assert (leader, parsed.nodes, epoch) == ("10.0.0.1:7000", ring.nodes, 3)
@@ -0,0 +1,20 @@
+from failure import PhiAccrualDetector, PHI_CRASH
+
+
+def test_phi_grows_with_silence():
+    detector = PhiAccrualDetector(interval=0.5)
+    detector.reset("peer", 0.0)
+    values = [detector.phi(t) for t in (0.0, 0.5, 0.8, 1.5)]
+    assert values == sorted(values)
+    assert values[0] < 0.01
+    assert values[-1] > PHI_CRASH
+
+
+def test_long_intervals():
+    for interval in (2.5, 3.0, 60.0):
+        detector = PhiAccrualDetector(interval=interval)
+        detector.reset("peer", 100.0)
+        # Right after an ack the wait is far below the mean
+        assert detector.phi(100.0) < 0.01
+        assert detector.phi(100.0 + interval) < 1.0
+        assert detector.phi(100.0 + 10 * interval) > PHI_CRASH
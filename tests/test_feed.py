@@ -0,0 +1,21 @@
+import codec
+from server import FEED_BYTES
+from sim import Cluster, Client
+
+
+def test_feed_frames_keep_to_the_budget():
+    cluster = Cluster(3)
+    client = Client(cluster)
+    client.register()
+    leader = cluster.leader()
+    since = leader.log.last_index
+    for i in range(40):
+        client.create_group(f"group-{i:02}-" + "x" * 300)
+    until = leader.log.last_index
+
+    frames = list(leader._Server__feed(since, until))
+    assert len(frames) > 1
+    assert all(len(codec.encode(frame)) <= FEED_BYTES for frame in frames)
+    assert [f["prev"] for f in frames[1:]] == [f["seq"] for f in frames[:-1]]
+    assert frames[0]["prev"] == since and frames[-1]["seq"] == until
+    assert sorted(g for f in frames for g in f["added"]) == sorted(leader.groups)
@@ -0,0 +1,51 @@
+from logger import Logger, ERROR
+from netsim import SimNetwork
+from server import Server
+from swim import DEAD, DEAD_TIMEOUT
+
+
+def cluster(network, n):
+    logger = Logger("TEST", ERROR)
+    servers = [Server(7000, host=f"10.0.0.{i + 1}", logger=logger, secret="test", network=network) for i in range(n)]
+    for server in servers:
+        server.run_simulated()
+    return servers
+
+
+def members(server):
+    return sorted(server.servers)
+
+
+def test_partition_heals():
+    network = SimNetwork(seed=1)
+    servers = cluster(network, 6)
+    network.run(5.0)
+    everybody = members(servers[0])
+    assert len(everybody) == 6
+
+    left, right = servers[:3], servers[3:]
+    network.partition([(s.ip, s.port) for s in left], [(s.ip, s.port) for s in right])
+    network.run(network.now + 30.0)
+    assert all(members(s) == sorted(t.id for t in left) for s in left)
+    assert all(members(s) == sorted(t.id for t in right) for s in right)
+
+    network.heal()
+    network.run(network.now + 60.0)
+    assert all(members(s) == everybody for s in servers)
+    assert network.errors == 0
+
+
+def test_dead_servers_are_forgotten():
+    network = SimNetwork(seed=2)
+    servers = cluster(network, 4)
+    network.run(5.0)
+    crashed, rest = servers[0], servers[1:]
+    crashed.stop()
+
+    network.run(network.now + 30.0)
+    assert all(s.servers.state(crashed.id)[0] == DEAD for s in rest)
+
+    network.run(network.now + DEAD_TIMEOUT)
+    assert all(s.servers.state(crashed.id) is None and not s.servers.dead() for s in rest)
+    assert all(members(s) == sorted(t.id for t in rest) for s in rest)
+    assert network.errors == 0
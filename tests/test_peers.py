@@ -0,0 +1,23 @@
+from sim import Cluster, Client
+
+
+def test_strangers_get_no_log_entries():
+    cluster = Cluster(3)
+    client = Client(cluster)
+    client.register()
+    client.create_group("g")
+    leader = cluster.leader()
+    owner = cluster.owner("g")
+    backup = next(s for s in cluster.servers if s is not leader)
+
+    # Unknown ids, and the ids of servers sent from somewhere else
+    for sid in ("10.1.0.1:7000", backup.id):
+        client.inbox.clear()
+        client.send(leader, {"type": "REPL_FETCH", "id": sid, "from": 1})
+        client.send(leader, {"type": "REPL_SYNC", "id": sid, "index": 0})
+        client.send(owner, {"type": "PART_FETCH", "id": sid, "from": 1})
+        assert client.inbox == []
+
+    refused = sum(s.metrics.snapshot()["counters"].get("error.NOT_A_PEER", 0) for s in cluster.servers)
+    assert refused == 6
+    assert cluster.network.errors == 0
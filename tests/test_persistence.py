@@ -0,0 +1,39 @@
+import codec
+from logger import Logger, ERROR
+from netsim import SimNetwork
+from server import Server
+
+
+LEADER = ("10.0.0.1", 7000)
+BACKUP = ("10.0.0.2", 7000)
+
+
+def backup(network, data_dir):
+    server = Server(BACKUP[1], host=BACKUP[0], data_dir=data_dir, logger=Logger("TEST", ERROR), secret="test", network=network)
+    server.run_simulated()
+    # Backups only take log entries from servers they know
+    server.leader = "10.0.0.1:7000"
+    return server
+
+
+def create_group(name):
+    return {"op": "create_group", "group": name, "owner": "c1", "addr": ["10.1.0.1", 7000], "codec": codec.JSON}
+
+
+def test_snapshot_inside_a_frame_keeps_the_rest_of_the_frame(tmp_path):
+    network = SimNetwork()
+    server = backup(network, str(tmp_path))
+    server.storage.snapshot_every = 3
+
+    leader = network.open(LEADER, lambda data, addr: None)
+    entries = [[i, create_group(f"g{i}")] for i in range(1, 6)]
+    leader.sendto(codec.encode({"type": "REPL_APPEND", "id": "10.0.0.1:7000", "entries": entries}), BACKUP)
+    network.run(1.0)
+    assert sorted(server.groups) == [f"g{i}" for i in range(1, 6)]
+    server.stop()
+    server.logger.close()
+
+    restored = backup(SimNetwork(), str(tmp_path))
+    assert restored.log.last_index == 5
+    assert sorted(restored.groups) == [f"g{i}" for i in range(1, 6)]
+    restored.logger.close()
@@ -0,0 +1,83 @@
+from sim import Cluster, Client
+
+
+def test_malformed_polls_are_refused():
+    cluster = Cluster(3)
+    client = Client(cluster)
+    client.register()
+    client.create_group("g")
+    owner = cluster.owner("g")
+    index = owner.partitions[owner.id].last_index
+
+    for options, timeout, topic in (([{"x": 1}], 30, "t"), ([], 30, "t"), (["a", "a"], 30, "t"),
+                                    (["a", "b"], "30", "t"), (["a", "b"], -1, "t"), (["a", "b"], True, "t"),
+                                    (["a", "b"], 30, 5)):
+        client.inbox.clear()
+        client.send(owner, {"type": "START_VOTE", "group": "g", "topic": topic, "options": options, "timeout": timeout})
+        assert [m["error"] for m in client.received("ERROR")] == ["INVALID_POLL"]
+    assert owner.partitions[owner.id].last_index == index
+
+    client.start_vote("g", "fine")
+    assert client.received("START_VOTE_OK")
+    assert cluster.network.errors == 0
+
+
+def start_vote_op(group, vote_id, options):
+    return {"op": "start_vote", "vote_id": vote_id, "group": group, "topic": "t", "options": options,
+            "close": "all", "started": 0.0, "deadline": 30.0}
+
+
+def test_failing_op_is_not_logged_or_replicated():
+    cluster = Cluster(3)
+    client = Client(cluster)
+    client.register()
+    client.create_group("g")
+    owner = cluster.owner("g")
+    log = owner.partitions[owner.id]
+    index = log.last_index
+
+    try:
+        owner._Server__commit(start_vote_op("g", "bad", [{"x": 1}]))
+    except TypeError:
+        pass
+    assert log.last_index == index
+
+    client.start_vote("g", "fine")
+    cluster.run(1.0)
+    backups = [cluster.server(b) for b in owner.ring.successors(owner.id)]
+    assert backups
+    assert all(sorted(b.fo_pending) == sorted(owner.fo_pending) for b in backups)
+
+
+def test_backup_skips_a_failing_entry():
+    cluster = Cluster(3)
+    client = Client(cluster)
+    client.register()
+    client.create_group("g")
+    owner = cluster.owner("g")
+    backup = cluster.server(owner.ring.successors(owner.id)[0])
+    index = backup.partitions[owner.id].last_index
+
+    entries = [[index + 1, start_vote_op("g", "bad", [{"x": 1}])],
+               [index + 2, start_vote_op("g", "good", ["a", "b"])]]
+    backup._Server__part_append({"type": "PART_APPEND", "id": owner.id, "entries": entries}, (owner.ip, owner.port))
+    assert "good" in backup.votes
+    assert backup.metrics.snapshot()["counters"]["repl.apply_failed"] == 1
+
+
+def test_new_owner_continues_the_vote_stream():
+    cluster = Cluster(4)
+    client = Client(cluster)
+    client.register()
+    client.create_group("g")
+    owner = cluster.owner("g")
+    client.start_vote("g", "first")
+
+    owner.stop()
+    cluster.run(15.0)
+    assert cluster.owner("g") is not owner
+    client.start_vote("g", "second")
+
+    votes = {m["topic"]: m for m in client.received("VOTE")}
+    assert votes["first"]["S"] + 1 == votes["second"]["S"]
+    assert votes["first"]["sender"] == votes["second"]["sender"] == "g"